@@ -0,0 +1,103 @@
+import struct
+from collections import deque
+
+# data offset, fragment part (| 0x80 for the last fragment), packet flags, data length
+_FRAGMENT_HEADER = struct.Struct("!IBBH")
+FRAGMENT_HEADER_SIZE = _FRAGMENT_HEADER.size
+LAST_FRAGMENT_BIT = 0x80
+
+MAX_PARTS = 64
+
+
+class _PendingPacket:
+    __slots__ = ("entry_time", "data_offset", "data", "packet_flags", "sent", "next_part")
+
+    def __init__(self, entry_time: float, data_offset: int, data: bytes, packet_flags: int) -> None:
+        self.entry_time = entry_time  # updated on every sent fragment
+        self.data_offset = data_offset
+        self.data = memoryview(data)
+        self.packet_flags = packet_flags
+        self.sent = 0
+        self.next_part = 0
+
+
+class AnswerQueue:
+    """
+    packets that wait for queries of the other side, to be sent in the answers of their responses.
+    the data is not encoded (answers are binary), every fragment gets a small binary header with the same data offset,
+    fragment part and packet flags as the fragments that are sent in queries, so the other side reassembles both
+    the same way. a packet that no query picked up within hold_time is handed back (expired) to be sent in queries.
+    """
+
+    def __init__(self, hold_time: float, max_packets: int) -> None:
+        self.hold_time = hold_time
+        self.max_packets = max_packets
+        self.packets: deque[_PendingPacket] = deque()
+
+    def __bool__(self) -> bool:
+        return bool(self.packets)
+
+    def put(self, now: float, data_offset: int, data: bytes, packet_flags: int) -> bool:
+        if len(self.packets) >= self.max_packets:
+            return False
+        self.packets.append(_PendingPacket(now, data_offset, data, packet_flags))
+        return True
+
+    def take(self, now: float, capacity: int) -> bytes:
+        """
+        fragments of the waiting packets, in order, that fit in capacity bytes
+        """
+        packets = self.packets
+        parts = []
+        while packets and capacity > FRAGMENT_HEADER_SIZE:
+            packet = packets[0]
+            remaining = len(packet.data) - packet.sent
+            size = capacity - FRAGMENT_HEADER_SIZE
+            if size >= remaining:
+                size = remaining
+            elif packet.next_part == MAX_PARTS - 1 or (packet.sent == 0 and size * (MAX_PARTS - 1) < remaining):
+                # the rest must go in one fragment / the packet would need more than MAX_PARTS fragments
+                break
+            last = size == remaining
+            parts.append(_FRAGMENT_HEADER.pack(packet.data_offset,
+                                               packet.next_part | (LAST_FRAGMENT_BIT if last else 0),
+                                               packet.packet_flags, size))
+            parts.append(packet.data[packet.sent:packet.sent + size])
+            capacity -= FRAGMENT_HEADER_SIZE + size
+            packet.sent += size
+            packet.next_part += 1
+            packet.entry_time = now
+            if last:
+                packets.popleft()
+        return b"".join(parts)
+
+    def expired(self, now: float) -> list[tuple[int, bytes, int]]:
+        """
+        removes the packets that waited longer than hold_time, returns them as (data offset, data, packet flags).
+        only the first packet can be started (partly sent), it expires hold_time after its last fragment and its
+        data offset is -1: the fragments that are on the way can not be mixed with fragments sent in queries,
+        so it must be sent again with a new data offset.
+        """
+        result = []
+        packets = self.packets
+        deadline = now - self.hold_time
+        while packets and packets[0].entry_time < deadline:
+            packet = packets.popleft()
+            result.append((-1 if packet.sent else packet.data_offset, packet.data.obj, packet.packet_flags))
+        return result
+
+
+def iter_fragments(payload: bytes):
+    """
+    yields (data offset, fragment part, last fragment, data, packet flags) of an answer payload, stops at padding
+    """
+    offset = 0
+    len_payload = len(payload)
+    while offset + FRAGMENT_HEADER_SIZE <= len_payload:
+        data_offset, part, packet_flags, size = _FRAGMENT_HEADER.unpack_from(payload, offset)
+        offset += FRAGMENT_HEADER_SIZE
+        if not size or offset + size > len_payload:
+            return
+        yield data_offset, part & ~LAST_FRAGMENT_BIT, bool(part & LAST_FRAGMENT_BIT), \
+            payload[offset:offset + size], packet_flags
+        offset += size
@@ -0,0 +1,286 @@
+import asyncio
+import ctypes
+import errno
+import os
+import socket
+import struct
+import sys
+
+MSG_DONTWAIT = 0x40
+
+_AF_INET_BYTES = struct.pack("=H", socket.AF_INET)
+
+
+class _Iovec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+
+class _SockaddrIn(ctypes.Structure):
+    _fields_ = [("sin_family", ctypes.c_ushort), ("sin_port", ctypes.c_ubyte * 2), ("sin_addr", ctypes.c_ubyte * 4),
+                ("sin_zero", ctypes.c_ubyte * 8)]
+
+
+class _Msghdr(ctypes.Structure):
+    _fields_ = [("msg_name", ctypes.c_void_p), ("msg_namelen", ctypes.c_uint32),
+                ("msg_iov", ctypes.POINTER(_Iovec)), ("msg_iovlen", ctypes.c_size_t),
+                ("msg_control", ctypes.c_void_p), ("msg_controllen", ctypes.c_size_t), ("msg_flags", ctypes.c_int)]
+
+
+class _Mmsghdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", _Msghdr), ("msg_len", ctypes.c_uint)]
+
+
+_SOCKADDR_IN_SIZE = ctypes.sizeof(_SockaddrIn)
+
+_recvmmsg = None
+_sendmmsg = None
+if sys.platform.startswith("linux"):
+    try:
+        _libc = ctypes.CDLL(None, use_errno=True)
+        _recvmmsg = _libc.recvmmsg
+        _recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_Mmsghdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+        _recvmmsg.restype = ctypes.c_int
+        _sendmmsg = _libc.sendmmsg
+        _sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_Mmsghdr), ctypes.c_uint, ctypes.c_int]
+        _sendmmsg.restype = ctypes.c_int
+    except (OSError, AttributeError):
+        _recvmmsg = None
+        _sendmmsg = None
+
+MMSG_AVAILABLE = _recvmmsg is not None and _sendmmsg is not None
+
+_WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+
+def _raise_errno():
+    err = ctypes.get_errno()
+    raise OSError(err, os.strerror(err))
+
+
+def _ctypes_array_over(buffer: bytearray, ctype, count: int):
+    return (ctype * count).from_buffer(buffer)
+
+
+class _MmsgHeaders:
+    """
+    mmsghdr/iovec/sockaddr_in arrays backed by bytearrays, so per-message fields are plain memoryview item access
+    """
+
+    def __init__(self, batch_size: int, slot_size: int) -> None:
+        self.batch_size = batch_size
+        self.slot_size = slot_size
+        self.buffer = bytearray(batch_size * slot_size)
+        self.buffer_view = memoryview(self.buffer)
+        self.c_buffer = _ctypes_array_over(self.buffer, ctypes.c_char, len(self.buffer))
+        self.names = bytearray(batch_size * _SOCKADDR_IN_SIZE)
+        self.names_view = memoryview(self.names)
+        self.c_names = _ctypes_array_over(self.names, _SockaddrIn, batch_size)
+        self.iovecs = bytearray(batch_size * ctypes.sizeof(_Iovec))
+        self.c_iovecs = _ctypes_array_over(self.iovecs, _Iovec, batch_size)
+        self.msgs = bytearray(batch_size * ctypes.sizeof(_Mmsghdr))
+        self.c_msgs = _ctypes_array_over(self.msgs, _Mmsghdr, batch_size)
+        buffer_addr = ctypes.addressof(self.c_buffer)
+        for i in range(batch_size):
+            self.c_iovecs[i].iov_base = buffer_addr + i * slot_size
+            self.c_iovecs[i].iov_len = slot_size
+            hdr = self.c_msgs[i].msg_hdr
+            hdr.msg_name = ctypes.addressof(self.c_names[i])
+            hdr.msg_namelen = _SOCKADDR_IN_SIZE
+            hdr.msg_iov = ctypes.pointer(self.c_iovecs[i])
+            hdr.msg_iovlen = 1
+        # uint32 view of the mmsghdr array for msg_namelen/msg_len, size_t view of the iovec array for iov_len
+        self.msg_words = memoryview(self.msgs).cast("I")
+        self.msg_stride = ctypes.sizeof(_Mmsghdr) // 4
+        self.msg_len_index = _Mmsghdr.msg_len.offset // 4
+        self.namelen_index = _Msghdr.msg_namelen.offset // 4
+        self.iov_words = memoryview(self.iovecs).cast("N")
+
+
+class _MmsgReader(_MmsgHeaders):
+    def __init__(self, batch_size: int, buffer_size: int) -> None:
+        super().__init__(batch_size, buffer_size)
+        self.addr_cache = {}
+
+    def recv(self, fd: int) -> list[tuple[bytes, tuple]]:
+        n = _recvmmsg(fd, self.c_msgs, self.batch_size, MSG_DONTWAIT, None)
+        if n < 0:
+            if ctypes.get_errno() in _WOULD_BLOCK:
+                return []
+            _raise_errno()
+        result = []
+        msg_words = self.msg_words
+        names_view = self.names_view
+        buffer_view = self.buffer_view
+        addr_cache = self.addr_cache
+        slot_size = self.slot_size
+        w = self.msg_len_index
+        namelen_i = self.namelen_index
+        stride = self.msg_stride
+        name_s = 2
+        buf_s = 0
+        for _ in range(n):
+            raw_name = bytes(names_view[name_s:name_s + 6])
+            addr = addr_cache.get(raw_name)
+            if addr is None:
+                if len(addr_cache) > 4096:
+                    addr_cache.clear()
+                addr = (socket.inet_ntoa(raw_name[2:6]), (raw_name[0] << 8) | raw_name[1])
+                addr_cache[raw_name] = addr
+            result.append((bytes(buffer_view[buf_s:buf_s + msg_words[w]]), addr))
+            msg_words[namelen_i] = _SOCKADDR_IN_SIZE
+            w += stride
+            namelen_i += stride
+            name_s += _SOCKADDR_IN_SIZE
+            buf_s += slot_size
+        return result
+
+
+class _MmsgWriter(_MmsgHeaders):
+    def __init__(self, batch_size: int, slot_size: int) -> None:
+        super().__init__(batch_size, slot_size)
+        self.addr_cache = {}
+
+    def packed_addr(self, addr: tuple) -> bytes:
+        packed = self.addr_cache.get(addr)
+        if packed is None:
+            if len(self.addr_cache) > 4096:
+                self.addr_cache.clear()
+            try:
+                packed = _AF_INET_BYTES + struct.pack("!H", addr[1]) + socket.inet_aton(addr[0]) + bytes(8)
+            except (OSError, TypeError, struct.error):
+                raise ValueError("not an ipv4 address: " + repr(addr))
+            self.addr_cache[addr] = packed
+        return packed
+
+    def send(self, fd: int, msgs: list, start: int) -> int:
+        """
+        copies up to batch_size messages into the slots and sends them with one sendmmsg,
+        stops early at a message that does not fit a slot (returns -1 if that is the first one)
+        """
+        count = 0
+        end = min(len(msgs), start + self.batch_size)
+        buffer_view = self.buffer_view
+        names_view = self.names_view
+        iov_words = self.iov_words
+        slot_size = self.slot_size
+        buf_s = 0
+        name_s = 0
+        for i in range(start, end):
+            data, addr = msgs[i]
+            len_data = len(data)
+            if len_data > slot_size:
+                break
+            buffer_view[buf_s:buf_s + len_data] = data
+            iov_words[2 * count + 1] = len_data
+            names_view[name_s:name_s + _SOCKADDR_IN_SIZE] = self.packed_addr(addr)
+            count += 1
+            buf_s += slot_size
+            name_s += _SOCKADDR_IN_SIZE
+        if count == 0:
+            return -1
+        n = _sendmmsg(fd, self.c_msgs, count, MSG_DONTWAIT)
+        if n < 0:
+            if ctypes.get_errno() in _WOULD_BLOCK:
+                return 0
+            _raise_errno()
+        return n
+
+
+_writer = None
+
+
+def set_use_mmsg(enabled: bool) -> None:
+    global _writer
+    if enabled and MMSG_AVAILABLE:
+        if _writer is None:
+            _writer = _MmsgWriter(64, 4096)
+    else:
+        _writer = None
+
+
+def sendto_many(sock: socket.socket, msgs: list, start: int = 0) -> int:
+    """
+    sends msgs[start:] ((data, addr) pairs) without blocking, returns the number of datagrams that were sent.
+    """
+    len_msgs = len(msgs)
+    sent = start
+    fd = sock.fileno()
+    while sent < len_msgs:
+        n = -1
+        if _writer is not None:
+            try:
+                n = _writer.send(fd, msgs, sent)
+            except ValueError:
+                # not an ipv4 address, the plain sendto below handles it
+                pass
+            if n == 0:
+                break
+        if n < 0:
+            data, addr = msgs[sent]
+            try:
+                sock.sendto(data, addr)
+            except (BlockingIOError, InterruptedError):
+                break
+            n = 1
+        sent += n
+    return sent - start
+
+
+async def sendto_all(sock: socket.socket, msgs: list) -> None:
+    loop = asyncio.get_running_loop()
+    sent = 0
+    len_msgs = len(msgs)
+    while sent < len_msgs:
+        sent += sendto_many(sock, msgs, sent)
+        if sent < len_msgs:
+            data, addr = msgs[sent]
+            await loop.sock_sendto(sock, data, addr)
+            sent += 1
+
+
+class BatchReceiver:
+    """
+    drains every readable datagram of a non-blocking udp socket on each event-loop wakeup
+    (recvmmsg on linux, a recvfrom loop elsewhere)
+    """
+
+    def __init__(self, sock: socket.socket, batch_size: int = 32, buffer_size: int = 65575,
+                 use_mmsg: bool = False) -> None:
+        self.sock = sock
+        self.batch_size = batch_size
+        self.buffer_size = buffer_size
+        self.reader = _MmsgReader(batch_size, buffer_size) if use_mmsg and MMSG_AVAILABLE else None
+        self.waiter = None
+
+    def recv_now(self) -> list[tuple[bytes, tuple]]:
+        if self.reader is not None:
+            return self.reader.recv(self.sock.fileno())
+        result = []
+        sock = self.sock
+        buffer_size = self.buffer_size
+        for _ in range(self.batch_size):
+            try:
+                result.append(sock.recvfrom(buffer_size))
+            except (BlockingIOError, InterruptedError):
+                break
+        return result
+
+    def _on_readable(self) -> None:
+        waiter = self.waiter
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    async def recv_batch(self) -> list[tuple[bytes, tuple]]:
+        while True:
+            datagrams = self.recv_now()
+            if datagrams:
+                return datagrams
+            loop = asyncio.get_running_loop()
+            fd = self.sock.fileno()
+            self.waiter = loop.create_future()
+            loop.add_reader(fd, self._on_readable)
+            try:
+                await self.waiter
+            finally:
+                self.waiter = None
+                loop.remove_reader(fd)
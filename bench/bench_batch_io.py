@@ -0,0 +1,105 @@
+# loopback packets-per-second of the per-datagram asyncio calls vs the batch_io layer
+# usage: python bench/bench_batch_io.py [count] [size]
+
+import asyncio
+import os
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import batch_io
+from batch_io import BatchReceiver, sendto_all
+
+COUNT = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+SIZE = int(sys.argv[2]) if len(sys.argv) > 2 else 120
+
+
+def udp_socket(rcvbuf: int = 0) -> socket.socket:
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    if rcvbuf:
+        try:
+            s.setsockopt(socket.SOL_SOCKET, getattr(socket, "SO_RCVBUFFORCE", 33), rcvbuf)
+        except OSError:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+    s.bind(("127.0.0.1", 0))
+    s.setblocking(False)
+    return s
+
+
+def fill(receiver: socket.socket) -> int:
+    sender = udp_socket()
+    payload = os.urandom(SIZE)
+    addr = receiver.getsockname()
+    # loopback drops silently once the receive buffer is full, only queue what surely fits
+    fits = receiver.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF) // (SIZE + 1024)
+    sent = 0
+    for _ in range(min(COUNT, fits)):
+        try:
+            sender.sendto(payload, addr)
+            sent += 1
+        except BlockingIOError:
+            break
+    sender.close()
+    return sent
+
+
+async def recv_per_datagram(sock: socket.socket, count: int) -> None:
+    loop = asyncio.get_running_loop()
+    for _ in range(count):
+        await loop.sock_recvfrom(sock, 65575)
+
+
+async def recv_batched(sock: socket.socket, count: int, use_mmsg: bool) -> None:
+    receiver = BatchReceiver(sock, 32, 65575, use_mmsg)
+    received = 0
+    while received < count:
+        received += len(await receiver.recv_batch())
+
+
+async def send_per_datagram(sock: socket.socket, msgs: list) -> None:
+    loop = asyncio.get_running_loop()
+    for data, addr in msgs:
+        await loop.sock_sendto(sock, data, addr)
+
+
+async def bench_recv(name: str, coro_factory) -> None:
+    sock = udp_socket(64 << 20)
+    count = fill(sock)
+    t = time.perf_counter()
+    await coro_factory(sock, count)
+    elapsed = time.perf_counter() - t
+    sock.close()
+    print(f"recv {name:<22} {count / elapsed:>12,.0f} pps")
+
+
+async def bench_send(name: str, coro_factory) -> None:
+    sink = udp_socket(64 << 20)
+    sock = udp_socket()
+    payload = os.urandom(SIZE)
+    msgs = [(payload, sink.getsockname())] * COUNT
+    t = time.perf_counter()
+    await coro_factory(sock, msgs)
+    elapsed = time.perf_counter() - t
+    sock.close()
+    sink.close()
+    print(f"send {name:<22} {COUNT / elapsed:>12,.0f} pps")
+
+
+async def main():
+    print(f"{COUNT} datagrams of {SIZE} bytes, mmsg available: {batch_io.MMSG_AVAILABLE}")
+    await bench_recv("sock_recvfrom", recv_per_datagram)
+    await bench_recv("batch recvfrom loop", lambda s, c: recv_batched(s, c, False))
+    if batch_io.MMSG_AVAILABLE:
+        await bench_recv("batch recvmmsg", lambda s, c: recv_batched(s, c, True))
+
+    await bench_send("sock_sendto", send_per_datagram)
+    batch_io.set_use_mmsg(False)
+    await bench_send("batch sendto loop", sendto_all)
+    if batch_io.MMSG_AVAILABLE:
+        batch_io.set_use_mmsg(True)
+        await bench_send("batch sendmmsg", sendto_all)
+
+
+asyncio.run(main())
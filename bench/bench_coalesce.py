@@ -0,0 +1,119 @@
+# dns queries per second with and without coalescing of small datagrams for an ack heavy traffic sample,
+# the datagrams arrive at random (poisson) times and the latency budget is handled like in h_recv.
+# usage: python bench/bench_coalesce.py [sample_file]
+# sample_file: datagrams as 2 bytes big-endian length + data, without it a synthetic ack heavy sample.
+
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_compression import read_sample
+from coalesce import Coalescer, unpack_datagrams
+from data_cap import get_base32_final_queries, get_chunk_len
+from utility.codec import PAYLOAD_CODECS
+from utility.dns import QueryTemplate, encode_qname
+
+SEND_DOMAIN = b"t.example.com"
+DATA_OFFSET_WIDTH = 3
+RATES = (200, 1000, 5000)
+COALESCE_TIMES = (0.001, 0.002, 0.005)
+# coalesce_max_size in fragments of the send domain
+MAX_SIZE_FRAGMENTS = (1, 2, 4)
+
+
+def ack_heavy_sample(count: int) -> list[bytes]:
+    """
+    kcp acks (one 24 bytes segment), wireguard keepalives, quic ack packets (short header, one ack frame)
+    and some full size data packets.
+    """
+    rnd = random.Random(1)
+    sample = []
+    for _ in range(count):
+        r = rnd.random()
+        if r < 0.6:
+            sample.append(os.urandom(4) + b"\x52" + os.urandom(19))
+        elif r < 0.7:
+            sample.append(b"\x04\x00\x00\x00" + os.urandom(28))
+        elif r < 0.9:
+            sample.append(b"\x40" + os.urandom(rnd.randint(30, 45)))
+        else:
+            sample.append(os.urandom(1200))
+    return sample
+
+
+def queries(data: bytes, templates: list, codec) -> int:
+    return len(get_base32_final_queries(data, 0, 0, templates, DATA_OFFSET_WIDTH, 0, codec))
+
+
+def run(sample: list[bytes], rate: float, coalesce_time: float, max_size: int, templates: list,
+        codec) -> tuple[int, float]:
+    """
+    (queries, mean added delay of the datagrams)
+    """
+    rnd = random.Random(1)
+    coalescer = Coalescer(max_size)
+    now = 0.0
+    deadline = None
+    first_times = []  # arrival times of the waiting datagrams
+    total_queries = 0
+    total_delay = 0.0
+
+    def send(waiting, send_time):
+        nonlocal total_queries, total_delay
+        payload, coalesced = waiting
+        total_queries += queries(payload, templates, codec)
+        if coalesced and len(unpack_datagrams(payload)) != len(first_times):
+            raise AssertionError("wrong datagrams")
+        total_delay += sum(send_time - t for t in first_times)
+        first_times.clear()
+
+    for datagram in sample:
+        now += rnd.expovariate(rate)
+        if deadline is not None and now >= deadline:
+            send(coalescer.take(), deadline)
+            deadline = None
+        if not coalescer.fits(datagram):
+            if coalescer:
+                send(coalescer.take(), now)
+                deadline = None
+            total_queries += queries(datagram, templates, codec)
+            continue
+        if not coalescer:
+            deadline = now + coalesce_time
+        waiting = coalescer.add(datagram)
+        if waiting is not None:
+            send(waiting, now)
+            deadline = now + coalesce_time
+        first_times.append(now)
+    if coalescer:
+        send(coalescer.take(), deadline)
+    return total_queries, total_delay / len(sample)
+
+
+def main():
+    if len(sys.argv) > 1:
+        sample = read_sample(sys.argv[1])
+    else:
+        sample = ack_heavy_sample(20000)
+    codec = PAYLOAD_CODECS["base32"]
+    for max_domain_len in (101, 253):
+        sdeq = encode_qname(SEND_DOMAIN)
+        chunk_len = get_chunk_len(max_domain_len + 2, len(sdeq), 63, DATA_OFFSET_WIDTH)
+        templates = [(QueryTemplate(sdeq, 1, 63), chunk_len)]
+        fragment_size = int(chunk_len * codec.bits_per_char / 8)
+        plain = sum(queries(d, templates, codec) for d in sample)
+        print(f"max_domain_len {max_domain_len}, {len(sample)} datagrams: "
+              f"{plain / len(sample):.3f} queries per datagram without coalescing")
+        for fragments in MAX_SIZE_FRAGMENTS:
+            max_size = fragment_size * fragments
+            print(f"  coalesce_max_size {max_size} ({fragments} fragments)")
+            for rate in RATES:
+                line = f"    {rate:>5} datagrams/s: {plain / len(sample) * rate:6.0f} queries/s"
+                for coalesce_time in COALESCE_TIMES:
+                    total, delay = run(sample, rate, coalesce_time, max_size, templates, codec)
+                    line += f" | {coalesce_time * 1000:.0f}ms {total / len(sample) * rate:6.0f} (+{delay * 1000:.2f}ms)"
+                print(line)
+
+main()
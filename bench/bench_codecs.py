@@ -0,0 +1,48 @@
+# payload bytes per query and encode/decode speed of every payload codec
+# usage: python bench/bench_codecs.py [count]
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from data_cap import get_chunk_len
+from utility.codec import PAYLOAD_CODECS
+from utility.dns import encode_qname
+
+COUNT = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+DATA_OFFSET_WIDTH = 3
+SEND_DOMAIN = b"t.example.com"
+
+
+def bytes_per_query(codec, max_domain_len: int, max_sub_len: int) -> float:
+    chunk_len = get_chunk_len(max_domain_len + 2, len(encode_qname(SEND_DOMAIN)), max_sub_len, DATA_OFFSET_WIDTH)
+    return chunk_len * codec.bits_per_char / 8
+
+
+def speed(codec, size: int) -> tuple[float, float]:
+    data = os.urandom(size)
+    encoded = codec.encode(data)
+    if codec.decode(encoded) != data or codec.decode(encoded.upper()) != data:
+        sys.exit(f"{codec.name}: round trip failed")
+    count = max(100, COUNT * 40 // size)
+    t = time.perf_counter()
+    for _ in range(count):
+        codec.encode(data)
+    encode = time.perf_counter() - t
+    t = time.perf_counter()
+    for _ in range(count):
+        codec.decode(encoded)
+    decode = time.perf_counter() - t
+    return count * size / encode / 1e6, count * size / decode / 1e6
+
+
+print(f"payload bytes per query (send domain {SEND_DOMAIN.decode()}, max_domain_len/max_sub_len)")
+for codec in PAYLOAD_CODECS.values():
+    print(f"{codec.name:<8}" + "".join(
+        f"  {d}/{s}: {bytes_per_query(codec, d, s):6.1f}" for d, s in ((99, 63), (151, 63), (253, 63), (253, 30))))
+print("encode / decode MB/s")
+for codec in PAYLOAD_CODECS.values():
+    print(f"{codec.name:<8}" + "".join(
+        f"  {size} B: {e:6.1f} / {d:6.1f}" for size, (e, d) in ((size, speed(codec, size)) for size in (40, 200, 1200))))
@@ -0,0 +1,124 @@
+# fragments per datagram with and without compression (and with a preset dictionary) on a traffic sample
+# usage: python bench/bench_compression.py [sample_file] [dictionary_file]
+# sample_file: datagrams as 2 bytes big-endian length + data, without it a synthetic wireguard/kcp sample is used.
+# without dictionary_file a dictionary is made of the first datagrams of the sample, which are then not measured.
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from compression import Compressor, MAX_DICTIONARY_SIZE
+from data_cap import get_chunk_len
+from utility.codec import PAYLOAD_CODECS
+from utility.dns import encode_qname
+
+SEND_DOMAIN = b"t.example.com"
+DATA_OFFSET_WIDTH = 3
+
+
+def read_sample(path: str) -> list[bytes]:
+    with open(path, "rb") as f:
+        raw = f.read()
+    datagrams = []
+    i = 0
+    while i + 2 <= len(raw):
+        n = int.from_bytes(raw[i:i + 2], "big")
+        datagrams.append(raw[i + 2:i + 2 + n])
+        i += 2 + n
+    return datagrams
+
+
+def synthetic_sample(count: int) -> list[tuple[str, bytes]]:
+    """
+    wireguard: handshakes, keepalives and transport data (encrypted, only the 16 bytes header is not random),
+    kcp without encryption: acks (24 bytes segment headers) and push segments carrying encrypted (tls) data.
+    """
+    rnd = random.Random(1)
+    receiver_index = os.urandom(4)
+    counter = 0
+    conv = os.urandom(4)
+    ts = 100000
+    sn = 0
+    sample = []
+    for _ in range(count):
+        r = rnd.random()
+        if r < 0.01:
+            sample.append(("wg handshake", b"\x01\x00\x00\x00" + os.urandom(4 + 32 + 48 + 28 + 16) + bytes(16)))
+        elif r < 0.02:
+            sample.append(("wg handshake", b"\x02\x00\x00\x00" + os.urandom(4) + receiver_index
+                           + os.urandom(32 + 16 + 16) + bytes(16)))
+        elif r < 0.05:
+            counter += 1
+            sample.append(("wg keepalive", b"\x04\x00\x00\x00" + receiver_index + counter.to_bytes(8, "little")
+                           + os.urandom(16)))
+        elif r < 0.45:
+            counter += 1
+            size = rnd.choice((64, 96, 128, 640, 1280, 1360))
+            sample.append(("wg data", b"\x04\x00\x00\x00" + receiver_index + counter.to_bytes(8, "little")
+                           + os.urandom(size + 16)))
+        elif r < 0.75:
+            ts += rnd.randint(0, 20)
+            acks = []
+            for _ in range(rnd.randint(1, 8)):
+                acks.append(conv + b"\x52\x00" + (1024).to_bytes(2, "little") + ts.to_bytes(4, "little")
+                            + (sn - rnd.randint(0, 30)).to_bytes(4, "little", signed=True)
+                            + sn.to_bytes(4, "little") + bytes(4))
+            sample.append(("kcp ack", b"".join(acks)))
+        else:
+            ts += rnd.randint(0, 20)
+            sn += 1
+            size = rnd.choice((32, 200, 1100, 1300))
+            sample.append(("kcp push", conv + b"\x51\x00" + (1024).to_bytes(2, "little") + ts.to_bytes(4, "little")
+                           + sn.to_bytes(4, "little") + (sn - 5).to_bytes(4, "little", signed=True)
+                           + size.to_bytes(4, "little") + os.urandom(size)))
+    return sample
+
+
+def fragments(data: bytes, compressor: Compressor | None, codec, chunk_len: int) -> int:
+    if compressor is not None:
+        compressed = compressor.compress(data)
+        if compressed is not None:
+            data = compressed
+    return -(-len(codec.encode(data)) // chunk_len)
+
+
+def main():
+    if len(sys.argv) > 1:
+        sample = [("sample", datagram) for datagram in read_sample(sys.argv[1])]
+    else:
+        sample = synthetic_sample(20000)
+    if len(sys.argv) > 2:
+        with open(sys.argv[2], "rb") as f:
+            dictionary = f.read()
+    else:
+        dictionary = b""
+        while sample and len(dictionary) < MAX_DICTIONARY_SIZE:
+            dictionary += sample.pop(0)[1]
+
+    codec = PAYLOAD_CODECS["base32"]
+    compressors = (("raw", None), ("compressed", Compressor()), ("with dictionary", Compressor(dictionary=dictionary)))
+    for max_domain_len in (101, 253):
+        chunk_len = get_chunk_len(max_domain_len + 2, len(encode_qname(SEND_DOMAIN)), 63, DATA_OFFSET_WIDTH)
+        print(f"max_domain_len {max_domain_len} ({chunk_len} characters per fragment), fragments per datagram:")
+        kinds = sorted({kind for kind, _ in sample})
+        for kind in kinds + ["all"]:
+            datagrams = [d for k, d in sample if kind in ("all", k)]
+            line = f"  {kind:<14}{len(datagrams):>7}"
+            for name, compressor in compressors:
+                total = sum(fragments(d, compressor, codec, chunk_len) for d in datagrams)
+                line += f"  {name} {total / len(datagrams):6.3f}"
+            print(line)
+
+    for name, compressor in compressors[1:]:
+        t = time.perf_counter()
+        for _, d in sample:
+            compressor.compress(d)
+        elapsed = time.perf_counter() - t
+        print(f"{name}: {elapsed / len(sample) * 1e6:.1f} us per datagram")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+# reassembly at high packet rates: with 32768 data offsets and a fixed 13 s assembly time the sender wraps around to
+# data offsets that the other side still keeps above about 2500 packets per second, so new packets are dropped as
+# duplicates or mixed with old fragments. compares the fixed time, the adaptive time, epochs and a wider data offset.
+# the time is simulated: packets of 3 fragments, every fragment sent twice (retries 1), 5% of them lost,
+# 30 ms + 50 ms (exponential) delay, 1% of them 0.5 to 2 s late and 0.2% 3 to 8 s late (retries of a resolver), a
+# packet that is delivered again after its data offset was released is counted in "twice".
+# usage: python bench/bench_data_offsets.py [rate ...]
+
+import asyncio
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from data_handler import DataHandler, WHEEL_TICK, EPOCH_COUNT
+
+RATES = [float(rate) for rate in sys.argv[1:]] or [1000.0, 3000.0, 10000.0]  # packets per second
+DURATION = 30.0
+FRAGMENTS = 3
+TRIES = 2
+LOSS = 0.05
+# (name, data offset width, assemble_time, min_assemble_time, epoch)
+SETTINGS = (("width 3, 13 s", 3, 13.0, 13.0, False),
+            ("width 3, adaptive", 3, 13.0, 2.0, False),
+            ("width 3, adaptive, epoch", 3, 13.0, 2.0, True),
+            ("width 4, 13 s", 4, 13.0, 13.0, False))
+
+
+def arrivals(rate: float, seed: int) -> list:
+    # (arrival time, packet, fragment part)
+    rnd = random.Random(seed)
+    result = []
+    for packet in range(int(rate * DURATION)):
+        sent = packet / rate
+        for part in range(FRAGMENTS):
+            for _ in range(TRIES):
+                if rnd.random() < LOSS:
+                    continue
+                delay = 0.03 + rnd.expovariate(20)
+                late = rnd.random()
+                if late < 0.01:
+                    delay += rnd.uniform(0.5, 2.0)
+                elif late < 0.012:
+                    delay += rnd.uniform(3.0, 8.0)
+                result.append((sent + delay, packet, part))
+    result.sort()
+    return result
+
+
+def expected(packet: int) -> bytes:
+    return b"".join(packet.to_bytes(4, "big") + bytes((part,)) for part in range(FRAGMENTS))
+
+
+async def simulate(events: list, packets: int, width: int, assemble_time: float, min_assemble_time: float,
+                   epoch: bool) -> dict:
+    total = 1 << 5 * width
+    handler = DataHandler(total, assemble_time, min_assemble_time, use_epochs=epoch)
+    handler.cleaner_task.cancel()
+    next_tick = WHEEL_TICK
+    delivered = set()
+    corrupt = 0
+    twice = 0
+    for now, packet, part in events:
+        while now >= next_tick:
+            handler.tick()
+            next_tick += WHEEL_TICK
+        data = packet.to_bytes(4, "big") + bytes((part,))
+        key = packet % total
+        result = handler.new_data_event(key, part, part == FRAGMENTS - 1, data,
+                                        packet // total % EPOCH_COUNT if epoch else 0)
+        if result:
+            if result != expected(packet):
+                corrupt += 1
+            elif packet in delivered:
+                # a late retry after its data offset was released
+                twice += 1
+            else:
+                delivered.add(packet)
+    return {"delivered": len(delivered) / packets, "corrupt": corrupt, "twice": twice,
+            "collisions": handler.collisions, "conflicts": handler.conflicts, "stale": handler.stale,
+            "late": handler.late, "assemble_time": handler.assemble_time}
+
+
+async def main():
+    print(f"{'packets/s':>9} {'setting':<26} {'delivered':>9} {'corrupt':>8} {'twice':>6} {'collisions':>10} "
+          f"{'conflicts':>9} {'stale':>6} {'late':>6} {'assembly':>8}")
+    for rate in RATES:
+        events = arrivals(rate, 1)
+        packets = int(rate * DURATION)
+        for name, width, assemble_time, min_assemble_time, epoch in SETTINGS:
+            r = await simulate(events, packets, width, assemble_time, min_assemble_time, epoch)
+            print(f"{rate:9.0f} {name:<26} {r['delivered']:9.2%} {r['corrupt']:8} {r['twice']:6} "
+                  f"{r['collisions']:10} {r['conflicts']:9} {r['stale']:6} {r['late']:6} {r['assemble_time']:7.1f}s")
+
+
+asyncio.run(main())
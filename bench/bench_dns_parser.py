@@ -0,0 +1,104 @@
+# cross-checks RecvDomainIndex against handle_dns_request + the per recv domain label comparison on random
+# (valid, truncated and mutated) queries, then compares their speed for growing numbers of recv domains
+# usage: python bench/bench_dns_parser.py [fuzz_count] [count]
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utility.dns import RecvDomainIndex, handle_dns_request, label_domain, encode_qname, build_dns_query, insert_dots
+
+FUZZ_COUNT = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+COUNT = int(sys.argv[2]) if len(sys.argv) > 2 else 200000
+
+LABELS = [b"a", b"b", b"t", b"ex", b"example", b"com", b"org", b"Io", b"COM", b"x1"]
+
+
+def old_parse(all_recv_domains_labels: list, raw_data: bytes):
+    qid, qflags, all_labels, qtype, next_question = handle_dns_request(raw_data)
+    accepted_recv_domain_labels_len = 0
+    for recv_domain_labels in all_recv_domains_labels:
+        len_recv_domain_labels = len(recv_domain_labels)
+        if all_labels[-len_recv_domain_labels:] == recv_domain_labels:
+            accepted_recv_domain_labels_len = len_recv_domain_labels
+            break
+    if accepted_recv_domain_labels_len == 0:
+        raise ValueError("no accepted recv_domain_labels")
+    return qid, qflags, b"".join(all_labels[:-accepted_recv_domain_labels_len]), qtype, next_question
+
+
+def random_domain(rnd: random.Random) -> bytes:
+    return b".".join(rnd.choice(LABELS) for _ in range(rnd.randint(1, 3)))
+
+
+def random_query(rnd: random.Random, recv_domains: list[bytes]) -> bytes:
+    payload = bytes(rnd.choice(b"abcdefghijklmnopqrstuvwxyzABCXYZ234567") for _ in range(rnd.randint(0, 200)))
+    suffix = rnd.choice(recv_domains) if rnd.random() < 0.8 else random_domain(rnd)
+    if rnd.random() < 0.3:
+        suffix = suffix.upper()
+    query = build_dns_query(insert_dots(payload, rnd.randint(1, 63)) + encode_qname(suffix), rnd.randrange(65536),
+                            rnd.choice((1, 16, 28)))
+    r = rnd.random()
+    if r < 0.1:
+        query = query[:rnd.randrange(len(query))]
+    elif r < 0.3:
+        query = bytearray(query)
+        for _ in range(rnd.randint(1, 3)):
+            query[rnd.randrange(len(query))] = rnd.randrange(256)
+        query = bytes(query)
+    elif r < 0.35:
+        query += os.urandom(rnd.randint(1, 20))
+    return query
+
+
+def outcome(parse, *args):
+    try:
+        qid, qflags, payload, qtype, next_question = parse(*args)
+    except Exception:
+        return None
+    return qid, qflags, bytes(payload).lower(), qtype, next_question
+
+
+def fuzz() -> None:
+    rnd = random.Random(7)
+    checked = 0
+    accepted = 0
+    while checked < FUZZ_COUNT:
+        recv_domains = [random_domain(rnd) for _ in range(rnd.randint(1, 4))]
+        index = RecvDomainIndex(recv_domains)
+        all_recv_domains_labels = [label_domain(d.lower()) for d in recv_domains]
+        for _ in range(200):
+            query = random_query(rnd, recv_domains)
+            old = outcome(old_parse, all_recv_domains_labels, query)
+            new = outcome(index.handle_dns_request, query)
+            if old != new:
+                sys.exit(f"mismatch: {recv_domains} {query!r}\nold: {old}\nnew: {new}")
+            accepted += old is not None
+            checked += 1
+    print(f"fuzz: {checked} queries, {accepted} accepted, identical results")
+
+
+def bench() -> None:
+    payload = os.urandom(120).hex()[:200].encode()
+    for recv_domains_count in (1, 10, 100):
+        recv_domains = [f"r{i}.example.com".encode() for i in range(recv_domains_count)]
+        # the worst case of the old parser: the query is for the last recv domain
+        query = build_dns_query(insert_dots(payload, 63) + encode_qname(recv_domains[-1]), 1, 1)
+        all_recv_domains_labels = [label_domain(d) for d in recv_domains]
+        index = RecvDomainIndex(recv_domains)
+        t = time.perf_counter()
+        for _ in range(COUNT):
+            old_parse(all_recv_domains_labels, query)
+        old = time.perf_counter() - t
+        t = time.perf_counter()
+        for _ in range(COUNT):
+            index.handle_dns_request(query)
+        new = time.perf_counter() - t
+        print(f"{recv_domains_count:>4} recv domains: old {COUNT / old:>10,.0f} q/s   new {COUNT / new:>10,.0f} q/s")
+
+
+fuzz()
+bench()
@@ -0,0 +1,73 @@
+# delivered packets and sent bytes per delivered packet of retries and of fec, when every query is lost with the
+# same probability. the queries are built, parsed and reassembled the same way as in main.py.
+# usage: python bench/bench_fec.py [packets] [max_domain_len]
+
+import asyncio
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from data_cap import get_base32_final_queries, get_fec_final_queries, get_fec_shard_size, get_chunk_len, \
+    get_chunk_data
+from data_handler import DataHandler
+from utility.codec import PAYLOAD_CODECS
+from utility.dns import QueryTemplate, RecvDomainIndex, encode_qname
+
+PACKETS = int(sys.argv[1]) if len(sys.argv) > 1 else 3000
+MAX_DOMAIN_LEN = int(sys.argv[2]) if len(sys.argv) > 2 else 101
+SEND_DOMAIN = b"t.example.com"
+DATA_OFFSET_WIDTH = 3
+TOTAL_DATA_OFFSET = 1 << 5 * DATA_OFFSET_WIDTH
+LOSS_RATES = (0.01, 0.05, 0.1, 0.2)
+# (name, tries, fec redundancy)
+SCHEMES = (("no retry", 1, 0), ("1 retry", 2, 0), ("2 retries", 3, 0), ("fec 0.25", 1, 0.25), ("fec 0.5", 1, 0.5),
+           ("fec 1.0", 1, 1.0), ("fec 0.5 + 1 retry", 2, 0.5))
+
+
+def run(packets: list[bytes], loss: float, tries: int, redundancy: float, rnd: random.Random) -> tuple[int, int]:
+    codec = PAYLOAD_CODECS["base32"]
+    sdeq = encode_qname(SEND_DOMAIN)
+    chunk_len = get_chunk_len(MAX_DOMAIN_LEN + 2, len(sdeq), 63, DATA_OFFSET_WIDTH)
+    templates = [(QueryTemplate(sdeq, 1, 63), chunk_len)]
+    shard_size = get_fec_shard_size(chunk_len, codec)
+    index = RecvDomainIndex([SEND_DOMAIN])
+    handler = DataHandler(TOTAL_DATA_OFFSET, 13.0)
+    delivered = 0
+    sent_bytes = 0
+    for data_offset, packet in enumerate(packets):
+        if redundancy:
+            queries = get_fec_final_queries(packet, data_offset, 0, templates, DATA_OFFSET_WIDTH, 0, shard_size,
+                                            redundancy, codec)
+        else:
+            queries = get_base32_final_queries(packet, data_offset, 0, templates, DATA_OFFSET_WIDTH, 0, codec)
+        for _ in range(tries):
+            for query in queries:
+                sent_bytes += len(query)
+                if rnd.random() < loss:
+                    continue
+                offset, part, last, chunk, flags = get_chunk_data(index.handle_dns_request(bytes(query))[2],
+                                                                  DATA_OFFSET_WIDTH)
+                data = handler.new_fragment_event(offset, part, last, bytes(chunk), flags, codec, None)
+                if data is not None:
+                    if data != packet:
+                        raise AssertionError("wrong packet")
+                    delivered += 1
+    handler.cleaner_task.cancel()
+    return delivered, sent_bytes
+
+
+async def main():
+    rnd = random.Random(1)
+    packets = [os.urandom(rnd.choice((60, 150, 600, 1200, 1300))) for _ in range(PACKETS)]
+    print(f"{PACKETS} packets of 60-1300 bytes, max_domain_len {MAX_DOMAIN_LEN}")
+    for loss in LOSS_RATES:
+        print(f"query loss {loss:.0%}:")
+        for name, tries, redundancy in SCHEMES:
+            delivered, sent_bytes = run(packets, loss, tries, redundancy, rnd)
+            print(f"  {name:<18} delivered {delivered / len(packets):7.2%}  "
+                  f"sent bytes per delivered packet {sent_bytes / max(delivered, 1):8.0f}")
+
+
+asyncio.run(main())
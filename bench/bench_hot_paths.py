@@ -0,0 +1,184 @@
+# per packet cost of the hot path functions for 40 bytes acks and 1200 bytes quic packets at several
+# max_domain_len/max_sub_len, and of the reassembly with in order, reordered and duplicate fragments.
+# every case runs for about --time seconds per repeat, the best repeat counts (like timeit).
+# usage: python bench/bench_hot_paths.py [--save results.json] [--compare baseline.json] [--filter text]
+# for example: python bench/bench_hot_paths.py --save bench/baseline.json, change something, then
+# python bench/bench_hot_paths.py --compare bench/baseline.json (exits with 1 if a case got slower than --threshold)
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from data_cap import get_base32_final_domains, get_base32_final_queries, get_chunk_len, get_chunk_data
+from data_handler import DataHandler
+from utility.base32 import b32decode_nopad, b32encode_nopad_lower
+from utility.dns import encode_qname, insert_dots, build_dns_query, handle_dns_request, QueryTemplate, \
+    RecvDomainIndex
+
+SEND_DOMAIN = b"t.example.com"
+DATA_OFFSET_WIDTH = 3
+TOTAL_DATA_OFFSET = 1 << 5 * DATA_OFFSET_WIDTH
+SIZES = (40, 1200)
+# (max_domain_len, max_sub_len)
+DOMAIN_LIMITS = ((101, 63), (253, 63), (253, 32))
+
+
+def measure(func, seconds: float, repeats: int) -> float:
+    """
+    seconds per call of func(), the best of repeats
+    """
+    loops = 1
+    while True:
+        t = time.perf_counter()
+        for _ in range(loops):
+            func()
+        elapsed = time.perf_counter() - t
+        if elapsed >= seconds / 4:
+            break
+        loops *= 2
+    loops = max(1, int(loops * seconds / max(elapsed, 1e-9)))
+    best = float("inf")
+    for _ in range(repeats):
+        t = time.perf_counter()
+        for _ in range(loops):
+            func()
+        best = min(best, (time.perf_counter() - t) / loops)
+    return best
+
+
+def reassembly_case(handler: DataHandler, fragments: list, order: str):
+    """
+    new_data_event over the fragments of one packet, every call uses the next data offset
+    """
+    keys = iter(range(1 << 62))
+    mpp_list = handler.mpp_list
+    wheel = handler.wheel
+    if order == "reordered":
+        # the odd fragments first, so most of them wait in pending
+        fragments = fragments[1::2] + fragments[::2]
+    elif order == "duplicate":
+        fragments = [f for f in fragments for _ in range(2)]
+
+    def run():
+        key = next(keys) % TOTAL_DATA_OFFSET
+        mpp_list[key] = None
+        if len(wheel[0]) > 100000:
+            for slot in wheel:
+                slot.clear()
+        for fragment_part, last_fragment, chunk in fragments:
+            handler.new_data_event(key, fragment_part, last_fragment, chunk)
+    return run
+
+
+def cases() -> list:
+    result = []
+    rnd = random.Random(1)
+    sdeq = encode_qname(SEND_DOMAIN)
+    index = RecvDomainIndex([SEND_DOMAIN])
+    handler = DataHandler(TOTAL_DATA_OFFSET, 13.0)
+    for max_domain_len, max_sub_len in DOMAIN_LIMITS:
+        chunk_len = get_chunk_len(max_domain_len + 2, len(sdeq), max_sub_len, DATA_OFFSET_WIDTH)
+        result.append((f"get_chunk_len {max_domain_len}/{max_sub_len}",
+                       lambda m=max_domain_len, s=max_sub_len:
+                       get_chunk_len(m + 2, len(sdeq), s, DATA_OFFSET_WIDTH)))
+        domains_list = [(sdeq, chunk_len)]
+        templates = [(QueryTemplate(sdeq, 1, max_sub_len), chunk_len)]
+        for size in SIZES:
+            data = rnd.randbytes(size)
+            limits = f"{size}B {max_domain_len}/{max_sub_len}"
+            result.append((f"get_base32_final_domains {limits}",
+                           lambda d=data, dl=domains_list, s=max_sub_len, m=max_domain_len:
+                           get_base32_final_domains(d, 1234, 0, dl, s, DATA_OFFSET_WIDTH, m + 2)))
+            result.append((f"get_base32_final_queries {limits}",
+                           lambda d=data, t=templates: get_base32_final_queries(d, 1234, 0, t, DATA_OFFSET_WIDTH, 0)))
+            domains = get_base32_final_domains(data, 1234, 0, domains_list, max_sub_len, DATA_OFFSET_WIDTH,
+                                               max_domain_len + 2)
+            queries = [build_dns_query(domain, i, 1) for i, domain in enumerate(domains)]
+            result.append((f"build_dns_query x{len(domains)} {limits}",
+                           lambda ds=domains: [build_dns_query(domain, 1, 1) for domain in ds]))
+            result.append((f"handle_dns_request x{len(queries)} {limits}",
+                           lambda qs=queries: [handle_dns_request(q) for q in qs]))
+            result.append((f"RecvDomainIndex.handle_dns_request x{len(queries)} {limits}",
+                           lambda qs=queries: [index.handle_dns_request(q) for q in qs]))
+            payloads = [bytes(index.handle_dns_request(q)[2]) for q in queries]
+            result.append((f"insert_dots x{len(payloads)} {limits}",
+                           lambda ps=payloads, s=max_sub_len: [insert_dots(p, s) for p in ps]))
+            result.append((f"get_chunk_data x{len(payloads)} {limits}",
+                           lambda ps=payloads: [get_chunk_data(p, DATA_OFFSET_WIDTH) for p in ps]))
+            fragments = []
+            for payload in payloads:
+                _, fragment_part, last_fragment, chunk, _ = get_chunk_data(payload, DATA_OFFSET_WIDTH)
+                fragments.append((fragment_part, last_fragment, chunk))
+            for order in ("in order", "reordered", "duplicate"):
+                if order == "reordered" and len(fragments) == 1:
+                    continue
+                result.append((f"new_data_event {order} x{len(fragments)} {limits}",
+                               reassembly_case(handler, fragments, order)))
+    for size in SIZES:
+        data = rnd.randbytes(size)
+        encoded = b32encode_nopad_lower(data)
+        result.append((f"b32encode_nopad_lower {size}B", lambda d=data: b32encode_nopad_lower(d)))
+        result.append((f"b32decode_nopad {size}B", lambda e=encoded: b32decode_nopad(e)))
+    return result
+
+
+async def run(opts) -> dict:
+    results = {}
+    for name, func in cases():
+        if opts.filter and opts.filter not in name:
+            continue
+        seconds = measure(func, opts.time, opts.repeats)
+        results[name] = seconds
+        print(f"{name:<62} {seconds * 1e6:9.2f} us")
+    return results
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> bool:
+    slower = False
+    print(f"\ncompared to the baseline ({baseline.get('python', '?')}, {baseline.get('machine', '?')}):")
+    for name, seconds in results.items():
+        base = baseline["results"].get(name)
+        if base is None:
+            print(f"{name:<62} new")
+            continue
+        change = seconds / base - 1
+        mark = ""
+        if change > threshold:
+            mark = "  SLOWER"
+            slower = True
+        elif change < -threshold:
+            mark = "  faster"
+        print(f"{name:<62} {base * 1e6:9.2f} -> {seconds * 1e6:9.2f} us {change:+7.1%}{mark}")
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description="microbenchmarks of the per packet functions")
+    parser.add_argument("--time", type=float, default=0.2, help="seconds per repeat of each case")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--filter", default="", help="only the cases whose name contains this")
+    parser.add_argument("--save", default="", help="write the results as json to this file")
+    parser.add_argument("--compare", default="", help="compare with the results in this json file")
+    parser.add_argument("--threshold", type=float, default=0.1, help="a change above this counts (0.1: 10%%)")
+    opts = parser.parse_args()
+
+    results = asyncio.run(run(opts))
+    if opts.save:
+        with open(opts.save, "w") as f:
+            json.dump({"python": platform.python_version(), "machine": platform.machine(), "time": time.time(),
+                       "results": results}, f, indent=1)
+    if opts.compare:
+        with open(opts.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, opts.threshold):
+            sys.exit(1)
+
+
+main()
@@ -0,0 +1,412 @@
+# end-to-end benchmark on one machine: two tunnels (a and b) with stand-in resolvers between them, a traffic generator
+# sends timestamped datagrams to the h_in_address of a, b delivers them to a sink (its h_out_address).
+# reports goodput, packet delivery ratio, one-way latency percentiles and the cpu time of each tunnel.
+# the stand-in resolvers listen on port 53 of 127.0.1.x / 127.0.2.x (linux, needs root or CAP_NET_BIND_SERVICE),
+# forward the queries (with a new query id, like a real resolver) to the receive_port of the other tunnel and
+# can simulate a rate limit, loss, reordering, duplication, qname/label length and question count caps and delay.
+# like most recursive resolvers they send their own EDNS0 udp size upstream (--upstream-edns) and truncate udp answers
+# that are bigger than what the querying tunnel advertised (512 bytes without EDNS0).
+# with --transport tcp or tls the resolvers of both tunnels are used over tcp/tls (like the udp ones they forward the
+# queries over udp), for comparing it with the udp socket pool.
+# with --probe no traffic is sent, probe.py tests the resolvers of a instead (what it finds should match the caps).
+# usage: python bench/bench_loopback.py --help
+# for example: python bench/bench_loopback.py --rate 500 --loss 0.05 --delay 0.02 --jitter 0.01 --config '{"retries": 0}'
+# or: python bench/bench_loopback.py --probe --max-qname 120 --max-label 40 --max-questions 2 --qps 300
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import ssl
+import subprocess
+import sys
+import tempfile
+import time
+from struct import pack
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PACKAGE_DIR)
+
+from dns_stream import frame, unframe
+from probe import probe_resolvers
+from utility.dns import QTYPE_OPT, get_edns_udp_size, skip_name
+
+A_RECEIVE_PORT = 15301
+B_RECEIVE_PORT = 15302
+A_H_IN = ("127.0.0.1", 16000)
+B_H_IN = ("127.0.0.1", 16001)
+SINK = ("127.0.0.1", 17000)
+STARTUP_TIME = 1.5
+DRAIN_TIME = 2.0
+# sequence number, send time (ns)
+HEADER_SIZE = 12
+
+
+class StandInResolver(asyncio.DatagramProtocol):
+    """
+    a recursive resolver as the tunnel sees it: every query goes to the other tunnel with a new query id and the
+    answer comes back with the original one. drops what is over the rate limit or lost, answers SERVFAIL to a too long
+    qname or label and FORMERR to too many questions, delays both ways by delay + random jitter (so queries can be
+    reordered) and duplicates some queries. the upstream queries carry the EDNS0 udp size of the resolver instead of
+    the one of the query, and a udp answer over the size the query advertised comes back truncated (TC, no answers).
+    """
+
+    def __init__(self, upstream_addr: tuple, opts, rnd: random.Random, stats: dict) -> None:
+        self.upstream_addr = upstream_addr
+        self.opts = opts
+        self.rnd = rnd
+        self.stats = stats
+        self.transport = None
+        self.upstream = None
+        self.pending = {}  # new query id: (reply function, original query id, largest answer, end of the questions)
+        self.next_id = rnd.randint(0, 65535)
+        self.tokens = float(opts.qps_burst)
+        self.last = 0.0
+
+    def connection_made(self, transport) -> None:
+        self.transport = transport
+
+    def delay(self) -> float:
+        return self.opts.delay + self.rnd.random() * self.opts.jitter
+
+    def datagram_received(self, data: bytes, addr) -> None:
+        self.on_query(data, lambda reply: self.transport.sendto(reply, addr), True)
+
+    def on_query(self, data: bytes, reply, udp: bool) -> None:
+        stats = self.stats
+        stats["queries"] += 1
+        loop = asyncio.get_running_loop()
+        if self.opts.qps:
+            now = loop.time()
+            self.tokens = min(self.opts.qps_burst, self.tokens + (now - self.last) * self.opts.qps)
+            self.last = now
+            if self.tokens < 1.0:
+                stats["rate_limited"] += 1
+                return
+            self.tokens -= 1.0
+        if len(data) < 12:
+            return
+        try:
+            qname_len = skip_name(data, 12) - 12
+            next_question = questions_end(data)
+            max_answer = max(512, get_edns_udp_size(data, next_question)) if udp else 65535
+        except Exception:
+            return
+        if self.opts.max_qname and qname_len > self.opts.max_qname + 2 or self.opts.max_label and max_label_len(
+                data) > self.opts.max_label:
+            stats["qname_too_long"] += 1
+            self.reply_error(data, reply, 2)
+            return
+        if self.opts.max_questions and int.from_bytes(data[4:6], "big") > self.opts.max_questions:
+            stats["too_many_questions"] += 1
+            self.reply_error(data, reply, 1)
+            return
+        if self.rnd.random() < self.opts.loss:
+            stats["lost"] += 1
+            return
+        copies = 2 if self.rnd.random() < self.opts.duplicate else 1
+        stats["duplicated"] += copies - 1
+        for _ in range(copies):
+            loop.call_later(self.delay(), self.forward, data, reply, max_answer, next_question)
+
+    def reply_error(self, data: bytes, reply, rcode: int) -> None:
+        reply(data[:2] + bytes(((data[2] & 0x79) | 0x80, 0x80 | rcode)) + data[4:])
+
+    def forward(self, data: bytes, reply, max_answer: int, next_question: int) -> None:
+        new_id = self.next_id
+        self.next_id = (new_id + 1) & 0xFFFF
+        self.pending[new_id] = (reply, data[:2], max_answer, next_question)
+        if self.opts.upstream_edns:
+            # the questions with the OPT record of the resolver, without the additional records of the query
+            data = b"".join((data[2:10], b"\x00\x01", data[12:next_question],
+                             pack("!BHHIH", 0, QTYPE_OPT, self.opts.upstream_edns, 0, 0)))
+        else:
+            data = data[2:]
+        self.upstream.sendto(new_id.to_bytes(2, "big") + data)
+
+    def on_answer(self, data: bytes) -> None:
+        if len(data) < 12:
+            return
+        pending = self.pending.pop(int.from_bytes(data[:2], "big"), None)
+        if pending is None:
+            return
+        if self.rnd.random() < self.opts.loss:
+            self.stats["lost"] += 1
+            return
+        reply, qid, max_answer, next_question = pending
+        if len(data) > max_answer:
+            self.stats["truncated"] += 1
+            data = b"".join((data[:2], bytes((data[2] | 0x02, data[3])), data[4:6], bytes(6), data[12:next_question]))
+        asyncio.get_running_loop().call_later(self.delay(), reply, qid + data[2:])
+
+
+class _StandInStream(asyncio.Protocol):
+    # a tcp/tls connection to a stand-in resolver
+    def __init__(self, resolver: StandInResolver) -> None:
+        self.resolver = resolver
+        self.transport = None
+        self.buffer = bytearray()
+
+    def connection_made(self, transport) -> None:
+        self.transport = transport
+        self.resolver.stats["connections"] += 1
+
+    def data_received(self, data: bytes) -> None:
+        self.buffer += data
+        for query in unframe(self.buffer):
+            self.resolver.on_query(query, self.reply, False)
+
+    def reply(self, data: bytes) -> None:
+        if not self.transport.is_closing():
+            self.transport.write(frame(data))
+
+
+def questions_end(data: bytes) -> int:
+    offset = 12
+    for _ in range(int.from_bytes(data[4:6], "big")):
+        offset = skip_name(data, offset) + 4
+    if offset > len(data):
+        raise ValueError
+    return offset
+
+
+def max_label_len(data: bytes) -> int:
+    # the longest label of the first qname
+    offset = 12
+    longest = 0
+    while offset < len(data) and data[offset]:
+        longest = max(longest, data[offset])
+        offset += data[offset] + 1
+    return longest
+
+
+class _Upstream(asyncio.DatagramProtocol):
+    def __init__(self, resolver: StandInResolver) -> None:
+        self.resolver = resolver
+
+    def datagram_received(self, data: bytes, addr) -> None:
+        self.resolver.on_answer(data)
+
+
+class Sink(asyncio.DatagramProtocol):
+    def __init__(self) -> None:
+        self.latencies = []
+        self.received = set()
+        self.bytes = 0
+        self.duplicates = 0
+
+    def datagram_received(self, data: bytes, addr) -> None:
+        now = time.perf_counter_ns()
+        if len(data) < HEADER_SIZE:
+            return
+        seq = int.from_bytes(data[:4], "big")
+        if seq in self.received:
+            self.duplicates += 1
+            return
+        self.received.add(seq)
+        self.bytes += len(data)
+        self.latencies.append((now - int.from_bytes(data[4:12], "big")) / 1e6)
+
+
+def cpu_seconds(pid: int) -> float:
+    """
+    user + system time of the process and its children (the --workers processes), from /proc
+    """
+    total = 0.0
+    pids = [pid]
+    while pids:
+        p = pids.pop()
+        try:
+            with open(f"/proc/{p}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            total += (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+            with open(f"/proc/{p}/task/{p}/children") as f:
+                pids.extend(int(child) for child in f.read().split())
+        except OSError:
+            pass
+    return total
+
+
+def self_signed_context(work_dir: str) -> ssl.SSLContext:
+    cert = os.path.join(work_dir, "cert.pem")
+    key = os.path.join(work_dir, "key.pem")
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-keyout", key, "-out", cert, "-days",
+                    "1", "-subj", "/CN=bench"], check=True, capture_output=True)
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(cert, key)
+    return context
+
+
+def tunnel_config(receive_port: int, h_in: tuple, h_out: str, dns_ips: list, send_domain: str, recv_domain: str,
+                  extra: dict) -> dict:
+    with open(os.path.join(PACKAGE_DIR, "config.json")) as f:
+        config = json.load(f)
+    config.update({"dns_ips": dns_ips, "send_interface_ip": "127.0.0.1", "receive_interface_ip": "127.0.0.1",
+                   "receive_port": receive_port, "send_domains": [send_domain], "recv_domains": [recv_domain],
+                   "h_in_address": f"{h_in[0]}:{h_in[1]}", "h_out_address": h_out, "send_sock_numbers": 8})
+    config.update(extra)
+    return config
+
+
+def start_tunnel(work_dir: str, name: str, config: dict, workers: int, log) -> subprocess.Popen:
+    # main.py reads config.json next to itself, so every tunnel runs from its own copy
+    tunnel_dir = os.path.join(work_dir, name)
+    shutil.copytree(PACKAGE_DIR, tunnel_dir, ignore=shutil.ignore_patterns(".git", "__pycache__", "bench"))
+    with open(os.path.join(tunnel_dir, "config.json"), "w") as f:
+        json.dump(config, f)
+    return subprocess.Popen([sys.executable, os.path.join(tunnel_dir, "main.py"), "--workers", str(workers)],
+                            stdout=log, stderr=subprocess.STDOUT)
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+async def run(opts) -> dict:
+    loop = asyncio.get_running_loop()
+    rnd = random.Random(opts.seed)
+    resolver_stats = {"queries": 0, "rate_limited": 0, "qname_too_long": 0, "too_many_questions": 0, "lost": 0,
+                      "duplicated": 0, "truncated": 0, "connections": 0}
+    work_dir = tempfile.mkdtemp(prefix="qq-bench-")
+    ssl_context = self_signed_context(work_dir) if opts.transport == "tls" else None
+    a_resolvers = [f"127.0.1.{2 + i}" for i in range(opts.resolvers)]
+    b_resolvers = [f"127.0.2.{2 + i}" for i in range(opts.resolvers)]
+    # closed at the end, so bench_workers.py can run this again in the same process
+    endpoints = []
+    for ips, upstream_port in ((a_resolvers, B_RECEIVE_PORT), (b_resolvers, A_RECEIVE_PORT)):
+        for ip in ips:
+            resolver = StandInResolver(("127.0.0.1", upstream_port), opts, rnd, resolver_stats)
+            endpoints.append((await loop.create_datagram_endpoint(lambda: resolver, local_addr=(ip, 53)))[0])
+            resolver.upstream, _ = await loop.create_datagram_endpoint(lambda: _Upstream(resolver),
+                                                                       remote_addr=("127.0.0.1", upstream_port))
+            endpoints.append(resolver.upstream)
+            if opts.transport != "udp":
+                endpoints.append(await loop.create_server(lambda r=resolver: _StandInStream(r), ip,
+                                                          853 if ssl_context else 53, ssl=ssl_context))
+    sink_transport, sink = await loop.create_datagram_endpoint(Sink, local_addr=SINK)
+    endpoints.append(sink_transport)
+
+    extra = json.loads(opts.config)
+    config_a = tunnel_config(A_RECEIVE_PORT, A_H_IN, "", a_resolvers, "t.b.bench", "t.a.bench", extra)
+    config_b = tunnel_config(B_RECEIVE_PORT, B_H_IN, f"{SINK[0]}:{SINK[1]}", b_resolvers, "t.a.bench",
+                             "t.b.bench", extra)
+    config_a.update(json.loads(opts.config_a))
+    config_b.update(json.loads(opts.config_b))
+    if opts.transport != "udp":
+        for config in (config_a, config_b):
+            profiles = config.setdefault("resolver_profiles", {})
+            for ip in config["dns_ips"]:
+                profiles.setdefault(ip, {}).setdefault("transport", opts.transport)
+                profiles[ip].setdefault("tls_verify", False)
+    procs = []
+    try:
+        with open(os.path.join(work_dir, "a.log"), "w") as log_a, open(os.path.join(work_dir, "b.log"), "w") as log_b:
+            procs.append(start_tunnel(work_dir, "a", config_a, opts.workers, log_a))
+            procs.append(start_tunnel(work_dir, "b", config_b, opts.workers, log_b))
+            await asyncio.sleep(STARTUP_TIME)
+            for p in procs:
+                if p.poll() is not None:
+                    raise RuntimeError(f"a tunnel exited, see the logs in {work_dir}")
+            if opts.probe:
+                return {"profiles": await probe_resolvers(config_a, a_resolvers), "resolvers": resolver_stats}
+            cpu_start = [cpu_seconds(p.pid) for p in procs]
+
+            sender, _ = await loop.create_datagram_endpoint(asyncio.DatagramProtocol, remote_addr=A_H_IN)
+            sizes = [int(size) for size in opts.sizes.split(",")]
+            sent = 0
+            sent_bytes = 0
+            start = time.perf_counter()
+            interval = 1 / opts.rate
+            while True:
+                elapsed = time.perf_counter() - start
+                if elapsed >= opts.duration:
+                    break
+                # catch up after a late wakeup, so the offered rate stays the same
+                while sent < elapsed * opts.rate + 1:
+                    size = max(rnd.choice(sizes), HEADER_SIZE)
+                    datagram = sent.to_bytes(4, "big") + time.perf_counter_ns().to_bytes(8, "big") + os.urandom(
+                        size - HEADER_SIZE)
+                    sender.sendto(datagram)
+                    sent += 1
+                    sent_bytes += size
+                await asyncio.sleep(interval)
+            send_time = time.perf_counter() - start
+            await asyncio.sleep(DRAIN_TIME)
+            cpu = [cpu_seconds(p.pid) - c for p, c in zip(procs, cpu_start)]
+    finally:
+        for p in procs:
+            p.terminate()
+        for p in procs:
+            p.wait()
+        if opts.keep:
+            print("logs and tunnel copies:", work_dir)
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        for endpoint in endpoints:
+            endpoint.close()
+
+    latencies = sorted(sink.latencies)
+    wall = send_time + DRAIN_TIME
+    return {
+        "sent": sent,
+        "sent_bytes": sent_bytes,
+        "offered_kbps": round(sent_bytes * 8 / send_time / 1000, 1),
+        "delivered": len(sink.received),
+        "delivery_ratio": round(len(sink.received) / sent, 4) if sent else 0.0,
+        "duplicates": sink.duplicates,
+        "goodput_kbps": round(sink.bytes * 8 / send_time / 1000, 1),
+        "latency_ms": {"p50": round(percentile(latencies, 0.5), 2), "p90": round(percentile(latencies, 0.9), 2),
+                       "p99": round(percentile(latencies, 0.99), 2),
+                       "max": round(latencies[-1], 2) if latencies else 0.0},
+        "cpu_percent": {"a": round(cpu[0] / wall * 100, 1), "b": round(cpu[1] / wall * 100, 1)},
+        "resolvers": resolver_stats,
+    }
+
+
+def make_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="loopback end-to-end benchmark of two tunnels")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of traffic")
+    parser.add_argument("--rate", type=float, default=200.0, help="datagrams per second sent to a")
+    parser.add_argument("--sizes", default="40,100,500,1200", help="datagram sizes, one is picked at random")
+    parser.add_argument("--workers", type=int, default=1, help="--workers of each tunnel")
+    parser.add_argument("--resolvers", type=int, default=1, help="stand-in resolvers per direction")
+    parser.add_argument("--qps", type=float, default=0.0, help="rate limit of each resolver in queries/s (0: none)")
+    parser.add_argument("--qps-burst", type=float, default=20.0, help="burst of the rate limit")
+    parser.add_argument("--loss", type=float, default=0.0, help="loss probability of each query and each answer")
+    parser.add_argument("--duplicate", type=float, default=0.0, help="probability that a query is forwarded twice")
+    parser.add_argument("--delay", type=float, default=0.0, help="seconds added to each query and each answer")
+    parser.add_argument("--jitter", type=float, default=0.0, help="random extra delay up to this, reorders queries")
+    parser.add_argument("--max-qname", type=int, default=0, help="SERVFAIL for longer qnames (0: no cap)")
+    parser.add_argument("--max-label", type=int, default=0, help="SERVFAIL for qnames with longer labels (0: no cap)")
+    parser.add_argument("--max-questions", type=int, default=0, help="FORMERR for more questions (0: no cap)")
+    parser.add_argument("--upstream-edns", type=int, default=1232,
+                        help="EDNS0 udp size the resolvers send upstream (0: forward the queries as they are)")
+    parser.add_argument("--transport", choices=("udp", "tcp", "tls"), default="udp",
+                        help="how the tunnels send the queries to the resolvers")
+    parser.add_argument("--probe", action="store_true", help="run probe.py against the resolvers of a, no traffic")
+    parser.add_argument("--config", default="{}", help="json that is merged into the config of both tunnels")
+    parser.add_argument("--config-a", default="{}", help="json that is merged into the config of a")
+    parser.add_argument("--config-b", default="{}", help="json that is merged into the config of b")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", default="", help="also write the results to this file")
+    parser.add_argument("--keep", action="store_true", help="keep the logs and tunnel copies")
+    return parser
+
+
+def main():
+    opts = make_parser().parse_args()
+
+    result = asyncio.run(run(opts))
+    result["options"] = vars(opts)
+    print(json.dumps(result, indent=1))
+    if opts.json:
+        with open(opts.json, "w") as f:
+            json.dump(result, f, indent=1)
+
+
+if __name__ == "__main__":
+    main()
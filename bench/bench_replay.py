@@ -0,0 +1,213 @@
+# replays a capture (capture_file in the config) without sockets: the h side datagrams through the encode path
+# (compression, fragmenting into queries) and/or the DNS-Queries through the decode path (parsing, fragment headers,
+# reassembly, decoding), with the settings of a config file (the config of the side that made the capture).
+# the reassembly clock follows the capture times, so the result is the same at any speed: --speed 0 (default) runs
+# as fast as possible, 1 at the original timing, 2 twice as fast.
+# prints the time per record and what came out, for profiling: python -m cProfile -s cumtime bench/bench_replay.py ...
+# usage: python bench/bench_replay.py capture.bin [--config config.json] [--mode encode|decode|both] [--speed 0]
+# [--repeats 3] [--json results.json] [--export-sample sample.bin]
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PACKAGE_DIR)
+
+from capture import read_capture, H_DATAGRAM, WAN_QUERY
+from compression import Compressor, load_dictionary
+from data_cap import get_base32_final_queries, get_chunk_len, get_chunk_data, get_fec_shard_size, \
+    get_fec_final_queries, PACKET_COMPRESSED
+from data_handler import DataHandler, WHEEL_TICK
+from utility.codec import get_payload_codec
+from utility.dns import encode_qname, QueryTemplate, RecvDomainIndex, query_edns_udp_size
+
+
+class Settings:
+    # the parts of the config that the encode and decode paths use
+    def __init__(self, config: dict) -> None:
+        self.codec = get_payload_codec(config.get("payload_codec", "base32"))
+        self.compression = config.get("compression", False)
+        self.compressor = Compressor(dictionary=load_dictionary(config.get("compression_dictionary", "")))
+        self.fec_redundancy = config.get("fec_redundancy", 0)
+        width = config.get("data_offset_width", 3)
+        self.total_data_offset = 1 << 5 * width
+        self.data_offset_chars = width + 1 if config.get("data_offset_epoch", False) else width
+        self.assemble_time = config.get("assemble_time", 13.0)
+        self.min_assemble_time = min(config.get("min_assemble_time", self.assemble_time), self.assemble_time)
+        self.use_epochs = config.get("data_offset_epoch", False)
+        max_encoded_domain_len = config["max_domain_len"] + 2
+        max_sub_len = config["max_sub_len"]
+        # the OPT record of the queries, as main.py adds it for resolvers without a profile
+        qtype = config["send_query_type_int"]
+        edns_udp_size = query_edns_udp_size(qtype, config.get("answer_max_size", 1232), config.get("edns", False))
+        self.templates = []
+        for send_domain in config["send_domains"]:
+            sdeq = encode_qname(send_domain.encode().lower())
+            self.templates.append((QueryTemplate(sdeq, qtype, max_sub_len, edns_udp_size),
+                                   get_chunk_len(max_encoded_domain_len, len(sdeq), max_sub_len,
+                                                 self.data_offset_chars)))
+        self.fec_shard_size = 0
+        if self.fec_redundancy > 0 and self.templates:
+            self.fec_shard_size = get_fec_shard_size(min(chunk_len for _, chunk_len in self.templates), self.codec)
+        self.recv_domain_index = RecvDomainIndex([domain.encode() for domain in config["recv_domains"]])
+
+
+def encode(settings: Settings, datagrams: list) -> dict:
+    """
+    send_packet and send_in_queries without the queues and sockets
+    """
+    if not settings.templates:
+        raise ValueError("send_domains is empty, the encode path needs them")
+    queries = 0
+    query_bytes = 0
+    compressed = 0
+    data_offset = 0
+    domain_index = 0
+    query_id = 0
+    start = time.perf_counter()
+    for data in datagrams:
+        packet_flags = 0
+        if settings.compression:
+            packed = settings.compressor.compress(data)
+            if packed is not None:
+                data = packed
+                packet_flags |= PACKET_COMPRESSED
+                compressed += 1
+        if settings.fec_shard_size:
+            result = get_fec_final_queries(data, data_offset, domain_index, settings.templates,
+                                           settings.data_offset_chars, query_id, settings.fec_shard_size,
+                                           settings.fec_redundancy, settings.codec, packet_flags)
+        else:
+            result = get_base32_final_queries(data, data_offset, domain_index, settings.templates,
+                                              settings.data_offset_chars, query_id, settings.codec, packet_flags)
+        data_offset = (data_offset + 1) % settings.total_data_offset
+        domain_index = (domain_index + len(result)) % len(settings.templates)
+        query_id = (query_id + len(result)) & 0xFFFF
+        queries += len(result)
+        query_bytes += sum(len(query) for query in result)
+    elapsed = time.perf_counter() - start
+    return {"seconds": elapsed, "records": len(datagrams), "queries": queries, "query_bytes": query_bytes,
+            "compressed": compressed}
+
+
+async def decode(settings: Settings, records: list, speed: float) -> dict:
+    """
+    wan_recv and reassemble (DataHandler.new_fragment_event, as main.py) without the sockets, records are
+    (capture time, query)
+    """
+    handler = DataHandler(settings.total_data_offset, settings.assemble_time, settings.min_assemble_time,
+                          use_epochs=settings.use_epochs)
+    # the wheel turns with the capture time instead of the clock
+    handler.cleaner_task.cancel()
+    recv_domain_index = settings.recv_domain_index
+    codec = settings.codec
+    compressor = settings.compressor
+    data_offset_chars = settings.data_offset_chars
+    counts = {"invalid_requests": 0, "fragments": 0, "invalid_fragments": 0, "packets": 0, "packet_bytes": 0,
+              "decode_errors": 0}
+    next_tick = WHEEL_TICK
+    loop = asyncio.get_running_loop()
+    wall_start = loop.time()
+    busy = 0.0
+    for capture_time, raw_data in records:
+        if speed > 0:
+            delay = wall_start + capture_time / speed - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        start = time.perf_counter()
+        while capture_time >= next_tick:
+            handler.tick()
+            next_tick += WHEEL_TICK
+        try:
+            _, _, payloads, _, _ = recv_domain_index.handle_dns_request_questions(raw_data)
+        except Exception:
+            counts["invalid_requests"] += 1
+            busy += time.perf_counter() - start
+            continue
+        for payload in payloads:
+            counts["fragments"] += 1
+            try:
+                data_offset, fragment_part, last_fragment, chunk_data, packet_flags = get_chunk_data(
+                    payload, data_offset_chars)
+                if not chunk_data or fragment_part == 63 and not last_fragment:
+                    raise ValueError("invalid fragment")
+            except Exception:
+                counts["invalid_fragments"] += 1
+                continue
+            try:
+                data = handler.new_fragment_event(data_offset, fragment_part, last_fragment, chunk_data,
+                                                  packet_flags, codec, compressor)
+            except Exception:
+                counts["decode_errors"] += 1
+                continue
+            if data is not None:
+                counts["packets"] += 1
+                counts["packet_bytes"] += len(data)
+        busy += time.perf_counter() - start
+    return dict(counts, seconds=busy, records=len(records), reassembly=handler.describe())
+
+
+def summary(name: str, result: dict) -> None:
+    per_record = result["seconds"] / result["records"] * 1e6 if result["records"] else 0.0
+    rate = result["records"] / result["seconds"] if result["seconds"] else 0.0
+    details = {key: value for key, value in result.items() if key not in ("seconds", "records", "reassembly")}
+    print(f"{name}: {result['records']} records, {result['seconds']:.3f} s, {per_record:.2f} us/record, "
+          f"{rate:.0f} records/s, {details}")
+
+
+async def run(opts) -> dict:
+    with open(opts.config) as f:
+        settings = Settings(json.load(f))
+    h_datagrams = []
+    wan_records = []
+    for capture_time, kind, data in read_capture(opts.capture):
+        if kind == H_DATAGRAM:
+            h_datagrams.append(data)
+        elif kind == WAN_QUERY:
+            wan_records.append((capture_time, data))
+    if opts.export_sample:
+        with open(opts.export_sample, "wb") as f:
+            for data in h_datagrams:
+                f.write(len(data).to_bytes(2, "big") + data)
+    results = {}
+    # the best of the repeats counts (like timeit), the counters are the same in every repeat
+    for _ in range(opts.repeats):
+        if opts.mode in ("encode", "both") and h_datagrams:
+            result = encode(settings, h_datagrams)
+            if "encode" not in results or result["seconds"] < results["encode"]["seconds"]:
+                results["encode"] = result
+        if opts.mode in ("decode", "both") and wan_records:
+            result = await decode(settings, wan_records, opts.speed)
+            if "decode" not in results or result["seconds"] < results["decode"]["seconds"]:
+                results["decode"] = result
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="replays a capture through the encode and decode paths")
+    parser.add_argument("capture", help="a capture_file")
+    parser.add_argument("--config", default=os.path.join(PACKAGE_DIR, "config.json"),
+                        help="the config of the side that made the capture")
+    parser.add_argument("--mode", choices=("encode", "decode", "both"), default="both")
+    parser.add_argument("--speed", type=float, default=0.0, help="0: as fast as possible, 1: original timing")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--json", default="", help="also write the results to this file")
+    parser.add_argument("--export-sample", default="",
+                        help="write the h side datagrams to this file in the sample format of bench_compression.py")
+    opts = parser.parse_args()
+
+    results = asyncio.run(run(opts))
+    if not results:
+        sys.exit("no records for this mode in the capture")
+    for name, result in results.items():
+        summary(name, result)
+    if opts.json:
+        with open(opts.json, "w") as f:
+            json.dump(results, f, indent=1)
+
+
+main()
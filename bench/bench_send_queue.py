@@ -0,0 +1,142 @@
+# queue delay and drops of one resolver queue when more packets arrive than the send rate allows:
+# the old asyncio.Queue (1024 packets, drop after packets_wait_time_limit when dequeued) against SendQueue (codel).
+# the time is simulated, a packet of n fragments takes n / rate seconds to send.
+# then a busy session (load 1.2) and a light one (1 fragment packets, 5% of the send rate) share the queue, with and
+# without a flow per session.
+# usage: python bench/bench_send_queue.py [send_rate]
+
+import os
+import random
+import sys
+from collections import deque
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from send_queue import SendQueue
+
+SEND_RATE = float(sys.argv[1]) if len(sys.argv) > 1 else 1000.0  # fragments per second
+PACKETS_QUEUE_SIZE = 1024
+PACKETS_WAIT_TIME_LIMIT = 1.0
+QUERY_SIZE = 130
+DURATION = 60.0
+LOADS = (0.8, 1.2, 2.0)
+MAX_BYTES = (262144, 65536)
+# (target, interval), target 0: no codel
+CODEL_SETTINGS = ((0.01, 0.1), (0.02, 0.1), (0.02, 0.2), (0.05, 0.2), (0, 0))
+
+
+class OldQueue:
+    def __init__(self) -> None:
+        self.items = deque()
+        self.dropped = 0
+
+    def put(self, now: float, item, size: int) -> None:
+        if len(self.items) >= PACKETS_QUEUE_SIZE:
+            self.dropped += 1
+        else:
+            self.items.append((now, item))
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def dequeue(self, now: float):
+        if self.items:
+            return self.items.popleft()[1]
+        return None
+
+
+def run(queue, load: float) -> tuple[list[float], int]:
+    rnd = random.Random(1)
+    # ack sized and data sized packets, 1 to 10 fragments
+    mean_fragments = 5.5
+    arrival_rate = load * SEND_RATE / mean_fragments
+    delays = []
+    arrivals = 0
+    t_arrival = rnd.expovariate(arrival_rate)
+    t_free = 0.0  # when the sender can take the next packet
+    while t_arrival < DURATION or len(queue):
+        if t_arrival < DURATION and (t_arrival <= t_free or not len(queue)):
+            fragments = rnd.randint(1, 10)
+            queue.put(t_arrival, (t_arrival, fragments), fragments * QUERY_SIZE)
+            arrivals += 1
+            t_free = max(t_free, t_arrival)
+            t_arrival += rnd.expovariate(arrival_rate)
+            continue
+        now = t_free
+        item = queue.dequeue(now)
+        if item is None:
+            continue
+        entry_time, fragments = item
+        if now - entry_time > PACKETS_WAIT_TIME_LIMIT:
+            # like wan_send_from_queue
+            continue
+        delays.append(now - entry_time)
+        t_free = now + fragments / SEND_RATE
+    return delays, arrivals
+
+
+def run_sessions(queue: SendQueue, use_flows: bool) -> tuple[list[float], int]:
+    # the queue delays of the light session and how many of its packets were sent
+    rnd = random.Random(1)
+    busy_rate = 1.2 * SEND_RATE / 5.5
+    light_rate = 0.05 * SEND_RATE
+    delays = []
+    sent = 0
+    t_busy = rnd.expovariate(busy_rate)
+    t_light = rnd.expovariate(light_rate)
+    t_free = 0.0
+    while min(t_busy, t_light) < DURATION or len(queue):
+        t_arrival = min(t_busy, t_light)
+        if t_arrival < DURATION and (t_arrival <= t_free or not len(queue)):
+            if t_busy <= t_light:
+                fragments = rnd.randint(1, 10)
+                queue.put(t_busy, (t_busy, fragments, False), fragments * QUERY_SIZE, 1 if use_flows else 0)
+                t_busy += rnd.expovariate(busy_rate)
+            else:
+                queue.put(t_light, (t_light, 1, True), QUERY_SIZE, 2 if use_flows else 0)
+                t_light += rnd.expovariate(light_rate)
+            t_free = max(t_free, t_arrival)
+            continue
+        now = t_free
+        item = queue.dequeue(now)
+        if item is None:
+            continue
+        entry_time, fragments, light = item
+        if now - entry_time > PACKETS_WAIT_TIME_LIMIT:
+            continue
+        if light:
+            delays.append(now - entry_time)
+            sent += 1
+        t_free = now + fragments / SEND_RATE
+    return delays, sent
+
+
+def percentile(values: list[float], p: float) -> float:
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def main():
+    print(f"send rate {SEND_RATE:.0f} fragments/s, packets of 1-10 fragments, {DURATION:.0f}s")
+    for load in LOADS:
+        print(f"offered load {load:.1f}:")
+        queues = [("asyncio.Queue", OldQueue())]
+        for max_bytes in MAX_BYTES:
+            for target, interval in CODEL_SETTINGS:
+                name = f"{max_bytes // 1024}KB " + (
+                    f"codel {target * 1000:.0f}/{interval * 1000:.0f}ms" if target else "no codel")
+                queues.append((name, SendQueue(PACKETS_QUEUE_SIZE, max_bytes, target, interval)))
+        for name, queue in queues:
+            delays, arrivals = run(queue, load)
+            delays.sort()
+            print(f"  {name:<24} sent {len(delays) / arrivals:6.1%}  queue delay p50 {percentile(delays, 0.5) * 1000:6.1f}ms"
+                  f"  p99 {percentile(delays, 0.99) * 1000:6.1f}ms  max {delays[-1] * 1000:6.1f}ms")
+    print("a light session next to a busy one (64KB codel 20/100ms):")
+    for use_flows in (False, True):
+        delays, sent = run_sessions(SendQueue(PACKETS_QUEUE_SIZE, 65536, 0.02, 0.1), use_flows)
+        delays.sort()
+        name = "a flow per session" if use_flows else "one flow"
+        print(f"  {name:<24} light sent {sent / (0.05 * SEND_RATE * DURATION):6.1%}  queue delay p50 "
+              f"{percentile(delays, 0.5) * 1000:6.1f}ms  p99 {percentile(delays, 0.99) * 1000:6.1f}ms")
+
+
+main()
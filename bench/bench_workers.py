@@ -0,0 +1,35 @@
+# runs bench_loopback.py with the same traffic and 1, 2, ... workers on both tunnels and prints them side by side.
+# the traffic comes from one h side client, which the kernel always hands to the same worker, so it shows whether
+# that worker gets the whole send budget (the rate of the resolvers and the send sockets) or only its 1/N of it.
+# usage: python bench/bench_workers.py [--counts 1,2] [the options of bench_loopback.py]
+# for example: python bench/bench_workers.py --rate 100 --duration 10
+
+import asyncio
+import json
+
+from bench_loopback import make_parser, run
+
+
+def main():
+    parser = make_parser()
+    parser.description = "loopback benchmark of one client with different --workers"
+    parser.add_argument("--counts", default="1,2", help="the --workers values to compare")
+    opts = parser.parse_args()
+    results = {}
+    for count in [int(count) for count in opts.counts.split(",")]:
+        opts.workers = count
+        results[count] = asyncio.run(run(opts))
+    print(f"{'workers':>8} {'delivery':>9} {'goodput kbps':>13} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} "
+          f"{'cpu a %':>8} {'cpu b %':>8}")
+    for count, result in results.items():
+        latency = result["latency_ms"]
+        print(f"{count:>8} {result['delivery_ratio']:>9.4f} {result['goodput_kbps']:>13.1f} {latency['p50']:>8.2f} "
+              f"{latency['p90']:>8.2f} {latency['p99']:>8.2f} {result['cpu_percent']['a']:>8.1f} "
+              f"{result['cpu_percent']['b']:>8.1f}")
+    if opts.json:
+        with open(opts.json, "w") as f:
+            json.dump({"options": vars(opts), "results": results}, f, indent=1)
+
+
+if __name__ == "__main__":
+    main()
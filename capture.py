@@ -0,0 +1,84 @@
+import os
+import struct
+
+# a capture file is CAPTURE_MAGIC and then one record per datagram: kind (1 byte), microseconds since the previous
+# record (4 bytes) and the datagram as 2 bytes big-endian length + data (like the sample files of the benchmarks)
+CAPTURE_MAGIC = b"QQCAP1\n"
+H_DATAGRAM = 0  # a datagram from the h side (h_in_address or a session backend)
+WAN_QUERY = 1  # a DNS-Query from a resolver (udp, tcp or tls)
+CAPTURE_BUFFER_SIZE = 1 << 20
+MAX_DELTA_US = 0xFFFFFFFF
+
+_RECORD_HEADER = struct.Struct("!BIH")
+
+
+class Capture:
+    """
+    appends the received datagrams to a capture file, the writes are buffered (flush() writes them out). the file is
+    closed when it reaches max_bytes.
+    """
+
+    def __init__(self, path: str, max_bytes: int, now: float) -> None:
+        # the capture holds the tunneled datagrams, only the user of the tunnel reads it
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o600)
+        if hasattr(os, "fchmod"):
+            # the mode of os.open only applies to a new file
+            os.fchmod(fd, 0o600)
+        self.file = os.fdopen(fd, "wb", buffering=CAPTURE_BUFFER_SIZE)
+        self.file.write(CAPTURE_MAGIC)
+        self.size = len(CAPTURE_MAGIC)
+        self.max_bytes = max_bytes
+        self.last_us = int(now * 1e6)
+        self.records = 0
+
+    def write(self, kind: int, datagrams: list[bytes], now: float) -> None:
+        if self.file is None:
+            return
+        now_us = int(now * 1e6)
+        delta = min(max(now_us - self.last_us, 0), MAX_DELTA_US)
+        self.last_us = now_us
+        write = self.file.write
+        size = self.size
+        for data in datagrams:
+            write(_RECORD_HEADER.pack(kind, delta, len(data)))
+            write(data)
+            size += _RECORD_HEADER.size + len(data)
+            delta = 0
+        self.records += len(datagrams)
+        self.size = size
+        if self.max_bytes and size >= self.max_bytes:
+            print("capture_file is full:", self.records, "records")
+            self.close()
+
+    def flush(self) -> None:
+        if self.file is not None:
+            self.file.flush()
+
+    def close(self) -> None:
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def read_capture(path: str):
+    """
+    yields (seconds since the first record, kind, datagram) of each record of a capture file
+    """
+    with open(path, "rb") as f:
+        if f.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError(f"{path} is not a capture file")
+        data = f.read()
+    offset = 0
+    now_us = 0
+    first = True
+    while offset + _RECORD_HEADER.size <= len(data):
+        kind, delta, length = _RECORD_HEADER.unpack_from(data, offset)
+        offset += _RECORD_HEADER.size
+        if offset + length > len(data):
+            # the last record of a capture that was not flushed completely
+            break
+        if not first:
+            now_us += delta
+        first = False
+        yield now_us / 1e6, kind, data[offset:offset + length]
+        offset += length
@@ -0,0 +1,84 @@
+# the length in front of every coalesced datagram: 1 byte below 128, else 2 bytes big-endian with the high bit set,
+# so two 24 bytes acks still fit in the 50 bytes of one fragment
+MAX_COALESCE_SIZE = 0x7FFF
+
+
+def _len_size(len_data: int) -> int:
+    return 1 if len_data < 0x80 else 2
+
+
+def pack_datagrams(datagrams: list[bytes]) -> bytes:
+    parts = []
+    for datagram in datagrams:
+        len_datagram = len(datagram)
+        parts.append(bytes((len_datagram,)) if len_datagram < 0x80 else (0x8000 | len_datagram).to_bytes(2, "big"))
+        parts.append(datagram)
+    return b"".join(parts)
+
+
+def unpack_datagrams(data: bytes) -> list[bytes]:
+    datagrams = []
+    i = 0
+    len_data = len(data)
+    while i < len_data:
+        len_datagram = data[i]
+        if len_datagram & 0x80:
+            if i + 1 >= len_data:
+                raise ValueError("invalid coalesced datagrams")
+            len_datagram = (len_datagram & 0x7F) << 8 | data[i + 1]
+            i += 2
+        else:
+            i += 1
+        end = i + len_datagram
+        if end > len_data:
+            raise ValueError("invalid coalesced datagrams")
+        datagrams.append(data[i:end])
+        i = end
+    return datagrams
+
+
+class Coalescer:
+    """
+    collects small datagrams into one payload of up to max_size bytes, so several of them share the fragments
+    of one packet. the caller flushes it (take) when the first waiting datagram is older than the latency budget.
+    """
+    __slots__ = ("max_size", "datagrams", "size")
+
+    def __init__(self, max_size: int) -> None:
+        self.max_size = min(max_size, MAX_COALESCE_SIZE)
+        self.datagrams: list[bytes] = []
+        self.size = 0
+
+    def __bool__(self) -> bool:
+        return bool(self.datagrams)
+
+    def fits(self, data: bytes) -> bool:
+        """
+        if the datagram is small enough to be coalesced at all
+        """
+        return len(data) + _len_size(len(data)) <= self.max_size
+
+    def add(self, data: bytes) -> tuple[bytes, bool] | None:
+        """
+        adds a datagram (that fits), returns what take() returns if the waiting datagrams had to be sent first
+        """
+        size = len(data) + _len_size(len(data))
+        result = None
+        if self.size + size > self.max_size:
+            result = self.take()
+        self.datagrams.append(data)
+        self.size += size
+        return result
+
+    def take(self) -> tuple[bytes, bool] | None:
+        """
+        (payload, coalesced) of the waiting datagrams, a single datagram is returned as it is
+        """
+        datagrams = self.datagrams
+        if not datagrams:
+            return None
+        self.datagrams = []
+        self.size = 0
+        if len(datagrams) == 1:
+            return datagrams[0], False
+        return pack_datagrams(datagrams), True
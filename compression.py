@@ -0,0 +1,53 @@
+import zlib
+
+# raw deflate with a 4KB window and a small hash table: the setup of the default 32KB/memLevel 8 state costs
+# several times more than compressing a datagram. only the last 4KB of the dictionary can be referenced.
+WINDOW_BITS = 12
+MEM_LEVEL = 4
+MAX_DICTIONARY_SIZE = 1 << WINDOW_BITS
+MAX_DECOMPRESSED_SIZE = 65535
+
+
+class Compressor:
+    """
+    compresses single datagrams, with an optional preset dictionary (the same bytes on both sides)
+    that gives the first bytes of small datagrams something to refer to.
+    """
+
+    def __init__(self, level: int = 9, dictionary: bytes = b"") -> None:
+        self.level = level
+        self.dictionary = dictionary[-MAX_DICTIONARY_SIZE:]
+
+    def compress(self, data: bytes) -> bytes | None:
+        """
+        returns None if the compressed data is not smaller.
+        """
+        if self.dictionary:
+            c = zlib.compressobj(self.level, zlib.DEFLATED, -WINDOW_BITS, MEM_LEVEL, zlib.Z_DEFAULT_STRATEGY,
+                                 self.dictionary)
+        else:
+            c = zlib.compressobj(self.level, zlib.DEFLATED, -WINDOW_BITS, MEM_LEVEL)
+        compressed = c.compress(data) + c.flush()
+        if len(compressed) >= len(data):
+            return None
+        return compressed
+
+    def decompress(self, data: bytes) -> bytes:
+        if self.dictionary:
+            d = zlib.decompressobj(-WINDOW_BITS, self.dictionary)
+        else:
+            d = zlib.decompressobj(-WINDOW_BITS)
+        try:
+            decompressed = d.decompress(data, MAX_DECOMPRESSED_SIZE)
+        except zlib.error as e:
+            raise ValueError(f"decompress error: {e}") from None
+        if not d.eof or d.unconsumed_tail or d.unused_data:
+            raise ValueError("invalid compressed data")
+        return decompressed
+
+
+def load_dictionary(path: str) -> bytes:
+    if not path:
+        return b""
+    with open(path, "rb") as f:
+        return f.read()
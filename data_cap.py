@@ -1,8 +1,10 @@
+import math
 import sys
 
-from utility.base32 import b32encode_nopad_lower, BASE32_LIST_LOWER, number_to_base32_lower, base32_to_number, \
-    BASE32_LOOKUP
+from fec import encode_parity, recover
+from utility.base32 import BASE32_LIST_LOWER, number_to_base32_lower, base32_to_number, BASE32_LOOKUP
 from utility.dns import insert_dots
+from utility.codec import PayloadCodec, PAYLOAD_CODECS
 
 
 def compute_max_m(s: int, max_allowed: int) -> int:
@@ -31,9 +33,9 @@ def get_chunk_len(max_encoded_domain_len: int, qname_encoded_len: int, max_sub_l
 def get_base32_final_domains(data: bytes, data_offset: int, send_domain_with_chunk_idx: int,
                              send_domain_with_chunk_list: list, max_sub_len: int,
                              data_offset_width: int,
-                             max_encoded_domain_len: int) -> \
+                             max_encoded_domain_len: int, codec: PayloadCodec = PAYLOAD_CODECS["base32"]) -> \
         list[bytes]:
-    data = b32encode_nopad_lower(data)
+    data = codec.encode(data)
     final_b_domains = []
     i = 0
     c_loop = True
@@ -68,6 +70,151 @@ def get_base32_final_domains(data: bytes, data_offset: int, send_domain_with_chu
     return final_b_domains
 
 
+# the magic character after the fragment part character: "0"/"1"/"8"/"9" while no packet flag is set (so peers that
+# do not know the packet flags still understand it), else the base32 character of these bits:
+MAGIC_LAST = 1
+MAGIC_PART_HIGH = 2  # fragment part | 32
+# packet flags, the same on every fragment of a packet
+PACKET_COMPRESSED = 4
+# the fragments are the shards of an erasure code (see get_fec_final_queries), MAGIC_LAST marks the parity fragments
+PACKET_FEC = 8
+# the packet is several datagrams, each with its length in front (see coalesce.py)
+PACKET_COALESCED = 16
+PACKET_FLAGS_SHIFT = 2
+PACKET_FLAGS_MASK = 0b11100
+# not in the magic character: set for the fragments that came in answers, their data is not encoded
+PACKET_BINARY = 32
+
+_LEGACY_MAGICS = (b"0", b"1", b"8", b"9")
+# FRAGMENT_HEADERS[packet_flags >> PACKET_FLAGS_SHIFT][fragment_part][last_fragment]:
+# fragment part character + magic character
+FRAGMENT_HEADERS = []
+for _packet_flags in range(0, PACKET_FLAGS_MASK + 1, 1 << PACKET_FLAGS_SHIFT):
+    _headers = []
+    for _part in range(64):
+        _pair = []
+        for _last in (0, 1):
+            _magic = (MAGIC_PART_HIGH if _part & 32 else 0) | _last
+            if _packet_flags:
+                _pair.append(BASE32_LIST_LOWER[_part & 31] + BASE32_LIST_LOWER[_packet_flags | _magic])
+            else:
+                _pair.append(BASE32_LIST_LOWER[_part & 31] + _LEGACY_MAGICS[_magic])
+        _headers.append(tuple(_pair))
+    FRAGMENT_HEADERS.append(_headers)
+
+
+def get_base32_final_queries(data: bytes, data_offset: int, send_domain_with_chunk_idx: int,
+                             send_template_with_chunk_list: list, data_offset_width: int, query_id: int,
+                             codec: PayloadCodec = PAYLOAD_CODECS["base32"], packet_flags: int = 0) -> \
+        list[bytearray]:
+    """
+    the same queries as build_dns_query over get_base32_final_domains (query_id is incremented per query),
+    but each query is written directly into its own bytearray by the QueryTemplate of the send domain.
+    the data offset and fragment header are always base32, the data is encoded with the payload codec.
+    """
+    data = memoryview(codec.encode(data))
+    fragment_headers = FRAGMENT_HEADERS[packet_flags >> PACKET_FLAGS_SHIFT]
+    queries = []
+    i = 0
+    s_index = 0
+    len_data = len(data)
+    data_offset_bytes = number_to_base32_lower(data_offset, data_offset_width)
+    len_send_list = len(send_template_with_chunk_list)
+    while True:
+        if i == 64:
+            print("ERROR: max_domain_len is too small, packet is not sent, len:", len_data)
+            return []
+        query_template, chunk_len = send_template_with_chunk_list[send_domain_with_chunk_idx]
+        send_domain_with_chunk_idx = (send_domain_with_chunk_idx + 1) % len_send_list
+        chunk_data = data[s_index:s_index + chunk_len]
+        s_index += chunk_len
+        last_fragment = s_index >= len_data
+        queries.append(query_template.build(query_id, data_offset_bytes + fragment_headers[i][last_fragment],
+                                            chunk_data))
+        query_id = (query_id + 1) & 0xFFFF
+        if last_fragment:
+            return queries
+        i += 1
+
+
+# fec fragments start with 2 base32 characters: (data fragments - 1) << 4 | (parity fragments - 1)
+FEC_HEADER_LEN = 2
+MAX_PARITY_FRAGMENTS = 16
+MAX_FEC_FRAGMENTS = 64
+
+
+def get_fec_shard_size(chunk_len: int, codec: PayloadCodec = PAYLOAD_CODECS["base32"]) -> int:
+    """
+    the most data bytes of a fec fragment whose encoding fits in chunk_len characters
+    """
+    max_chars = chunk_len - FEC_HEADER_LEN
+    shard_size = int(max_chars * codec.bits_per_char / 8) + 1
+    while shard_size > 0 and len(codec.encode(bytes(shard_size))) > max_chars:
+        shard_size -= 1
+    if shard_size <= 0:
+        raise ValueError("max_encoded_domain_len is too small to fit any fec data")
+    return shard_size
+
+
+def get_fec_final_queries(data: bytes, data_offset: int, send_domain_with_chunk_idx: int,
+                          send_template_with_chunk_list: list, data_offset_width: int, query_id: int,
+                          shard_size: int, redundancy: float, codec: PayloadCodec = PAYLOAD_CODECS["base32"],
+                          packet_flags: int = 0) -> list[bytearray]:
+    """
+    like get_base32_final_queries, but the packet (with its length in front) is split in n shards of shard_size
+    bytes and ceil(n * redundancy) parity shards are added, the other side rebuilds it from any n fragments.
+    every shard is encoded on its own, so parity fragments look like data fragments.
+    """
+    data = len(data).to_bytes(2, "big") + data
+    n = -(-len(data) // shard_size)
+    k = min(max(1, math.ceil(n * redundancy)), MAX_PARITY_FRAGMENTS, MAX_FEC_FRAGMENTS - n)
+    if k < 1:
+        print("ERROR: max_domain_len is too small, packet is not sent, len:", len(data))
+        return []
+    data += bytes(n * shard_size - len(data))
+    shards = [data[i:i + shard_size] for i in range(0, len(data), shard_size)]
+    shards += encode_parity(shards, k)
+    fragment_headers = FRAGMENT_HEADERS[(packet_flags | PACKET_FEC) >> PACKET_FLAGS_SHIFT]
+    fec_header = number_to_base32_lower((n - 1) << 4 | (k - 1), FEC_HEADER_LEN)
+    data_offset_bytes = number_to_base32_lower(data_offset, data_offset_width)
+    len_send_list = len(send_template_with_chunk_list)
+    queries = []
+    for i, shard in enumerate(shards):
+        query_template, _ = send_template_with_chunk_list[send_domain_with_chunk_idx]
+        send_domain_with_chunk_idx = (send_domain_with_chunk_idx + 1) % len_send_list
+        queries.append(query_template.build(query_id, data_offset_bytes + fragment_headers[i][i >= n] + fec_header,
+                                            codec.encode(shard)))
+        query_id = (query_id + 1) & 0xFFFF
+    return queries
+
+
+def get_fec_header(fragment_part: int, parity_fragment: bool, chunk_data: bytes) -> tuple[int, int, bytes]:
+    """
+    (data fragments, parity fragments, encoded shard) of a fec fragment
+    """
+    value = base32_to_number(chunk_data[:FEC_HEADER_LEN])
+    n = (value >> 4) + 1
+    k = (value & 15) + 1
+    if len(chunk_data) <= FEC_HEADER_LEN or fragment_part >= n + k or parity_fragment != (fragment_part >= n):
+        raise ValueError("invalid fec fragment")
+    return n, k, chunk_data[FEC_HEADER_LEN:]
+
+
+def get_fec_packet(shards: dict, n: int, k: int, codec: PayloadCodec = PAYLOAD_CODECS["base32"]) -> bytes:
+    """
+    the packet of n of the encoded shards ({fragment part: encoded shard})
+    """
+    shards = {i: codec.decode(shard) for i, shard in shards.items()}
+    shard_size = len(next(iter(shards.values())))
+    if any(len(shard) != shard_size for shard in shards.values()):
+        raise ValueError("fec shards of different sizes")
+    data = b"".join(recover(shards, n, k))
+    len_data = int.from_bytes(data[:2], "big")
+    if len_data > len(data) - 2:
+        raise ValueError("invalid fec packet length")
+    return data[2:2 + len_data]
+
+
 def get_chunk_data(data: bytes, data_offset_width: int):
     data_offset = base32_to_number(data[:data_offset_width])
 
@@ -76,6 +223,7 @@ def get_chunk_data(data: bytes, data_offset_width: int):
         raise ValueError("Invalid base32 character in fragment part")
 
     magic = data[data_offset_width + 1]
+    packet_flags = 0
     if magic == 48:  # b"0"
         fragment_part = fragment_part_raw
         last_fragment = False
@@ -89,7 +237,12 @@ def get_chunk_data(data: bytes, data_offset_width: int):
         fragment_part = fragment_part_raw | 32
         last_fragment = True
     else:
-        raise ValueError("Unknown magic")
+        magic = BASE32_LOOKUP[magic]
+        packet_flags = magic & PACKET_FLAGS_MASK
+        if magic < 0 or not packet_flags:
+            raise ValueError("Unknown magic")
+        fragment_part = fragment_part_raw | 32 if magic & MAGIC_PART_HIGH else fragment_part_raw
+        last_fragment = bool(magic & MAGIC_LAST)
 
     e_data = data[data_offset_width + 2:]
-    return data_offset, fragment_part, last_fragment, e_data
+    return data_offset, fragment_part, last_fragment, e_data, packet_flags
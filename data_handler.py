@@ -1,89 +1,382 @@
 import asyncio
+import math
 import sys
 
+from data_cap import get_fec_header, get_fec_packet, PACKET_COMPRESSED, PACKET_BINARY, PACKET_FEC
+from metrics import Histogram
+
+WHEEL_TICK = 0.5
+# the assembly time is adapted every ADAPT_TICKS ticks (2 s)
+ADAPT_TICKS = 4
+# a key is kept for SPREAD_MARGIN times the longest spread (ticks from the first to the last fragment or duplicate
+# of a packet) of the last SPREAD_PERIODS adapt periods (10 s)
+SPREAD_MARGIN = 2
+SPREAD_PERIODS = 5
+# wheel entries are epoch << EPOCH_SHIFT | key
+EPOCH_SHIFT = 24
+KEY_MASK = (1 << EPOCH_SHIFT) - 1
+# the epoch of a sender goes around after EPOCH_COUNT wraparounds of the data offsets, an epoch up to half of it
+# behind the kept one is older
+EPOCH_COUNT = 32
+# the first tick of a key that was never used
+NEVER = -(1 << 30)
+
+
+class PartialPacket:
+    __slots__ = ("received", "last_part", "contiguous", "buffer", "pending", "last_tick")
+
+    def __init__(self, tick: int) -> None:
+        self.last_tick = tick  # the tick of the last received fragment
+        self.received = 0  # bitmap of the received fragment parts
+        self.last_part = -1  # fragment part of the last fragment, -1 until it is received
+        self.contiguous = 0  # the parts before this one are already appended to buffer
+        self.buffer = bytearray()
+        self.pending = None  # out of order parts: {fragment_part: data}
+
+
+class FecPacket:
+    __slots__ = ("n", "k", "shards", "last_tick")
+
+    def __init__(self, n: int, k: int, shards: dict, tick: int) -> None:
+        self.last_tick = tick
+        self.n = n  # data fragments, any n of the n + k fragments rebuild the packet
+        self.k = k  # parity fragments
+        self.shards = shards  # {fragment_part: data}
+
 
 class DataHandler:
-    def __init__(self, offsets_size: int, assemble_time: float) -> None:
+    """
+    reassembles fragments, all callers run on one event loop so there is no locking.
+    every used key is kept for the assembly time (so late duplicates and retries are ignored) and then
+    released in bulk by a hashed timer wheel.
+    with min_assemble_time below assemble_time the assembly time follows the observed fragment spread (completed
+    packets, duplicates, timeouts that were still receiving fragments and fragments that come after their key was
+    released), and is cut when the rate of new keys would make the sender wrap around to a key that is still kept.
+    every fragment carries the epoch of its sender (0 if the other side does not send one), a fragment with a newer
+    epoch than its kept key is a new packet after a wraparound: the old entry is replaced and counted as a collision,
+    a fragment with an older epoch is a late copy of an old packet and is dropped (stale).
+    with use_epochs (the other side sends epochs) a fragment with the epoch of a key released less than assemble_time
+    ago is a late copy of that packet and is dropped, without epochs it can not be told from a new packet.
+    shares: the number of handlers (workers) the keys are split between. offsets_size is a power of 2.
+    """
+
+    def __init__(self, offsets_size: int, assemble_time: float, min_assemble_time: float | None = None,
+                 shares: int = 1, use_epochs: bool = False) -> None:
         self.offsets_size = offsets_size
-        self.assemble_time = assemble_time
-        self.lock = asyncio.Lock()
+        self.offset_bits = offsets_size.bit_length() - 1  # the epoch of a data offset is above these bits
+        self.shares = shares
+        self.use_epochs = use_epochs
+        # None: free, PartialPacket/FecPacket: in progress, True: done, False: conflicting fragments
         self.mpp_list: list = [None] * offsets_size
-        self.active_keys_queue = asyncio.Queue(maxsize=offsets_size)
+        self.epochs = bytearray(offsets_size)
+        self.first_ticks = [NEVER] * offsets_size  # the tick of the first fragment of the (last) kept key
+        # a key added during tick t is released at tick t + wheel_ticks, at least the assembly time later
+        self.max_ticks = math.ceil(assemble_time / WHEEL_TICK) + 1
+        self.min_ticks = self.max_ticks
+        if min_assemble_time is not None:
+            self.min_ticks = min(math.ceil(min_assemble_time / WHEEL_TICK) + 1, self.max_ticks)
+        self.wheel_ticks = self.min_ticks
+        self.wheel: list[list[int]] = [[] for _ in range(self.max_ticks + 1)]
+        self.wheel_pos = 0
+        self.ticks = 0
+        # adapt period state
+        self.spread_max = 0
+        self.spread_history = [0] * SPREAD_PERIODS
+        self.new_keys = 0
+        self.wrap_ticks = 1 << 30  # the ticks the sender takes to come back to a key
+        # counters
+        self.completed = 0
+        self.timeouts = 0  # released before all fragments were received
+        self.conflicts = 0
+        self.duplicates = 0
+        self.collisions = 0
+        self.stale = 0  # fragments with an older epoch than their key
+        self.late = 0  # fragments of a key that was released before assemble_time
+        self.fragments_per_packet = Histogram()
         self.cleaner_task = asyncio.create_task(self.cleanup())
 
+    @property
+    def assemble_time(self) -> float:
+        return (self.wheel_ticks - 1) * WHEEL_TICK
+
+    def adapt(self) -> None:
+        self.spread_history[self.ticks // ADAPT_TICKS % SPREAD_PERIODS] = self.spread_max
+        if self.min_ticks < self.max_ticks:
+            ticks = max(self.min_ticks, max(self.spread_history) * SPREAD_MARGIN + 2)
+            if self.new_keys:
+                # the sender is back at a key after going through all the others, keep it at most half of that
+                self.wrap_ticks = self.offsets_size // self.shares * ADAPT_TICKS // self.new_keys
+                ticks = min(ticks, max(self.wrap_ticks // 2, 2))
+            self.wheel_ticks = min(ticks, self.max_ticks)
+        self.spread_max = 0
+        self.new_keys = 0
+
+    def new_key(self, key: int, epoch: int) -> None:
+        self.epochs[key] = epoch
+        self.first_ticks[key] = self.ticks
+        self.new_keys += 1
+        self.wheel[(self.wheel_pos + self.wheel_ticks) % len(self.wheel)].append(epoch << EPOCH_SHIFT | key)
+
+    def record_spread(self, key: int) -> None:
+        # only for completed packets and their duplicates, the spread of a packet in progress is not final
+        spread = self.ticks - self.first_ticks[key]
+        if spread > self.spread_max:
+            self.spread_max = spread
+
+    def released_early(self, key: int, epoch: int) -> bool:
+        """
+        for a fragment of a free key that was released less than assemble_time after its first fragment (only with
+        the adaptive time): True if it is dropped as a late copy of the released packet or of an older one
+        """
+        kept_epoch = self.epochs[key]
+        if kept_epoch != epoch:
+            if self.use_epochs and (epoch - kept_epoch) % EPOCH_COUNT >= EPOCH_COUNT // 2:
+                self.stale += 1
+                return True
+            return False
+        spread = self.ticks - self.first_ticks[key]
+        if not self.use_epochs and spread * 2 >= self.wrap_ticks:
+            # the sender may be back at this key, a new packet
+            return False
+        # a duplicate or retry that came after its key was released, the assembly time grows to its spread
+        self.late += 1
+        if spread > self.spread_max:
+            self.spread_max = spread
+        return self.use_epochs
+
+    def tick(self) -> None:
+        """
+        releases the keys of the next wheel slot, called every WHEEL_TICK seconds
+        """
+        self.ticks += 1
+        if self.ticks % ADAPT_TICKS == 0:
+            self.adapt()
+        self.wheel_pos = (self.wheel_pos + 1) % len(self.wheel)
+        slot = self.wheel[self.wheel_pos]
+        mpp_list = self.mpp_list
+        epochs = self.epochs
+        for entry in slot:
+            key = entry & KEY_MASK
+            if epochs[key] != entry >> EPOCH_SHIFT:
+                # replaced after a collision, the new entry is released by its own wheel entry
+                continue
+            mpp = mpp_list[key]
+            if mpp is not True and mpp is not False and mpp is not None:
+                self.timeouts += 1
+                # its fragments were still coming in the second half of its time, the time is too short for them
+                first_tick = self.first_ticks[key]
+                held = self.ticks - first_tick
+                if (mpp.last_tick - first_tick) * 2 >= held > self.spread_max:
+                    self.spread_max = held
+            mpp_list[key] = None
+        slot.clear()
+
     async def cleanup(self) -> None:
         try:
-            loop = asyncio.get_running_loop()
-            await asyncio.sleep(self.assemble_time)
             while True:
-                key: int
-                add_time: float
-                key, add_time = await self.active_keys_queue.get()
-                alive_time = self.assemble_time - (loop.time() - add_time)
-                if alive_time <= 0:
-                    async with self.lock:
-                        self.mpp_list[key] = None
-                else:
-                    await asyncio.sleep(alive_time)
-                    async with self.lock:
-                        self.mpp_list[key] = None
+                await asyncio.sleep(WHEEL_TICK)
+                self.tick()
 
         except Exception as e:
             print(e)
             sys.exit("cleanup error!")
 
-    async def new_data_event(self, key: int, fragment_part: int, last_fragment: bool, data: bytes) -> bytes:
-        loop = asyncio.get_running_loop()
-        async with self.lock:
-            mpp = self.mpp_list[key]
-            if mpp is None:
-                rec_nums = 1
-                biggest_index_plus_one = fragment_part + 1
-                seen_last_fragment = last_fragment
-                if seen_last_fragment and rec_nums == biggest_index_plus_one:
-                    self.mpp_list[key] = True
-                    await self.active_keys_queue.put((key, loop.time()))
-                    return data
-
-                mpp = [None, None, None, None, None, None, None, None, None, None, None, None, None, None, None, None,
-                       None, None, None, None, None, None, None, None, None, None, None, None, None, None, None, None,
-                       None, None, None, None, None, None, None, None, None, None, None, None, None, None, None, None,
-                       None, None, None, None, None, None, None, None, None, None, None, None, None, None, None, None,
-                       rec_nums, biggest_index_plus_one, seen_last_fragment]
-                mpp[fragment_part] = data
-                self.mpp_list[key] = mpp
-                await self.active_keys_queue.put((key, loop.time()))
-                return b""
-
-            if (mpp is True) or (mpp is False):
+    def new_data_event(self, key: int, fragment_part: int, last_fragment: bool, data: bytes,
+                       epoch: int = 0) -> bytes | bytearray:
+        mpp = self.mpp_list[key]
+        if mpp is None:
+            if self.ticks - self.first_ticks[key] < self.max_ticks and self.released_early(key, epoch):
                 return b""
-            if mpp[fragment_part] is not None:
+        elif self.epochs[key] != epoch:
+            if (epoch - self.epochs[key]) % EPOCH_COUNT >= EPOCH_COUNT // 2:
+                # a late fragment of an older packet, the key is kept for a newer one
+                self.stale += 1
                 return b""
+            self.collisions += 1
+            mpp = None
+        if mpp is None:
+            # new_key() inline, this is the most common case
+            self.epochs[key] = epoch
+            self.first_ticks[key] = self.ticks
+            self.new_keys += 1
+            self.wheel[(self.wheel_pos + self.wheel_ticks) % len(self.wheel)].append(epoch << EPOCH_SHIFT | key)
+            if last_fragment and fragment_part == 0:
+                self.mpp_list[key] = True
+                self.completed += 1
+                self.fragments_per_packet.record(1)
+                return data
 
-            mpp[fragment_part] = data
-            rec_nums = mpp[-3] + 1
-            fp_po = fragment_part + 1
-            p_biggest = mpp[-2]
-            if fp_po > p_biggest:
-                biggest_updated = True
-                biggest_index_plus_one = fp_po
+            mpp = PartialPacket(self.ticks)
+            mpp.received = 1 << fragment_part
+            if fragment_part == 0:
+                mpp.buffer += data
+                mpp.contiguous = 1
             else:
-                biggest_index_plus_one = p_biggest
-                biggest_updated = False
-            p_seen_last_frag = mpp[-1]
-            if (last_fragment and p_seen_last_frag) or (biggest_updated and p_seen_last_frag) or (
-                    (not biggest_updated) and last_fragment):
+                mpp.pending = {fragment_part: data}
+            if last_fragment:
+                mpp.last_part = fragment_part
+            self.mpp_list[key] = mpp
+            return b""
+
+        if (mpp is True) or (mpp is False):
+            if mpp is True:
+                self.duplicates += 1
+                spread = self.ticks - self.first_ticks[key]
+                if spread > self.spread_max:
+                    self.spread_max = spread
+            return b""
+        if mpp.__class__ is FecPacket:
+            self.mpp_list[key] = False
+            self.conflicts += 1
+            return b""
+        bit = 1 << fragment_part
+        received = mpp.received
+        if received & bit:
+            self.duplicates += 1
+            return b""
+
+        seen_last_fragment = mpp.last_part >= 0
+        if seen_last_fragment:
+            # the last fragment is already known, so this one must be before it
+            if last_fragment or fragment_part > mpp.last_part:
                 self.mpp_list[key] = False
+                self.conflicts += 1
                 return b""
-            seen_last_fragment = last_fragment or p_seen_last_frag
+        elif last_fragment and bit < received:
+            # a last fragment before a fragment we already have
+            self.mpp_list[key] = False
+            self.conflicts += 1
+            return b""
 
-            if seen_last_fragment and rec_nums == biggest_index_plus_one:
+        mpp.received = received | bit
+        mpp.last_tick = self.ticks
+        if last_fragment:
+            mpp.last_part = fragment_part
+        if fragment_part == mpp.contiguous:
+            buffer = mpp.buffer
+            buffer += data
+            contiguous = fragment_part + 1
+            pending = mpp.pending
+            if pending:
+                while contiguous in pending:
+                    buffer += pending.pop(contiguous)
+                    contiguous += 1
+                if not pending:
+                    mpp.pending = None
+            mpp.contiguous = contiguous
+            if contiguous == mpp.last_part + 1:
                 self.mpp_list[key] = True
-                return b"".join(mpp[:rec_nums])
+                self.completed += 1
+                self.fragments_per_packet.record(contiguous)
+                self.record_spread(key)
+                return buffer
+        else:
+            if mpp.pending is None:
+                mpp.pending = {}
+            mpp.pending[fragment_part] = data
+        return b""
 
-            mpp[-3] = rec_nums
-            if last_fragment:
-                mpp[-1] = True
-            if biggest_updated:
-                mpp[-2] = biggest_index_plus_one
-            return b""
+    def new_shard_event(self, key: int, fragment_part: int, n: int, k: int, data: bytes,
+                        epoch: int = 0) -> dict | None:
+        """
+        collects the fragments of a fec packet, returns {fragment_part: data} once n different fragments are received
+        """
+        mpp = self.mpp_list[key]
+        if mpp is None:
+            if self.ticks - self.first_ticks[key] < self.max_ticks and self.released_early(key, epoch):
+                return None
+        elif self.epochs[key] != epoch:
+            if (epoch - self.epochs[key]) % EPOCH_COUNT >= EPOCH_COUNT // 2:
+                self.stale += 1
+                return None
+            self.collisions += 1
+            mpp = None
+        if mpp is None:
+            self.new_key(key, epoch)
+            shards = {fragment_part: data}
+            if n == 1:
+                self.mpp_list[key] = True
+                self.completed += 1
+                self.fragments_per_packet.record(1)
+                return shards
+            self.mpp_list[key] = FecPacket(n, k, shards, self.ticks)
+            return None
+
+        if mpp.__class__ is not FecPacket:
+            if mpp.__class__ is PartialPacket:
+                self.mpp_list[key] = False
+                self.conflicts += 1
+            elif mpp is True:
+                self.duplicates += 1
+                self.record_spread(key)
+            return None
+        shards = mpp.shards
+        if mpp.n != n or mpp.k != k or len(data) != len(next(iter(shards.values()))):
+            self.mpp_list[key] = False
+            self.conflicts += 1
+            return None
+        if fragment_part in shards:
+            self.duplicates += 1
+            return None
+        shards[fragment_part] = data
+        mpp.last_tick = self.ticks
+        if len(shards) == n:
+            self.mpp_list[key] = True
+            self.completed += 1
+            self.fragments_per_packet.record(n)
+            self.record_spread(key)
+            return shards
+        return None
+
+    def new_fragment_event(self, data_offset: int, fragment_part: int, last_fragment: bool, chunk_data: bytes,
+                           packet_flags: int, codec, compressor) -> bytes | None:
+        """
+        reassembles a fragment as it came on the wire (its data offset with the epoch) and decodes the packet: returns
+        the packet once it is complete, else None. raises ValueError for an invalid fec header, and what the codec
+        or the decompressor raise for a packet that can not be decoded.
+        """
+        key = data_offset & (self.offsets_size - 1)
+        epoch = data_offset >> self.offset_bits
+        if packet_flags & PACKET_FEC:
+            n, k, chunk_data = get_fec_header(fragment_part, last_fragment, chunk_data)
+            shards = self.new_shard_event(key, fragment_part, n, k, chunk_data, epoch)
+            if not shards:
+                return None
+            data = get_fec_packet(shards, n, k, codec)
+        else:
+            data = self.new_data_event(key, fragment_part, last_fragment, chunk_data, epoch)
+            if not data:
+                return None
+            if not packet_flags & PACKET_BINARY:
+                data = codec.decode(data)
+        if packet_flags & PACKET_COMPRESSED:
+            data = compressor.decompress(data)
+        return data
+
+    def memory(self) -> dict:
+        """
+        what the kept keys hold, walks all of mpp_list (for on demand snapshots, not for the stats)
+        """
+        partial = fec = done = 0
+        buffered = 0
+        for entry in self.mpp_list:
+            if entry is None:
+                continue
+            if entry.__class__ is PartialPacket:
+                partial += 1
+                buffered += len(entry.buffer)
+                if entry.pending:
+                    buffered += sum(len(data) for data in entry.pending.values())
+            elif entry.__class__ is FecPacket:
+                fec += 1
+                buffered += sum(len(data) for data in entry.shards.values())
+            else:
+                done += 1
+        return {"partial": partial, "fec": fec, "done": done, "buffered_bytes": buffered,
+                "wheel_entries": sum(len(slot) for slot in self.wheel)}
+
+    def describe(self) -> dict:
+        return {"completed": self.completed, "timeouts": self.timeouts, "conflicts": self.conflicts,
+                "duplicates": self.duplicates, "collisions": self.collisions, "stale": self.stale, "late": self.late,
+                "assemble_time": self.assemble_time,
+                "fragments_per_packet": self.fragments_per_packet.describe()}
@@ -0,0 +1,271 @@
+import asyncio
+import ssl
+
+# dns over tcp and tls (rfc 7766, rfc 7858): every message has a 2 bytes length before it, a connection carries many
+# queries at once and the replies come back in any order (they are matched by query id)
+STREAM_CONNECT_TIMEOUT = 5.0
+# after a failed connect that connection is not opened again for this long, its queries go to the other ones
+STREAM_RECONNECT_DELAY = 1.0
+# queries written while the connection is being opened (and queries held while all connections are full), more are
+# dropped
+STREAM_MAX_PENDING = 65536
+STREAM_WRITE_BUFFER = 65536
+STREAM_IDLE_TIMEOUT = 120.0
+MAX_STREAM_MESSAGE = 65535
+
+
+def frame(message: bytes) -> bytes:
+    return len(message).to_bytes(2, "big") + message
+
+
+def unframe(buffer: bytearray) -> list[bytes]:
+    """
+    the complete messages at the start of buffer (they are removed from it), a partial one stays
+    """
+    messages = []
+    offset = 0
+    end = len(buffer)
+    while end - offset >= 2:
+        message_end = offset + 2 + (buffer[offset] << 8 | buffer[offset + 1])
+        if message_end > end:
+            break
+        messages.append(bytes(buffer[offset + 2:message_end]))
+        offset = message_end
+    if offset:
+        del buffer[:offset]
+    return messages
+
+
+def client_ssl_context(verify: bool) -> ssl.SSLContext:
+    context = ssl.create_default_context()
+    if not verify:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+class _StreamConnection(asyncio.Protocol):
+    def __init__(self, pool: "StreamPool") -> None:
+        self.pool = pool
+        self.transport = None
+        self.pending: list[bytes] = []
+        self.pending_size = 0
+        self.paused = False
+        self.closed = False
+        self.buffer = bytearray()
+
+    def connection_made(self, transport) -> None:
+        self.transport = transport
+        transport.set_write_buffer_limits(STREAM_WRITE_BUFFER)
+        if self.pending:
+            transport.write(b"".join(self.pending))
+            self.pending = []
+            self.pending_size = 0
+
+    def data_received(self, data: bytes) -> None:
+        self.buffer += data
+        replies = unframe(self.buffer)
+        if replies:
+            self.pool.on_reply(replies, self.pool.ip)
+
+    def connection_lost(self, exc) -> None:
+        self.closed = True
+        self.pool.lost(self)
+
+    def pause_writing(self) -> None:
+        self.paused = True
+
+    def resume_writing(self) -> None:
+        self.paused = False
+        self.pool.resumed()
+
+    def write(self, data: bytes) -> bool:
+        if self.transport is not None:
+            self.transport.write(data)
+            return True
+        if self.pending_size + len(data) > STREAM_MAX_PENDING:
+            return False
+        self.pending.append(data)
+        self.pending_size += len(data)
+        return True
+
+
+class StreamPool:
+    """
+    a few persistent tcp or tls connections to one resolver. send() writes a query to the next connection without
+    waiting for the reply, the replies go to on_reply(replies, ip). a connection is opened on its first query and
+    again after the resolver closes it (resolvers close idle connections), the queries in flight on a closed
+    connection are lost like udp queries. while all connections are full the queries are held and written on the
+    next resume.
+    """
+
+    def __init__(self, ip: str, port: int, connections: int, ssl_context: ssl.SSLContext | None,
+                 server_hostname: str | None, bind_ip: str, on_reply) -> None:
+        self.ip = ip
+        self.port = port
+        self.ssl_context = ssl_context
+        self.server_hostname = server_hostname
+        self.bind_ip = bind_ip
+        self.on_reply = on_reply
+        self.connections: list[_StreamConnection | None] = [None] * max(1, connections)
+        self.failed_until = [0.0] * len(self.connections)
+        self.next_index = 0
+        self.resume_waiter: asyncio.Future | None = None
+        self.held: list[bytes] = []  # framed queries, written when a connection resumes
+        self.held_size = 0
+        self.connects = 0
+        self.connect_errors = 0
+        self.dropped = 0
+
+    def _open(self, index: int) -> _StreamConnection:
+        connection = _StreamConnection(self)
+        self.connections[index] = connection
+        self.connects += 1
+        asyncio.create_task(self._connect(index, connection))
+        return connection
+
+    async def _connect(self, index: int, connection: _StreamConnection) -> None:
+        loop = asyncio.get_running_loop()
+        try:
+            await asyncio.wait_for(loop.create_connection(
+                lambda: connection, self.ip, self.port, ssl=self.ssl_context,
+                server_hostname=self.server_hostname if self.ssl_context is not None else None,
+                local_addr=(self.bind_ip, 0) if self.bind_ip else None), STREAM_CONNECT_TIMEOUT)
+        except Exception as e:
+            print("stream connect error:", self.ip, self.port, e)
+            self.connect_errors += 1
+            connection.closed = True
+            self.failed_until[index] = loop.time() + STREAM_RECONNECT_DELAY
+            if self.connections[index] is connection:
+                self.connections[index] = None
+            # the queries written to it go to the other connections
+            pending = connection.pending
+            connection.pending = []
+            connection.pending_size = 0
+            self._write_again(pending)
+
+    def lost(self, connection: _StreamConnection) -> None:
+        for i, c in enumerate(self.connections):
+            if c is connection:
+                self.connections[i] = None
+        self.resumed()
+
+    def resumed(self) -> None:
+        if self.held:
+            held = self.held
+            self.held = []
+            self.held_size = 0
+            self._write_again(held)
+            if self.held:
+                # they filled the connections again, the waiter waits for the next resume
+                return
+        if self.resume_waiter is not None and not self.resume_waiter.done():
+            self.resume_waiter.set_result(None)
+        self.resume_waiter = None
+
+    def _all_paused(self) -> bool:
+        return all(connection is not None and connection.paused for connection in self.connections)
+
+    def _hold(self, data: bytes) -> bool:
+        if self.held_size + len(data) > STREAM_MAX_PENDING:
+            return False
+        self.held.append(data)
+        self.held_size += len(data)
+        return True
+
+    def _write_again(self, queries: list[bytes]) -> None:
+        """
+        writes framed queries that their connection did not take to the others, or holds them if all are full
+        """
+        now = asyncio.get_running_loop().time()
+        for data in queries:
+            if not self._write(data, now) and not (self._all_paused() and self._hold(data)):
+                self.dropped += 1
+
+    def _write(self, data: bytes, now: float) -> bool:
+        connections = self.connections
+        for _ in range(len(connections)):
+            index = self.next_index
+            self.next_index = (index + 1) % len(connections)
+            connection = connections[index]
+            if connection is None:
+                if now < self.failed_until[index]:
+                    continue
+                connection = self._open(index)
+            elif connection.paused:
+                continue
+            if connection.write(data):
+                return True
+        return False
+
+    def send(self, query: bytes, now: float) -> asyncio.Future | None:
+        """
+        writes the query, returns a future to wait for before the next query if all connections are full (the query
+        is held and written when one of them resumes)
+        """
+        data = frame(query)
+        if self._write(data, now):
+            return None
+        if self._all_paused() and self._hold(data):
+            if self.resume_waiter is None:
+                self.resume_waiter = asyncio.get_running_loop().create_future()
+            return self.resume_waiter
+        self.dropped += 1
+        return None
+
+    def close(self) -> None:
+        for connection in self.connections:
+            if connection is not None and connection.transport is not None:
+                connection.transport.close()
+
+    def describe(self) -> dict:
+        return {"open": sum(1 for c in self.connections if c is not None and c.transport is not None),
+                "connects": self.connects, "connect_errors": self.connect_errors, "held": len(self.held),
+                "dropped": self.dropped}
+
+
+class _StreamServerConnection(asyncio.Protocol):
+    def __init__(self, on_queries) -> None:
+        self.on_queries = on_queries
+        self.transport = None
+        self.buffer = bytearray()
+        self.last_seen = 0.0
+        self.idle_handle = None
+
+    def connection_made(self, transport) -> None:
+        self.transport = transport
+        loop = asyncio.get_running_loop()
+        self.last_seen = loop.time()
+        self.idle_handle = loop.call_later(STREAM_IDLE_TIMEOUT, self.check_idle)
+
+    def check_idle(self) -> None:
+        loop = asyncio.get_running_loop()
+        idle = loop.time() - self.last_seen
+        if idle >= STREAM_IDLE_TIMEOUT:
+            self.transport.close()
+        else:
+            self.idle_handle = loop.call_later(STREAM_IDLE_TIMEOUT - idle, self.check_idle)
+
+    def data_received(self, data: bytes) -> None:
+        self.last_seen = asyncio.get_running_loop().time()
+        self.buffer += data
+        queries = unframe(self.buffer)
+        if queries:
+            responses = self.on_queries(queries, self.transport.get_extra_info("peername"))
+            if responses:
+                self.transport.write(b"".join(frame(response) for response in responses))
+
+    def connection_lost(self, exc) -> None:
+        if self.idle_handle is not None:
+            self.idle_handle.cancel()
+
+
+async def serve_stream(bind_addr: tuple, on_queries, reuse_port: bool = False,
+                       ssl_context: ssl.SSLContext | None = None) -> asyncio.AbstractServer:
+    """
+    accepts dns queries over tcp (or tls with ssl_context), on_queries(queries, addr) returns the responses of a
+    batch of queries of one connection, which are written back in one go
+    """
+    return await asyncio.get_running_loop().create_server(
+        lambda: _StreamServerConnection(on_queries), bind_addr[0], bind_addr[1], reuse_port=reuse_port or None,
+        ssl=ssl_context)
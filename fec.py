@@ -0,0 +1,115 @@
+"""
+systematic erasure code over GF(256): n data shards + k parity shards of the same size, any n of them rebuild the data.
+one parity shard is the xor of the data shards, more use the rows of a cauchy matrix (reed-solomon),
+every square part of it is invertible, so it does not matter which shards are lost.
+a shard is multiplied by a coefficient with bytes.translate and shards are added (xor) as big integers,
+so python only loops over shards, not over bytes.
+"""
+
+MAX_SHARDS = 64
+
+_GF_EXP = [0] * 512
+_GF_LOG = [0] * 256
+_x = 1
+for _i in range(255):
+    _GF_EXP[_i] = _x
+    _GF_LOG[_x] = _i
+    _x <<= 1
+    if _x & 0x100:
+        _x ^= 0x11D
+for _i in range(255, 512):
+    _GF_EXP[_i] = _GF_EXP[_i - 255]
+
+_mul_tables: dict[int, bytes] = {}
+
+
+def _gf_mul(a: int, b: int) -> int:
+    if a == 0 or b == 0:
+        return 0
+    return _GF_EXP[_GF_LOG[a] + _GF_LOG[b]]
+
+
+def _gf_inv(a: int) -> int:
+    return _GF_EXP[255 - _GF_LOG[a]]
+
+
+def _mul_table(c: int) -> bytes:
+    table = _mul_tables.get(c)
+    if table is None:
+        table = _mul_tables[c] = bytes(_gf_mul(c, x) for x in range(256))
+    return table
+
+
+def _coefficient(parity_index: int, data_index: int, n: int, k: int) -> int:
+    if k == 1:
+        return 1
+    # cauchy matrix: 1 / (x_j + y_i) with x_j = n + j and y_i = i, all distinct
+    return _gf_inv((n + parity_index) ^ data_index)
+
+
+def _combine(shards: list[bytes], coefficients: list[int], shard_size: int) -> bytes:
+    value = 0
+    for shard, c in zip(shards, coefficients):
+        if c == 0:
+            continue
+        if c != 1:
+            shard = shard.translate(_mul_table(c))
+        value ^= int.from_bytes(shard, "big")
+    return value.to_bytes(shard_size, "big")
+
+
+def encode_parity(shards: list[bytes], k: int) -> list[bytes]:
+    """
+    the k parity shards of the n data shards (all of the same size)
+    """
+    n = len(shards)
+    if n + k > MAX_SHARDS:
+        raise ValueError("too many shards")
+    shard_size = len(shards[0])
+    return [_combine(shards, [_coefficient(j, i, n, k) for i in range(n)], shard_size) for j in range(k)]
+
+
+def recover(shards: dict[int, bytes], n: int, k: int) -> list[bytes]:
+    """
+    the n data shards from at least n of the shards ({index: shard}, parity shards are n to n + k - 1)
+    """
+    if len(shards) < n:
+        raise ValueError("not enough shards")
+    missing = [i for i in range(n) if i not in shards]
+    if not missing:
+        return [shards[i] for i in range(n)]
+    shard_size = len(next(iter(shards.values())))
+    received_data = [i for i in range(n) if i in shards]
+    parity_indexes = [i for i in sorted(shards) if i >= n][:len(missing)]
+
+    # every used parity shard minus the received data shards is a combination of the missing shards only:
+    # p_j + sum(c_ji * d_i, received i) = sum(c_ji * d_i, missing i), solve it for the missing shards
+    rows = []
+    rhs = []
+    for p in parity_indexes:
+        j = p - n
+        rhs.append(_combine([shards[p]] + [shards[i] for i in received_data],
+                            [1] + [_coefficient(j, i, n, k) for i in received_data], shard_size))
+        rows.append([_coefficient(j, i, n, k) for i in missing])
+    inverse = _invert(rows)
+    return_shards = dict(shards)
+    for row_index, i in enumerate(missing):
+        return_shards[i] = _combine(rhs, inverse[row_index], shard_size)
+    return [return_shards[i] for i in range(n)]
+
+
+def _invert(matrix: list[list[int]]) -> list[list[int]]:
+    size = len(matrix)
+    m = [row[:] + [1 if i == j else 0 for j in range(size)] for i, row in enumerate(matrix)]
+    for col in range(size):
+        pivot = next((r for r in range(col, size) if m[r][col]), None)
+        if pivot is None:
+            raise ValueError("singular matrix")
+        m[col], m[pivot] = m[pivot], m[col]
+        inv = _gf_inv(m[col][col])
+        m[col] = [_gf_mul(v, inv) for v in m[col]]
+        for r in range(size):
+            if r != col and m[r][col]:
+                factor = m[r][col]
+                m[r] = [v ^ _gf_mul(factor, w) for v, w in zip(m[r], m[col])]
+    return [row[size:] for row in m]
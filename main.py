@@ -1,91 +1,353 @@
-# todo: DNS(rd=1,qdcount=2,qd=DNSQR(qname="example.com", qtype="A") / DNSQR(qname="example.net", qtype="AAAA"))
-# todo: test ips
-
+import argparse
 import asyncio
 import random
+import signal
 import socket
+import ssl
 import json
 import os
 import sys
+import time
 
-from data_handler import DataHandler
-from utility.base32 import b32decode_nopad
-from utility.dns import label_domain, encode_qname, build_dns_query, handle_dns_request, \
-    create_noerror_empty_response
-from data_cap import get_base32_final_domains, get_chunk_len, get_chunk_data
+from batch_io import BatchReceiver, sendto_all, set_use_mmsg
+from data_handler import DataHandler, EPOCH_COUNT
+from utility.codec import get_payload_codec
+from utility.dns import encode_qname, build_dns_query, create_noerror_empty_response, QueryTemplate, \
+    RecvDomainIndex, pack_questions, MAX_QUESTIONS, DATA_QTYPES, OPT_RR_SIZE, get_edns_udp_size, answer_capacity, \
+    create_data_response, get_answer_payload, renumber_queries, query_edns_udp_size
+from data_cap import get_base32_final_queries, get_chunk_len, get_chunk_data, PACKET_COMPRESSED, PACKET_BINARY, \
+    PACKET_COALESCED, get_fec_shard_size, get_fec_final_queries
+from compression import Compressor, load_dictionary
+from answer_data import AnswerQueue, iter_fragments
+from coalesce import Coalescer, unpack_datagrams, MAX_COALESCE_SIZE
+from send_scheduler import SendScheduler
+from send_queue import SendQueue
+from metrics import Metrics, stats_path, serve_stats, dump_stats_every
+from capture import Capture, H_DATAGRAM, WAN_QUERY
+from profiling import Profiler
+from send_socks import SendSocketPool, SEND_SOCK_TICK
+from dns_stream import StreamPool, client_ssl_context, serve_stream
+from sessions import SessionTable, SessionBackends, add_session, split_session
+from resolver_health import ResolverHealth
+from workers import create_inboxes, fork_workers, pack_fragment, unpack_fragment, pack_h_addr, unpack_h_addr, \
+    pack_session_addr, unpack_session_addr, pack_session_data, unpack_session_data, FRAGMENT_MESSAGE, H_ADDR_MESSAGE, \
+    SESSION_ADDR_MESSAGE, SESSION_DATA_MESSAGE, DEMAND_MESSAGE, pack_demand, unpack_demand, WorkerShare, SHARE_INTERVAL
 
 PACKETS_QUEUE_SIZE = 1024
 
-ASSEMBLE_TIME = 13.0
+CAPTURE_FLUSH_INTERVAL = 1.0
 
-DATA_OFFSET_WIDTH = 3
+QUEUE_REPORT_INTERVAL = 10.0
 
-TOTAL_DATA_OFFSET = 1 << 5 * DATA_OFFSET_WIDTH
-TOTAL_DATA_OFFSET_MINUS_ONE = TOTAL_DATA_OFFSET - 1
+RECV_BATCH_SIZE = 32
 
 
-def create_v4_udp_dgram_socket(blocking: bool, bind_addr: None | tuple) -> socket.socket:
+def create_v4_udp_dgram_socket(blocking: bool, bind_addr: None | tuple, reuse_port: bool = False) -> socket.socket:
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     s.setblocking(blocking)
+    if reuse_port:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     if bind_addr is not None:
         s.bind(bind_addr)
     return s
 
 
-async def accurate_sleep(delay: float):
-    loop = asyncio.get_running_loop()
-    now = loop.time()
-    while True:
-        await asyncio.sleep(0.0000001)
-        if loop.time() - now > delay:
-            return
-
+arg_parser = argparse.ArgumentParser()
+arg_parser.add_argument("--workers", type=int, default=1,
+                        help="number of worker processes that share the ports with SO_REUSEPORT")
+args = arg_parser.parse_args()
+workers_count = args.workers
+if workers_count < 1:
+    sys.exit("--workers must be at least 1")
+reuse_port = workers_count > 1
+worker_id = 0
+worker_inboxes: list[tuple[socket.socket, socket.socket]] = []
+# the part of the send budget of this worker (with --workers N), set in main()
+worker_share: WorkerShare | None = None
 
-with open(os.path.join(os.path.dirname(sys.argv[0]), "config.json")) as f:
+config_path = os.path.join(os.path.dirname(sys.argv[0]), "config.json")
+with open(config_path) as f:
     config = json.loads(f.read())
 
 packets_wait_time_limit = config["packets_wait_time_limit"]
 
-packets_send_interval = config["packets_send_interval"]
-
-if ((sys.platform == "win32") and (packets_send_interval < 0.1)) or (packets_send_interval < 0.001):
-    packets_send_sleep = accurate_sleep
-else:
-    packets_send_sleep = asyncio.sleep
+send_scheduler: SendScheduler | None = None
 
 send_query_type_int = config["send_query_type_int"]
 
+use_mmsg = config.get("use_mmsg", False)
+set_use_mmsg(use_mmsg)
+
 send_interface_ip_str = config["send_interface_ip"]
-send_sock_list = []
-# ulimit -n 32768
-for _ in range(config["send_sock_numbers"]):
-    send_sock_list.append(create_v4_udp_dgram_socket(False, (send_interface_ip_str, 0)))
+# the udp sockets that send the queries, set in main()
+send_socks: SendSocketPool | None = None
 
 wan_receive_bind_addr = (config["receive_interface_ip"], int(config["receive_port"]))
+# the queries can also come over tcp (same port) and tls (with a certificate)
+receive_tcp = config.get("receive_tcp", False)
+receive_tls_context: ssl.SSLContext | None = None
+if config.get("receive_tls_cert", ""):
+    receive_tls_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    try:
+        receive_tls_context.load_cert_chain(config["receive_tls_cert"], config.get("receive_tls_key", "") or None)
+    except (OSError, ssl.SSLError) as e:
+        sys.exit(f"cannot load receive_tls_cert: {e}")
+receive_tls_bind_addr = (config["receive_interface_ip"], int(config.get("receive_tls_port", 853)))
 
-dns_ips = config["dns_ips"]
-queues_list: list[asyncio.Queue] = []
+queues_list: list[SendQueue] = []
+send_queue_max_bytes = config.get("send_queue_max_bytes", 65536)
+send_queue_target = config.get("send_queue_target", 0.02)
+send_queue_interval = config.get("send_queue_interval", 0.1)
 
 h_inbound_bind_addr = (config["h_in_address"].rsplit(":", 1)[0], int(config["h_in_address"].rsplit(":", 1)[1]))
-h_inbound_socket = create_v4_udp_dgram_socket(False, h_inbound_bind_addr)
+h_inbound_socket: socket.socket | None = None
+d_handler: DataHandler | None = None
+
+stream_connections = config.get("stream_connections", 2)
+# the StreamPool of each tcp/tls resolver (None for udp), set in main()
+resolver_streams: list[StreamPool | None] = []
+# the resolver profile keys of the tcp/tls connections, a reload keeps the connections if none of them changed
+STREAM_PROFILE_KEYS = ("transport", "port", "connections", "tls_name", "tls_verify")
 
-max_encoded_domain_len = config["max_domain_len"] + 2
-if max_encoded_domain_len > 255:
-    sys.exit("the maximum domain length is 253 bytes")
-max_sub_len = config["max_sub_len"]
-if max_sub_len > 63:
-    sys.exit("max_sub_len cannot be greater than 63!")
+try:
+    payload_codec = get_payload_codec(config.get("payload_codec", "base32"))
+except ValueError as e:
+    sys.exit(str(e))
+
+# data for the other side waits for its queries and is sent in their answers
+answer_queue: AnswerQueue | None = None
+if config.get("answer_data", False):
+    answer_queue = AnswerQueue(config.get("answer_hold_time", 0.05), PACKETS_QUEUE_SIZE)
+answer_max_size = config.get("answer_max_size", 1232)
+
+use_compression = config.get("compression", False)
+try:
+    # the other side may compress even if we do not, so the dictionary is always loaded
+    compressor = Compressor(dictionary=load_dictionary(config.get("compression_dictionary", "")))
+except OSError as e:
+    sys.exit(f"cannot read compression_dictionary: {e}")
 
 tries = config["retries"] + 1
-all_recv_domains_labels = []
-for recv_domain in config["recv_domains"]:
-    all_recv_domains_labels.append(label_domain(recv_domain.encode().lower()))
 
-send_doms_with_chunk_len_list = []
-for send_domain in config["send_domains"]:
-    sdeq = encode_qname(send_domain.encode().lower())
-    send_doms_with_chunk_len_list.append(
-        (sdeq, get_chunk_len(max_encoded_domain_len, len(sdeq), max_sub_len, DATA_OFFSET_WIDTH)))
+# both sides must use the same data_offset_width and data_offset_epoch.
+# every data offset is used again after TOTAL_DATA_OFFSET packets, that must take longer than the assembly time
+data_offset_width = config.get("data_offset_width", 3)
+if not 2 <= data_offset_width <= 4:
+    sys.exit("data_offset_width must be 2, 3 or 4")
+TOTAL_DATA_OFFSET = 1 << 5 * data_offset_width
+TOTAL_DATA_OFFSET_MINUS_ONE = TOTAL_DATA_OFFSET - 1
+# one more character in front of the data offset: how many times the sender went through all of them (mod 32),
+# so a reused data offset whose old packet is still kept is detected instead of mixed with it
+use_data_offset_epoch = config.get("data_offset_epoch", False)
+data_offset_chars = data_offset_width + 1 if use_data_offset_epoch else data_offset_width
+MAX_WIRE_DATA_OFFSET = (1 << 5 * data_offset_chars) - 1
+data_offset_shift = 5 * data_offset_width
+assemble_time = config.get("assemble_time", 13.0)
+# below assemble_time the assembly time adapts to the fragment spread (opt in)
+min_assemble_time = min(config.get("min_assemble_time", assemble_time), assemble_time)
+
+# parity fragments per data fragment, 0: no fec, lost fragments are only covered by retries
+fec_redundancy = config.get("fec_redundancy", 0)
+
+
+def make_send_templates(send_domains: list, limits: tuple[int, int, int]) -> tuple[list, int]:
+    """
+    the query templates of the send domains for fragments that fit these qname limits (and with this EDNS0 udp size,
+    0 for none), and their fec shard size
+    """
+    encoded_domain_len, sub_len, edns_udp_size = limits
+    templates = [(QueryTemplate(sdeq, send_query_type_int, sub_len, edns_udp_size),
+                  get_chunk_len(encoded_domain_len, len(sdeq), sub_len, data_offset_chars)) for sdeq, _ in
+                 send_domains]
+    shard_size = 0
+    if fec_redundancy > 0:
+        # every fragment of a fec packet has the same size, so it must fit the shortest send domain
+        shard_size = get_fec_shard_size(min(chunk_len for _, chunk_len in templates), payload_codec)
+    return templates, shard_size
+
+
+def get_send_templates(limits: tuple[int, int, int]) -> tuple[list, int]:
+    cached = send_templates_cache.get(limits)
+    if cached is None:
+        cached = send_templates_cache[limits] = make_send_templates(send_doms_with_chunk_len_list, limits)
+    return cached
+
+
+def parse_resolver_profile(ip: str, profile: dict, max_encoded_domain_len: int, max_sub_len: int,
+                           edns: bool) -> dict:
+    """
+    the profile of a resolver with every value checked and the defaults filled in, raises ValueError if a value is
+    invalid. it is parsed before a (re)load changes anything, so nothing fails after that
+    """
+    if not isinstance(profile, dict):
+        raise ValueError(f"the resolver profile of {ip} must be an object")
+    transport = profile.get("transport", "udp")
+    if transport not in ("udp", "tcp", "tls"):
+        raise ValueError(f"the resolver profile of {ip}: transport must be udp, tcp or tls")
+    for key in ("tls_verify", "edns"):
+        if not isinstance(profile.get(key, True), bool):
+            raise ValueError(f"the resolver profile of {ip}: {key} must be true or false")
+    try:
+        parsed = dict(profile,
+                      max_domain_len=int(profile.get("max_domain_len", max_encoded_domain_len - 2)),
+                      max_sub_len=int(profile.get("max_sub_len", max_sub_len)),
+                      questions=min(max(int(profile.get("questions", 1)), 1), MAX_QUESTIONS),
+                      rate=float(profile.get("rate", 0)),
+                      transport=transport,
+                      port=int(profile.get("port", 853 if transport == "tls" else 53)),
+                      connections=int(profile.get("connections", stream_connections)),
+                      tls_name=str(profile.get("tls_name", ip)),
+                      tls_verify=profile.get("tls_verify", True),
+                      edns=profile.get("edns", edns))
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"the resolver profile of {ip}: {e}") from None
+    # the global options are the most any resolver gets, a profile (for example written by probe.py before the global
+    # options were lowered) is lowered to them
+    parsed["max_domain_len"] = min(parsed["max_domain_len"], max_encoded_domain_len - 2)
+    parsed["max_sub_len"] = min(parsed["max_sub_len"], max_sub_len)
+    if parsed["rate"] < 0:
+        raise ValueError(f"the resolver profile of {ip}: rate cannot be negative")
+    if not 0 < parsed["port"] < 65536:
+        raise ValueError(f"the resolver profile of {ip}: port must be between 1 and 65535")
+    if parsed["connections"] < 1:
+        raise ValueError(f"the resolver profile of {ip}: connections must be at least 1")
+    return parsed
+
+
+def load_resolver_settings(new_config: dict):
+    """
+    sets what a reload can change: the resolvers and their profiles, the domains, the qname limits and the pacing.
+    raises ValueError if they are invalid, then nothing is changed
+    """
+    global packets_send_rate
+    global packets_send_burst
+    global dns_ips
+    global resolver_profiles
+    global resolver_questions
+    global max_encoded_domain_len
+    global max_sub_len
+    global resolver_qname_limits
+    global resolver_transports
+    global resolver_send_rates
+    global recv_domain_index
+    global send_doms_with_chunk_len_list
+    global send_templates_cache
+    global smallest_qname_limits
+    global resolver_send_templates
+    new_dns_ips = list(new_config["dns_ips"])
+    if not new_dns_ips:
+        raise ValueError("dns_ips is empty")
+    if len(set(new_dns_ips)) != len(new_dns_ips):
+        raise ValueError("dns_ips has duplicates")
+    if not new_config["send_domains"]:
+        raise ValueError("send_domains is empty")
+    new_send_rate = new_config.get("packets_send_rate", 0)
+    if not new_send_rate and new_config["packets_send_interval"] > 0:
+        new_send_rate = 1 / new_config["packets_send_interval"]
+    new_max_encoded_domain_len = new_config["max_domain_len"] + 2
+    if new_max_encoded_domain_len > 255:
+        raise ValueError("the maximum domain length is 253 bytes")
+    new_max_sub_len = new_config["max_sub_len"]
+    if new_max_sub_len > 63:
+        raise ValueError("max_sub_len cannot be greater than 63!")
+    # what each resolver supports (written by probe.py), for example {"1.2.3.4": {"questions": 2, "max_domain_len":
+    # 99}}, resolvers that are not listed and keys that are missing get the global settings
+    config_profiles = new_config.get("resolver_profiles", {})
+    if not isinstance(config_profiles, dict):
+        raise ValueError("resolver_profiles must be an object")
+    # with edns (opt in, for an other side with answer_data) the queries advertise answer_max_size with EDNS0, so the
+    # resolver does not truncate the answers to 512 bytes, a resolver profile can turn it on or off for one resolver
+    new_edns = new_config.get("edns", False)
+    if not isinstance(new_edns, bool):
+        raise ValueError("edns must be true or false")
+    new_profiles = {ip: parse_resolver_profile(ip, config_profiles.get(ip, {}), new_max_encoded_domain_len,
+                                               new_max_sub_len, new_edns) for ip in new_dns_ips}
+    # (max_encoded_domain_len, max_sub_len, edns udp size) of each resolver
+    new_qname_limits = []
+    for ip in new_dns_ips:
+        profile = new_profiles[ip]
+        new_qname_limits.append((profile["max_domain_len"] + 2, profile["max_sub_len"],
+                                 query_edns_udp_size(send_query_type_int, answer_max_size, profile["edns"])))
+    # "udp" (default), "tcp" or "tls": how the queries go to each resolver, tcp and tls keep a few connections open
+    new_transports = [new_profiles[ip]["transport"] for ip in new_dns_ips]
+    new_send_domains = []
+    for send_domain in new_config["send_domains"]:
+        sdeq = encode_qname(send_domain.encode().lower())
+        new_send_domains.append(
+            (sdeq, get_chunk_len(new_max_encoded_domain_len, len(sdeq), new_max_sub_len, data_offset_chars)))
+    # {(max_encoded_domain_len, max_sub_len): (send templates with chunk len, fec shard size)}
+    new_templates_cache = {}
+    for limits in new_qname_limits + [(new_max_encoded_domain_len, new_max_sub_len,
+                                       query_edns_udp_size(send_query_type_int, answer_max_size, new_edns))]:
+        if limits not in new_templates_cache:
+            new_templates_cache[limits] = make_send_templates(new_send_domains, limits)
+    # the fragments of a packet that is sent to several resolvers (retries) fit the smallest limits of them, and the
+    # queries only have an OPT record if all of them take it
+    new_smallest_limits = (min(limits[0] for limits in new_templates_cache),
+                           min(limits[1] for limits in new_templates_cache),
+                           min(limits[2] for limits in new_templates_cache))
+    if new_smallest_limits not in new_templates_cache:
+        new_templates_cache[new_smallest_limits] = make_send_templates(new_send_domains, new_smallest_limits)
+    new_recv_domain_index = RecvDomainIndex([recv_domain.encode() for recv_domain in new_config["recv_domains"]])
+    new_send_burst = float(new_config.get("packets_send_burst", 1))
+
+    packets_send_rate = new_send_rate
+    packets_send_burst = new_send_burst
+    dns_ips = new_dns_ips
+    resolver_profiles = new_profiles
+    # fragments per query (qdcount), most resolvers drop queries with more than one question
+    resolver_questions = [new_profiles[ip]["questions"] for ip in new_dns_ips]
+    max_encoded_domain_len = new_max_encoded_domain_len
+    max_sub_len = new_max_sub_len
+    resolver_qname_limits = new_qname_limits
+    resolver_transports = new_transports
+    # packets per second of each resolver, with --workers N it is split between them (worker_send_rates)
+    resolver_send_rates = [new_profiles[ip]["rate"] or new_send_rate for ip in new_dns_ips]
+    recv_domain_index = new_recv_domain_index
+    send_doms_with_chunk_len_list = new_send_domains
+    send_templates_cache = new_templates_cache
+    smallest_qname_limits = new_smallest_limits
+    resolver_send_templates = [new_templates_cache[limits] for limits in new_qname_limits]
+
+
+try:
+    load_resolver_settings(config)
+except ValueError as e:
+    sys.exit(str(e))
+resolver_health = ResolverHealth(dns_ips, config.get("resolver_reply_timeout", 2.0),
+                                 config.get("resolver_quarantine_time", 30.0))
+
+# small datagrams wait up to coalesce_time to share one packet with the next ones
+coalesce_time = config.get("coalesce_time", 0)
+coalesce_max_size = 0
+# {flow: coalescer}, the datagrams of each session are coalesced on their own, so they stay in their own flow
+coalescers: dict[int, Coalescer] = {}
+coalesce_timers: dict[int, asyncio.TimerHandle] = {}
+if coalesce_time > 0:
+    # by default as much as fits in one fragment of the shortest send domain
+    coalesce_max_size = config.get("coalesce_max_size", 0) or int(
+        min(chunk_len for _, chunk_len in get_send_templates(smallest_qname_limits)[0]) *
+        payload_codec.bits_per_char / 8)
+
+metrics = Metrics()
+# a json reply to any datagram sent to stats_address (worker i listens on its port + i),
+# and/or a json file that is rewritten every stats_interval seconds
+stats_address = config.get("stats_address", "")
+# without stats_token only loopback senders are answered (the replies are much bigger than the datagrams, so an open
+# port would be a udp amplification reflector), with it the datagrams must start with the token from any sender
+stats_token = config.get("stats_token", "")
+stats_file = config.get("stats_file", "")
+stats_interval = config.get("stats_interval", 10.0)
+# the received h side datagrams and DNS-Queries are written to this file (for bench/bench_replay.py)
+capture_file = config.get("capture_file", "")
+capture_max_bytes = config.get("capture_max_bytes", 100 << 20)
+capture: Capture | None = None
+# profiles and tracemalloc snapshots (started with signals or stats_address commands) are written to this directory
+profile_dir = config.get("profile_dir", "") or os.path.join(os.path.dirname(os.path.abspath(sys.argv[0])), "profiles")
+profiler: Profiler | None = None
+# the time of each packet stage in the statistics (metrics.stage_*), "timing on"/"timing off" on stats_address
+stage_timing = config.get("stage_timing", False)
+start_time = time.time()
 
 use_fixed_h_addr = False
 last_h_addr = None
@@ -93,57 +355,287 @@ if config["h_out_address"]:
     last_h_addr = (config["h_out_address"].rsplit(":", 1)[0], int(config["h_out_address"].rsplit(":", 1)[1]))
     use_fixed_h_addr = True
 
+# several h side clients on one tunnel, every datagram carries a session id, both sides must set it
+use_sessions = config.get("sessions", False)
+session_timeout = config.get("session_timeout", 120.0)
+# the side with h_out_address spreads the sessions over these addresses instead
+session_backend_addrs = [(addr.rsplit(":", 1)[0], int(addr.rsplit(":", 1)[1])) for addr in
+                         config.get("session_backends", [])]
+session_table: SessionTable | None = None
+session_backends: SessionBackends | None = None
+
+
+def send_sock_count(send_sock_numbers: int) -> int:
+    # the workers split the send socket pool, it is not needed if all resolvers use tcp/tls (but one socket is kept)
+    if "udp" not in resolver_transports:
+        send_sock_numbers = 1
+    if worker_share is None:
+        return max(1, send_sock_numbers // workers_count)
+    return max(1, int(send_sock_numbers * worker_share.share))
+
 
-async def wan_send_from_queue(queue: asyncio.Queue):
+def worker_send_rates() -> list[float]:
+    # the rate of each resolver for this worker: the workers split it by their demand (0 stays unlimited)
+    if worker_share is None:
+        return resolver_send_rates
+    return [rate * worker_share.share for rate in resolver_send_rates]
+
+
+def apply_worker_share():
+    send_scheduler.set_rates(worker_send_rates(), packets_send_burst, list(range(len(dns_ips))))
+    max_socks = send_sock_count(config["send_sock_numbers"])
+    if max_socks != send_socks.max_socks:
+        send_socks.set_limits(max_socks, send_socks.sock_rate, send_socks.rotate_time, send_socks.linger)
+
+
+async def share_send_budget():
     loop = asyncio.get_running_loop()
     while True:
-        send_socks_datas, send_ip_str, entry_time, curr_try = await queue.get()
+        await asyncio.sleep(SHARE_INTERVAL)
+        now = loop.time()
+        broadcast_to_workers(pack_demand(worker_id, worker_share.tick(now)))
+        old_share = worker_share.share
+        if worker_share.update(now) != old_share:
+            apply_worker_share()
+
+
+def open_sockets():
+    global h_inbound_socket
+    h_inbound_socket = create_v4_udp_dgram_socket(False, h_inbound_bind_addr, reuse_port)
+
+
+def handle_reply(data: bytes, ip: str, now: float, h_datas: list):
+    resolver_health.on_reply(data, ip, now)
+    if len(data) >= 12 and (data[6] or data[7]):
+        # the other side sent data in the answers
+        try:
+            for data_offset, fragment_part, last_fragment, chunk_data, packet_flags in iter_fragments(
+                    get_answer_payload(data)):
+                if data_offset > MAX_WIRE_DATA_OFFSET or fragment_part > 63 or (
+                        fragment_part == 63 and not last_fragment):
+                    raise ValueError("invalid answer fragment")
+                dispatch_fragment(data_offset, fragment_part, last_fragment, chunk_data,
+                                  packet_flags | PACKET_BINARY, h_datas)
+        except Exception:
+            metrics.invalid_answers += 1
+
+
+def on_send_sock_readable(sock: socket.socket):
+    now = asyncio.get_running_loop().time()
+    h_datas = []
+    while True:
+        try:
+            data, addr = sock.recvfrom(65575)
+        except (BlockingIOError, InterruptedError):
+            break
+        except OSError:
+            break
+        handle_reply(data, addr[0], now, h_datas)
+    if h_datas:
+        asyncio.create_task(send_to_h(h_datas))
+
+
+def on_stream_replies(replies: list, ip: str):
+    now = asyncio.get_running_loop().time()
+    h_datas = []
+    for data in replies:
+        handle_reply(data, ip, now, h_datas)
+    if h_datas:
+        asyncio.create_task(send_to_h(h_datas))
+
+
+def send_probe(send_ip_index: int):
+    global query_id
+    # the leading "0" is never a valid data offset character, the other side just answers NOERROR
+    probe_label = b"0" + bytes(random.choice(b"abcdefghijklmnopqrstuvwxyz234567") for _ in range(7))
+    sdeq, _ = random.choice(send_doms_with_chunk_len_list)
+    # the query id comes from the counter of the data queries, so it is not the id of a query in flight
+    query = build_dns_query(bytes((len(probe_label),)) + probe_label + sdeq, query_id, send_query_type_int)
+    query_id = (query_id + 1) & 0xFFFF
+    now = asyncio.get_running_loop().time()
+    if resolver_streams[send_ip_index] is not None:
+        resolver_streams[send_ip_index].send(query, now)
+    else:
+        try:
+            send_socks.next().sock.sendto(query, (dns_ips[send_ip_index], 53))
+        except OSError as e:
+            print("probe send error:", e, dns_ips[send_ip_index])
+            return
+    resolver_health.on_sent(send_ip_index, query, now)
+
+
+def stats_snapshot() -> dict:
+    return {
+        "worker": worker_id,
+        "send_share": round(worker_share.share, 3) if worker_share is not None else None,
+        "time": round(time.time(), 3),
+        "uptime": round(time.time() - start_time, 3),
+        "data": metrics.describe(),
+        "reassembly": d_handler.describe(),
+        "send_socks": send_socks.describe(),
+        "answer_queue": len(answer_queue.packets) if answer_queue is not None else None,
+        "sessions": len(session_table if session_table is not None else session_backends) if use_sessions else None,
+        "resolvers": {ip: dict(resolver_health.describe(i), queue=queues_list[i].describe(True),
+                               stream=resolver_streams[i].describe() if resolver_streams[i] is not None else None)
+                      for i, ip in enumerate(dns_ips)},
+    }
+
+
+async def report_queues():
+    last_drops = {}
+    while True:
+        await asyncio.sleep(QUEUE_REPORT_INTERVAL)
+        for ip, queue in zip(dns_ips, queues_list):
+            drops = queue.dropped_overflow + queue.dropped_codel + queue.dropped_delayed
+            if drops != last_drops.get(ip, 0):
+                last_drops[ip] = drops
+                print("send queue drops:", ip, queue.describe())
+
+
+async def wan_send_from_queue(queue: SendQueue, send_ip_str: str):
+    loop = asyncio.get_running_loop()
+    send_addr = (send_ip_str, 53)
+    while True:
+        queries, entry_time, curr_try = await queue.get()
         if loop.time() - entry_time > packets_wait_time_limit:
-            print("drop delayed packet")
+            queue.dropped_delayed += 1
             continue
 
         if curr_try & 1 == 0:
-            iter_range = range(len(send_socks_datas))
+            iter_range = range(len(queries))
         else:
-            iter_range = range(len(send_socks_datas) - 1, -1, -1)
+            iter_range = range(len(queries) - 1, -1, -1)
 
         for i in iter_range:
-            send_sock_index, send_sock, data = send_socks_datas[i]
+            data = queries[i]
+            # the index of the resolver changes when a reload adds or removes others
+            send_ip_index = resolver_indexes[send_ip_str]
+            waiter = send_scheduler.acquire(send_ip_index)
+            if waiter is not None:
+                wait_start = time.perf_counter() if stage_timing else 0.0
+                await waiter
+                if wait_start:
+                    metrics.stage_pacing_wait.record(time.perf_counter() - wait_start)
+                send_ip_index = resolver_indexes[send_ip_str]
+            send_start = time.perf_counter() if stage_timing else 0.0
+            stream = resolver_streams[send_ip_index]
+            if stream is not None:
+                now = loop.time()
+                waiter = stream.send(data, now)
+                resolver_health.on_sent(send_ip_index, data, now)
+                if send_start:
+                    metrics.stage_wan_send.record(time.perf_counter() - send_start)
+                if waiter is not None:
+                    await waiter
+                continue
             try:
-                await loop.sock_sendto(send_sock, data, (send_ip_str, 53))
+                pool_sock = send_socks.next()
+            except OSError as e:
+                print("wan_send_sock create error:", e)
+                continue
+            try:
+                try:
+                    pool_sock.sock.sendto(data, send_addr)
+                except (BlockingIOError, InterruptedError):
+                    await loop.sock_sendto(pool_sock.sock, data, send_addr)
+                if send_start:
+                    metrics.stage_wan_send.record(time.perf_counter() - send_start)
             except Exception as e:
-                print("wan_send_sock send error:", e, send_ip_str, send_sock)
-                send_sock.close()
-                while True:
-                    await asyncio.sleep(packets_wait_time_limit)
-                    if send_sock_list[send_sock_index] != send_sock:
-                        break
-                    try:
-                        send_sock_list[send_sock_index] = create_v4_udp_dgram_socket(False, (send_interface_ip_str, 0))
-                    except Exception as e:
-                        print("wan_send_sock create error:", e)
-                        continue
-                    break
+                # the socket is replaced in the pool, the next queries go on without waiting for it
+                print("wan_send_sock send error:", e, send_ip_str, pool_sock.port)
+                send_socks.failed(pool_sock)
+                metrics.socket_recreations += 1
+                continue
+            resolver_health.on_sent(resolver_indexes[send_ip_str], data, loop.time())
+
+
+# the sending state of this worker, set in main()
+query_id = 0
+data_offset = 0
+data_offset_epoch = 0
+send_domain_index = 0
+
+
+def next_data_offset() -> int:
+    global data_offset
+    global data_offset_epoch
+    packet_data_offset = data_offset
+    if use_data_offset_epoch:
+        packet_data_offset |= data_offset_epoch << data_offset_shift
+    # each worker only uses the offsets that are equal to its id modulo the workers count
+    data_offset += workers_count
+    if data_offset > TOTAL_DATA_OFFSET_MINUS_ONE:
+        data_offset = worker_id
+        data_offset_epoch = (data_offset_epoch + 1) % EPOCH_COUNT
+    return packet_data_offset
+
+
+def send_in_queries(raw_data: bytes, packet_data_offset: int, packet_flags: int, flow: int = 0):
+    global query_id
+    global send_domain_index
+    # the resolvers of all tries are chosen first, the fragments are sized for them
+    send_ip_indexes = []
+    for _ in range(tries):
+        send_ip_index = resolver_health.next_resolver()
+        for _ in range(len(dns_ips)):
+            # retries go to other resolvers while there are any
+            if send_ip_index not in send_ip_indexes:
                 break
-            await packets_send_sleep(packets_send_interval)
+            send_ip_index = resolver_health.next_resolver()
+        send_ip_indexes.append(send_ip_index)
+    if len(send_ip_indexes) == 1:
+        send_templates, fec_shard_size = resolver_send_templates[send_ip_indexes[0]]
+    else:
+        send_templates, fec_shard_size = get_send_templates(
+            (min(resolver_qname_limits[i][0] for i in send_ip_indexes),
+             min(resolver_qname_limits[i][1] for i in send_ip_indexes),
+             min(resolver_qname_limits[i][2] for i in send_ip_indexes)))
+    if fec_shard_size:
+        queries = get_fec_final_queries(raw_data, packet_data_offset, send_domain_index, send_templates,
+                                        data_offset_chars, query_id, fec_shard_size, fec_redundancy, payload_codec,
+                                        packet_flags)
+    else:
+        queries = get_base32_final_queries(raw_data, packet_data_offset, send_domain_index, send_templates,
+                                           data_offset_chars, query_id, payload_codec, packet_flags)
+    if not queries:
+        return
+    metrics.packets_sent += 1
+    metrics.fragments_per_packet.record(len(queries))
+    send_domain_index = (send_domain_index + len(queries)) % len(send_doms_with_chunk_len_list)
+    # every try gets its own query ids, so the replies of each try are matched to the resolver it went to
+    first_query_id = query_id
+    query_id = (query_id + len(queries) * len(send_ip_indexes)) & 0xFFFF
+    # the send socket of each query is chosen when it is sent
+    queries_size = sum(len(query) for query in queries)
+
+    now = asyncio.get_running_loop().time()
+    for curr_try, send_ip_index in enumerate(send_ip_indexes):
+        try_queries = queries
+        if curr_try:
+            try_queries = renumber_queries(queries, first_query_id + curr_try * len(queries))
+        questions = resolver_questions[send_ip_index]
+        if questions > 1 and len(queries) > 1:
+            # resolvers that take several questions in one query
+            try_queries = pack_questions(try_queries, questions)
+            queues_list[send_ip_index].put(now, (try_queries, now, curr_try),
+                                           sum(len(query) for query in try_queries), flow)
+        else:
+            queues_list[send_ip_index].put(now, (try_queries, now, curr_try), queries_size, flow)
+        if worker_share is not None:
+            worker_share.add(len(try_queries))
 
 
 async def h_recv():
     loop = asyncio.get_running_loop()
     global h_inbound_socket
     global last_h_addr
-    send_sock_index = random.randint(0, len(send_sock_list) - 1)
-    query_id = random.randint(0, 65535)
-    data_offset = random.randint(0, TOTAL_DATA_OFFSET_MINUS_ONE)
-    send_ip_index = random.randint(0, len(dns_ips) - 1)
-    queue_index = random.randint(0, len(queues_list) - 1)
-    send_domain_index = random.randint(0, len(send_doms_with_chunk_len_list) - 1)
+    h_receiver = None
     while True:
         use_h_inbound_socket = h_inbound_socket
+        if h_receiver is None or h_receiver.sock is not use_h_inbound_socket:
+            h_receiver = BatchReceiver(use_h_inbound_socket, RECV_BATCH_SIZE, use_mmsg=use_mmsg)
         try:
-            raw_data, addr_h = await loop.sock_recvfrom(use_h_inbound_socket, 65575)
-            if not addr_h:
-                raise ValueError("h inbound socket no addr!")
+            datagrams = await h_receiver.recv_batch()
         except Exception as e:
             print("h_inbound_socket recv error:", e)
             use_h_inbound_socket.close()
@@ -151,156 +643,613 @@ async def h_recv():
                 if h_inbound_socket != use_h_inbound_socket:
                     break
                 try:
-                    h_inbound_socket = create_v4_udp_dgram_socket(False, h_inbound_bind_addr)
+                    h_inbound_socket = create_v4_udp_dgram_socket(False, h_inbound_bind_addr, reuse_port)
                 except Exception as e:
                     print("h_inbound_socket create error:", e)
                     await asyncio.sleep(1)
                     continue
+                metrics.socket_recreations += 1
                 break
             continue
 
-        if use_fixed_h_addr:
-            if addr_h != last_h_addr:
+        stage_start = time.perf_counter() if stage_timing else 0.0
+        metrics.h_received += len(datagrams)
+        if capture is not None:
+            capture.write(H_DATAGRAM, [raw_data for raw_data, _ in datagrams], loop.time())
+        if session_table is not None:
+            now = loop.time()
+            for raw_data, addr_h in datagrams:
+                session_id, new_session = session_table.session_of(addr_h, now)
+                if session_id < 0:
+                    metrics.sessions_full += 1
+                    continue
+                if new_session:
+                    print("new session:", session_id, addr_h)
+                    broadcast_to_workers(pack_session_addr(session_id, addr_h))
+                if raw_data:
+                    send_h_data(add_session(session_id, raw_data), session_id)
+        else:
+            for raw_data, addr_h in datagrams:
+                if use_fixed_h_addr:
+                    if addr_h != last_h_addr:
+                        continue
+                elif last_h_addr != addr_h:
+                    last_h_addr = addr_h
+                    print("the received data is sent to:", addr_h)
+                    broadcast_to_workers(pack_h_addr(addr_h))
+
+                if raw_data:
+                    send_h_data(raw_data, 0)
+        if stage_start:
+            metrics.stage_h_recv.record(time.perf_counter() - stage_start)
+
+
+def send_h_data(raw_data: bytes, flow: int):
+    """
+    sends a datagram of the h side to the other side, small ones wait in the coalescer.
+    flow: the session, the sessions share the send queues fairly
+    """
+    if coalesce_max_size:
+        coalescer = coalescers.get(flow)
+        if coalescer is None:
+            coalescer = coalescers[flow] = Coalescer(coalesce_max_size)
+        if coalescer.fits(raw_data):
+            loop = asyncio.get_running_loop()
+            if not coalescer:
+                coalesce_timers[flow] = loop.call_later(coalesce_time, flush_coalescer, flow)
+            waiting = coalescer.add(raw_data)
+            if waiting is not None:
+                coalesce_timers[flow].cancel()
+                coalesce_timers[flow] = loop.call_later(coalesce_time, flush_coalescer, flow)
+                send_packet(*waiting, flow)
+            return
+        # the waiting datagrams go first
+        flush_coalescer(flow)
+    send_packet(raw_data, False, flow)
+
+
+def on_session_reply(session_id: int, datagrams: list):
+    metrics.h_received += len(datagrams)
+    if capture is not None:
+        capture.write(H_DATAGRAM, datagrams, asyncio.get_running_loop().time())
+    for datagram in datagrams:
+        if datagram:
+            send_h_data(add_session(session_id, datagram), session_id)
+
+
+async def expire_sessions():
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(session_timeout / 4)
+        if session_table is not None:
+            session_table.expire(loop.time())
+            for session_id, addr_h in session_table.announcements(loop.time()):
+                broadcast_to_workers(pack_session_addr(session_id, addr_h))
+        if session_backends is not None:
+            session_backends.expire(loop.time())
+
+
+def send_packet(raw_data: bytes, coalesced: bool, flow: int = 0):
+    packet_flags = PACKET_COALESCED if coalesced else 0
+    if use_compression:
+        compressed = compressor.compress(raw_data)
+        if compressed is not None:
+            raw_data = compressed
+            packet_flags |= PACKET_COMPRESSED
+    packet_data_offset = next_data_offset()
+    if answer_queue is not None:
+        if answer_queue.put(asyncio.get_running_loop().time(), packet_data_offset, raw_data, packet_flags):
+            metrics.packets_answered += 1
+            return
+        metrics.answer_queue_full += 1
+    send_in_queries(raw_data, packet_data_offset, packet_flags, flow)
+
+
+def flush_coalescer(flow: int):
+    timer = coalesce_timers.pop(flow, None)
+    if timer is not None:
+        timer.cancel()
+    # an empty coalescer is not kept, so the ones of ended sessions do not pile up
+    coalescer = coalescers.pop(flow, None)
+    if coalescer is not None:
+        waiting = coalescer.take()
+        if waiting is not None:
+            send_packet(*waiting, flow)
+
+
+async def answer_queue_expire():
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(answer_queue.hold_time / 2)
+        for packet_data_offset, raw_data, packet_flags in answer_queue.expired(loop.time()):
+            if packet_data_offset < 0:
+                packet_data_offset = next_data_offset()
+            send_in_queries(raw_data, packet_data_offset, packet_flags)
+
+
+async def send_to_h(h_datas: list):
+    global h_inbound_socket
+    metrics.h_sent += len(h_datas)
+    use_h_inbound_socket = h_inbound_socket
+    try:
+        stage_start = time.perf_counter() if stage_timing else 0.0
+        await sendto_all(use_h_inbound_socket, h_datas)
+        if stage_start:
+            metrics.stage_h_send.record(time.perf_counter() - stage_start)
+    except Exception as e:
+        print("h_inbound_socket send error:", e)
+        use_h_inbound_socket.close()
+        while True:
+            if h_inbound_socket != use_h_inbound_socket:
+                break
+            try:
+                h_inbound_socket = create_v4_udp_dgram_socket(False, h_inbound_bind_addr, reuse_port)
+            except Exception as e:
+                print("h_inbound_socket create error:", e)
+                await asyncio.sleep(1)
                 continue
-        elif last_h_addr != addr_h:
-            last_h_addr = addr_h
-            print("the received data is sent to:", addr_h)
+            metrics.socket_recreations += 1
+            break
+
+
+def reassemble(data_offset: int, fragment_part: int, last_fragment: bool, chunk_data: bytes, packet_flags: int,
+               h_datas: list):
+    if last_h_addr is None and not use_sessions:
+        return
+    try:
+        data = d_handler.new_fragment_event(data_offset, fragment_part, last_fragment, chunk_data, packet_flags,
+                                            payload_codec, compressor)
+    except Exception:
+        metrics.decode_errors += 1
+    else:
+        if data is not None:
+            deliver(data, packet_flags, h_datas)
+
 
-        if not raw_data:
+def deliver(data: bytes, packet_flags: int, h_datas: list):
+    """
+    the datagrams of a reassembled packet: to the h side address, or with sessions to the address or backend socket
+    of their session
+    """
+    if packet_flags & PACKET_COALESCED:
+        try:
+            datagrams = unpack_datagrams(data)
+        except ValueError:
+            metrics.decode_errors += 1
+            return
+    elif not use_sessions:
+        h_datas.append((data, last_h_addr))
+        return
+    else:
+        datagrams = (data,)
+    if not use_sessions:
+        h_datas.extend((datagram, last_h_addr) for datagram in datagrams)
+        return
+    now = asyncio.get_running_loop().time()
+    for datagram in datagrams:
+        try:
+            session_id, datagram = split_session(datagram)
+        except ValueError:
+            metrics.decode_errors += 1
             continue
-        final_domains = get_base32_final_domains(raw_data, data_offset, send_domain_index,
-                                                 send_doms_with_chunk_len_list,
-                                                 max_sub_len, DATA_OFFSET_WIDTH, max_encoded_domain_len)
-        if not final_domains:
+        if session_backends is None:
+            addr = session_table.addr_of(session_id)
+            if addr is None:
+                metrics.unknown_sessions += 1
+            else:
+                h_datas.append((datagram, addr))
             continue
-        data_offset = (data_offset + 1) & TOTAL_DATA_OFFSET_MINUS_ONE
-        send_domain_index = (send_domain_index + len(final_domains)) % len(send_doms_with_chunk_len_list)
-        send_socks_datas = []
-        for final_domain in final_domains:
-            send_socks_datas.append(
-                (send_sock_index, send_sock_list[send_sock_index],
-                 build_dns_query(final_domain, query_id, send_query_type_int)))
-            send_sock_index = (send_sock_index + 1) % len(send_sock_list)
-            query_id = (query_id + 1) & 0xFFFF
-
-        curr_try = 0
-        while curr_try < tries:
-            try:
-                queues_list[queue_index].put_nowait((send_socks_datas, dns_ips[send_ip_index], loop.time(), curr_try))
-            except asyncio.QueueFull:
-                pass
-            send_ip_index = (send_ip_index + 1) % len(dns_ips)
-            queue_index = (queue_index + 1) % len(queues_list)
-            curr_try += 1
+        # the socket of a session is in the worker that owns it (session id modulo the workers count)
+        owner_id = session_id % workers_count
+        if owner_id != worker_id:
+            send_to_worker(owner_id, pack_session_data(session_id, datagram))
+        else:
+            metrics.h_sent += 1
+            session_backends.send(session_id, datagram, now)
+
+
+def send_to_worker(owner_id: int, message: bytes):
+    try:
+        worker_inboxes[owner_id][1].send(message)
+    except OSError as e:
+        print("worker inbox send error:", e)
+
+
+def broadcast_to_workers(message: bytes):
+    for other_id in range(workers_count):
+        if other_id != worker_id:
+            send_to_worker(other_id, message)
+
+
+async def worker_inbox_recv():
+    global last_h_addr
+    inbox_receiver = BatchReceiver(worker_inboxes[worker_id][0], RECV_BATCH_SIZE)
+    while True:
+        h_datas = []
+        messages = await inbox_receiver.recv_batch()
+        metrics.worker_messages += len(messages)
+        for message, _ in messages:
+            if message[0] == FRAGMENT_MESSAGE:
+                reassemble(*unpack_fragment(message), h_datas)
+            elif message[0] == H_ADDR_MESSAGE and not use_fixed_h_addr:
+                last_h_addr = unpack_h_addr(message)
+            elif message[0] == SESSION_ADDR_MESSAGE and session_table is not None:
+                session_table.learn(*unpack_session_addr(message), asyncio.get_running_loop().time())
+            elif message[0] == DEMAND_MESSAGE:
+                worker_share.learn(*unpack_demand(message), asyncio.get_running_loop().time())
+            elif message[0] == SESSION_DATA_MESSAGE and session_backends is not None:
+                session_id, datagram = unpack_session_data(message)
+                metrics.h_sent += 1
+                session_backends.send(session_id, datagram, asyncio.get_running_loop().time())
+        if h_datas:
+            await send_to_h(h_datas)
+
+
+def handle_fragment(data_with_header: bytes, h_datas: list):
+    try:
+        if not data_with_header:
+            raise ValueError("no header")
+        data_offset, fragment_part, last_fragment, chunk_data, packet_flags = get_chunk_data(
+            data_with_header, data_offset_chars)
+        if not chunk_data:
+            raise ValueError("no chunk data")
+        if fragment_part == 63 and not last_fragment:
+            raise ValueError("last possible fragment part but not last fragment")
+    except Exception:
+        metrics.invalid_fragments += 1
+    else:
+        dispatch_fragment(data_offset, fragment_part, last_fragment, chunk_data, packet_flags, h_datas)
+
+
+def dispatch_fragment(data_offset: int, fragment_part: int, last_fragment: bool, chunk_data: bytes, packet_flags: int,
+                      h_datas: list):
+    owner_id = (data_offset & TOTAL_DATA_OFFSET_MINUS_ONE) % workers_count
+    if owner_id != worker_id:
+        send_to_worker(owner_id, pack_fragment(data_offset, fragment_part, last_fragment, chunk_data, packet_flags))
+    else:
+        reassemble(data_offset, fragment_part, last_fragment, chunk_data, packet_flags, h_datas)
+
+
+def create_answer_response(raw_data: bytes, qid: int, qflags: int, qtype: int, next_question: int,
+                           qdcount: int) -> bytes:
+    question = raw_data[12:next_question]
+    try:
+        edns_udp_size = get_edns_udp_size(raw_data, next_question)
+    except Exception:
+        edns_udp_size = 0
+    room = min(answer_max_size, max(512, edns_udp_size)) - 12 - len(question)
+    if edns_udp_size:
+        room -= OPT_RR_SIZE
+    payload = answer_queue.take(asyncio.get_running_loop().time(), answer_capacity(qtype, room))
+    if not payload:
+        return create_noerror_empty_response(qid, qflags, question, qdcount)
+    return create_data_response(qid, qflags, question, qdcount, qtype, payload, min(edns_udp_size, answer_max_size))
+
+
+def answer_query(raw_data: bytes, h_datas: list) -> bytes | None:
+    """
+    handles the fragments in a query, returns its response (None for an invalid query)
+    """
+    try:
+        qid, qflags, payloads, qtype, next_question = recv_domain_index.handle_dns_request_questions(raw_data)
+    except Exception:
+        metrics.invalid_requests += 1
+        return None
+
+    for data_with_header in payloads:
+        handle_fragment(data_with_header, h_datas)
+
+    if answer_queue and qtype in DATA_QTYPES:
+        return create_answer_response(raw_data, qid, qflags, qtype, next_question, len(payloads))
+    return create_noerror_empty_response(qid, qflags, raw_data[12:next_question], len(payloads))
+
+
+def on_stream_queries(queries: list, addr) -> list:
+    metrics.queries_received += len(queries)
+    metrics.stream_queries_received += len(queries)
+    if capture is not None:
+        capture.write(WAN_QUERY, queries, asyncio.get_running_loop().time())
+    h_datas = []
+    responses = []
+    for raw_data in queries:
+        response = answer_query(raw_data, h_datas)
+        if response is not None:
+            responses.append(response)
+    if h_datas:
+        asyncio.create_task(send_to_h(h_datas))
+    return responses
 
 
 async def wan_recv():
-    loop = asyncio.get_running_loop()
-    global h_inbound_socket
-    wan_receive_socket = create_v4_udp_dgram_socket(False, wan_receive_bind_addr)
-    d_handler = DataHandler(TOTAL_DATA_OFFSET, ASSEMBLE_TIME)
+    wan_receive_socket = create_v4_udp_dgram_socket(False, wan_receive_bind_addr, reuse_port)
+    wan_receiver = BatchReceiver(wan_receive_socket, RECV_BATCH_SIZE, use_mmsg=use_mmsg)
     while True:
         try:
-            raw_data, addr_w = await loop.sock_recvfrom(wan_receive_socket, 65575)
-            if not addr_w:
-                raise ValueError("wan receive socket no addr!")
-        except Exception as e:
-            # print("wan receive socket recv error:", e)
+            datagrams = await wan_receiver.recv_batch()
+        except Exception:
+            # not printed, they come in bursts (for example icmp errors), the recreations are counted
+            metrics.wan_recv_errors += 1
             wan_receive_socket.close()
             while True:
                 try:
-                    wan_receive_socket = create_v4_udp_dgram_socket(False, wan_receive_bind_addr)
+                    wan_receive_socket = create_v4_udp_dgram_socket(False, wan_receive_bind_addr, reuse_port)
                 except Exception as e:
                     print("wan receive socket create error:", e)
                     await asyncio.sleep(1)
                     continue
+                metrics.socket_recreations += 1
                 break
+            wan_receiver = BatchReceiver(wan_receive_socket, RECV_BATCH_SIZE, use_mmsg=use_mmsg)
             continue
 
-        try:
-            qid, qflags, all_labels, qtype, next_question = handle_dns_request(raw_data)
-
-            accepted_recv_domain_labels_len = 0
-            for recv_domain_labels in all_recv_domains_labels:
-                len_recv_domain_labels = len(recv_domain_labels)
-                if all_labels[-len_recv_domain_labels:] == recv_domain_labels:
-                    accepted_recv_domain_labels_len = len_recv_domain_labels
-                    break
-            if accepted_recv_domain_labels_len == 0:
-                raise ValueError("no accepted recv_domain_labels")
+        stage_start = time.perf_counter() if stage_timing else 0.0
+        metrics.queries_received += len(datagrams)
+        if capture is not None:
+            capture.write(WAN_QUERY, [raw_data for raw_data, _ in datagrams], asyncio.get_running_loop().time())
+        h_datas = []
+        responses = []
+        for raw_data, addr_w in datagrams:
+            response = answer_query(raw_data, h_datas)
+            if response is not None:
+                responses.append((response, addr_w))
+        if stage_start:
+            metrics.stage_wan_recv.record(time.perf_counter() - stage_start)
 
+        if h_datas:
+            await send_to_h(h_datas)
 
-        except Exception as e:
-            print("receive invalid request:", raw_data)
-            continue
-
-        try:
-            if last_h_addr is None:
-                raise ValueError("no last_h_addr")
-            data_with_header = b"".join(all_labels[:-accepted_recv_domain_labels_len])
-            if not data_with_header:
-                raise ValueError("no header")
-            data_offset, fragment_part, last_fragment, chunk_data = get_chunk_data(data_with_header,
-                                                                                   DATA_OFFSET_WIDTH)
-            if not chunk_data:
-                raise ValueError("no chunk data")
-            if fragment_part == 63 and not last_fragment:
-                raise ValueError("last possible fragment part but not last fragment")
-        except Exception as e:
-            # print("error when extracting data", e)
-            pass
-        else:
-            data = await d_handler.new_data_event(data_offset, fragment_part, last_fragment, chunk_data)
-            if data:
-                try:
-                    data = b32decode_nopad(data)
-                except Exception as e:
-                    print("data-error", e)
-                else:
-                    use_h_inbound_socket = h_inbound_socket
-                    try:
-                        await loop.sock_sendto(use_h_inbound_socket, data, last_h_addr)
-                    except Exception as e:
-                        print("h_inbound_socket send error:", e)
-                        use_h_inbound_socket.close()
-                        while True:
-                            if h_inbound_socket != use_h_inbound_socket:
-                                break
-                            try:
-                                h_inbound_socket = create_v4_udp_dgram_socket(False, h_inbound_bind_addr)
-                            except Exception as e:
-                                print("h_inbound_socket create error:", e)
-                                await asyncio.sleep(1)
-                                continue
-                            break
-
-        response = create_noerror_empty_response(qid, qflags, raw_data[12:next_question])
         try:
-            await loop.sock_sendto(wan_receive_socket, response, addr_w)
+            stage_start = time.perf_counter() if stage_timing else 0.0
+            await sendto_all(wan_receive_socket, responses)
+            if stage_start:
+                metrics.stage_wan_reply.record(time.perf_counter() - stage_start)
         except Exception as e:
             print("wan receive socket send error:", e)
             wan_receive_socket.close()
             while True:
                 try:
-                    wan_receive_socket = create_v4_udp_dgram_socket(False, wan_receive_bind_addr)
+                    wan_receive_socket = create_v4_udp_dgram_socket(False, wan_receive_bind_addr, reuse_port)
                 except Exception as e:
                     print("wan receive socket create error:", e)
                     await asyncio.sleep(1)
                     continue
+                metrics.socket_recreations += 1
                 break
+            wan_receiver = BatchReceiver(wan_receive_socket, RECV_BATCH_SIZE, use_mmsg=use_mmsg)
+
+
+async def flush_capture():
+    while True:
+        await asyncio.sleep(CAPTURE_FLUSH_INTERVAL)
+        capture.flush()
+
+
+# the index of each resolver in dns_ips, the send tasks find their resolver with it
+resolver_indexes: dict[str, int] = {}
+# {resolver ip: the task that sends its queue}
+send_tasks: dict[str, asyncio.Task] = {}
+# fails when a send task fails, so the tunnel stops like on any other failed task
+send_task_failed: asyncio.Future | None = None
+# the keys that reload_config applies, the others need a restart
+RELOAD_KEYS = ("dns_ips", "resolver_profiles", "send_domains", "recv_domains", "max_domain_len", "max_sub_len",
+               "packets_send_interval", "packets_send_rate", "packets_send_burst", "send_sock_numbers",
+               "send_sock_rate", "send_sock_rotate", "resolver_reply_timeout", "resolver_quarantine_time", "edns")
+
+
+def on_send_task_done(task: asyncio.Task):
+    if not task.cancelled() and not send_task_failed.done():
+        send_task_failed.set_exception(task.exception() or RuntimeError("send task stopped"))
+
+
+def start_send_queue(ip: str) -> SendQueue:
+    queue = SendQueue(PACKETS_QUEUE_SIZE, send_queue_max_bytes, send_queue_target, send_queue_interval)
+    task = send_tasks[ip] = asyncio.create_task(wan_send_from_queue(queue, ip))
+    task.add_done_callback(on_send_task_done)
+    return queue
+
+
+def open_stream(ip: str) -> StreamPool | None:
+    profile = resolver_profiles[ip]
+    if profile["transport"] == "udp":
+        return None
+    ssl_context = client_ssl_context(profile["tls_verify"]) if profile["transport"] == "tls" else None
+    return StreamPool(ip, profile["port"], profile["connections"], ssl_context, profile["tls_name"],
+                      send_interface_ip_str, on_stream_replies)
+
+
+async def maintain_send_socks():
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(SEND_SOCK_TICK)
+        send_socks.maintain(loop.time())
+
+
+def reload_config() -> dict:
+    """
+    reads config.json again and applies RELOAD_KEYS while the tunnel runs: the resolvers that are kept keep their
+    queue, statistics and connections, the reassembly state and the data offset/query id counters are not touched
+    """
+    global send_domain_index
+    global coalesce_max_size
+    try:
+        with open(config_path) as f:
+            new_config = json.loads(f.read())
+        # everything that is applied below is read first, load_resolver_settings is the last step that can fail
+        reply_timeout = float(new_config.get("resolver_reply_timeout", 2.0))
+        quarantine_time = float(new_config.get("resolver_quarantine_time", 30.0))
+        sock_numbers = int(new_config.get("send_sock_numbers", config["send_sock_numbers"]))
+        sock_rate = float(new_config.get("send_sock_rate", 10.0))
+        sock_rotate = float(new_config.get("send_sock_rotate", 300.0))
+        old_dns_ips = dns_ips
+        old_profiles = resolver_profiles
+        load_resolver_settings(new_config)
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        print("reload error, nothing is changed:", repr(e))
+        return {"reloaded": False, "error": repr(e)}
+
+    old_indexes = [old_dns_ips.index(ip) if ip in old_dns_ips else -1 for ip in dns_ips]
+    resolver_health.set_resolvers(dns_ips, old_indexes, reply_timeout, quarantine_time)
+    send_scheduler.set_rates(worker_send_rates(), packets_send_burst, old_indexes)
+    new_queues = []
+    new_streams = []
+    for ip, old_index in zip(dns_ips, old_indexes):
+        if old_index < 0:
+            new_queues.append(start_send_queue(ip))
+            new_streams.append(open_stream(ip))
+            continue
+        new_queues.append(queues_list[old_index])
+        stream = resolver_streams[old_index]
+        old_profile = old_profiles[ip]
+        profile = resolver_profiles[ip]
+        if any(old_profile[key] != profile[key] for key in STREAM_PROFILE_KEYS):
+            if stream is not None:
+                stream.close()
+            stream = open_stream(ip)
+        new_streams.append(stream)
+    for old_index, ip in enumerate(old_dns_ips):
+        if ip not in dns_ips:
+            # its queued packets are dropped, their retries went to other resolvers
+            send_tasks.pop(ip).cancel()
+            if resolver_streams[old_index] is not None:
+                resolver_streams[old_index].close()
+    queues_list[:] = new_queues
+    resolver_streams[:] = new_streams
+    resolver_indexes.clear()
+    resolver_indexes.update((ip, i) for i, ip in enumerate(dns_ips))
+    send_domain_index %= len(send_doms_with_chunk_len_list)
+    send_socks.set_limits(send_sock_count(sock_numbers), sock_rate, sock_rotate, resolver_health.reply_timeout)
+    if coalesce_max_size and not config.get("coalesce_max_size", 0):
+        coalesce_max_size = int(min(chunk_len for _, chunk_len in get_send_templates(smallest_qname_limits)[0]) *
+                                payload_codec.bits_per_char / 8)
+        for coalescer in coalescers.values():
+            coalescer.max_size = min(coalesce_max_size, MAX_COALESCE_SIZE)
+
+    restart_keys = sorted(key for key in set(config) | set(new_config) if key not in RELOAD_KEYS and
+                          config.get(key) != new_config.get(key))
+    for key in RELOAD_KEYS:
+        if key in new_config:
+            config[key] = new_config[key]
+        else:
+            config.pop(key, None)
+    print("reloaded:", len(dns_ips), "resolvers,", len(send_doms_with_chunk_len_list), "send domains,",
+          send_socks.max_socks, "send sockets at most")
+    if restart_keys:
+        print("reload: these keys need a restart:", ", ".join(restart_keys))
+    return {"reloaded": True, "restart_needed": restart_keys}
+
+
+def set_stage_timing(on: bool) -> dict:
+    global stage_timing
+    stage_timing = on
+    print("stage timing:", "on" if on else "off")
+    return {"stage_timing": on}
+
+
+def memory_snapshot() -> dict:
+    # the reassembly state is walked only after tracemalloc started, the first call only starts it
+    return profiler.memory_snapshot({"reassembly": d_handler.memory()} if profiler.last_snapshot else None)
+
+
+# the commands of stats_address, each datagram is one command and the reply is its result as json. they are only run
+# for the senders that serve_stats answers (loopback, or datagrams that start with stats_token)
+CONTROL_COMMANDS = {
+    b"reload": reload_config,
+    b"profile start": lambda: profiler.start("cprofile"),
+    b"profile start sampling": lambda: profiler.start("sampling"),
+    b"profile stop": lambda: profiler.stop(),
+    b"memory snapshot": memory_snapshot,
+    b"memory stop": lambda: profiler.memory_stop(),
+    b"timing on": lambda: set_stage_timing(True),
+    b"timing off": lambda: set_stage_timing(False),
+}
 
 
 async def main():
+    global send_scheduler
+    global d_handler
+    global send_socks
+    global query_id
+    global data_offset
+    global data_offset_epoch
+    global send_domain_index
+    global session_table
+    global session_backends
+    global send_task_failed
+    global capture
+    global profiler
+    global worker_share
+    if workers_count > 1:
+        worker_share = WorkerShare(workers_count, worker_id, asyncio.get_running_loop().time())
+    send_scheduler = SendScheduler(worker_send_rates(), packets_send_burst)
+    d_handler = DataHandler(TOTAL_DATA_OFFSET, assemble_time, min_assemble_time, workers_count, use_data_offset_epoch)
+    send_socks = SendSocketPool(send_interface_ip_str, send_sock_count(config["send_sock_numbers"]),
+                                config.get("send_sock_rate", 10.0), config.get("send_sock_rotate", 300.0),
+                                resolver_health.reply_timeout, on_send_sock_readable)
+    query_id = random.randint(0, 65535)
+    data_offset = random.randrange(worker_id, TOTAL_DATA_OFFSET, workers_count)
+    data_offset_epoch = random.randrange(EPOCH_COUNT)
+    send_domain_index = random.randint(0, len(send_doms_with_chunk_len_list) - 1)
     wait_list = []
-    for _ in dns_ips:
-        queue = asyncio.Queue(maxsize=PACKETS_QUEUE_SIZE)
-        queues_list.append(queue)
-        wait_list.append(asyncio.create_task(wan_send_from_queue(queue)))
+    wait_list.append(asyncio.create_task(maintain_send_socks()))
+    wait_list.append(asyncio.create_task(resolver_health.monitor(send_probe)))
+    send_task_failed = asyncio.get_running_loop().create_future()
+    profiler = Profiler(profile_dir, worker_id)
+    wait_list.append(send_task_failed)
+    for i, ip in enumerate(dns_ips):
+        resolver_indexes[ip] = i
+        resolver_streams.append(open_stream(ip))
+        queues_list.append(start_send_queue(ip))
+    wait_list.append(asyncio.create_task(report_queues()))
+    if capture_file:
+        try:
+            capture = Capture(stats_path(capture_file, worker_id, workers_count), capture_max_bytes,
+                              asyncio.get_running_loop().time())
+        except OSError as e:
+            sys.exit(f"cannot open capture_file: {e}")
+        wait_list.append(asyncio.create_task(flush_capture()))
+    if stats_address:
+        stats_host, stats_port = stats_address.rsplit(":", 1)
+        await serve_stats((stats_host, int(stats_port) + worker_id), stats_snapshot, CONTROL_COMMANDS,
+                          stats_token)
+    if stats_file:
+        wait_list.append(asyncio.create_task(dump_stats_every(stats_path(stats_file, worker_id, workers_count),
+                                                              stats_interval, stats_snapshot)))
 
-    wait_list.append(asyncio.create_task(h_recv()))
+    if use_sessions:
+        if use_fixed_h_addr:
+            # the backends answer on the socket of each session, h_in_address is not used
+            session_backends = SessionBackends(session_backend_addrs or [last_h_addr], session_timeout,
+                                               on_session_reply)
+        else:
+            session_table = SessionTable(session_timeout, worker_id, workers_count)
+        wait_list.append(asyncio.create_task(expire_sessions()))
+    if session_backends is None:
+        wait_list.append(asyncio.create_task(h_recv()))
     wait_list.append(asyncio.create_task(wan_recv()))
-    print("started...")
+    if receive_tcp:
+        await serve_stream(wan_receive_bind_addr, on_stream_queries, reuse_port)
+    if receive_tls_context is not None:
+        await serve_stream(receive_tls_bind_addr, on_stream_queries, reuse_port, receive_tls_context)
+    if answer_queue is not None:
+        wait_list.append(asyncio.create_task(answer_queue_expire()))
+    if hasattr(signal, "SIGHUP"):
+        # kill -HUP <pid> reloads the config (the supervisor of the workers passes it on to them)
+        asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, reload_config)
+    if hasattr(signal, "SIGUSR1"):
+        # kill -USR1 <pid> starts and stops a cProfile profile, kill -USR2 <pid> takes a tracemalloc snapshot
+        asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, profiler.toggle)
+        asyncio.get_running_loop().add_signal_handler(signal.SIGUSR2, memory_snapshot)
+    if workers_count > 1:
+        wait_list.append(asyncio.create_task(worker_inbox_recv()))
+        wait_list.append(asyncio.create_task(share_send_budget()))
+        print("worker", worker_id, "started...")
+    else:
+        print("started...")
     await asyncio.wait(wait_list, return_when=asyncio.FIRST_COMPLETED)
 
 
+if workers_count > 1:
+    worker_inboxes = create_inboxes(workers_count)
+    worker_id = fork_workers(workers_count)
+open_sockets()
 asyncio.run(main())
@@ -0,0 +1,163 @@
+import asyncio
+import hmac
+import ipaddress
+import json
+import os
+
+
+class Histogram:
+    """
+    counts values in power of 2 buckets: bucket i holds the values (in units, value * scale) below 2 ** i.
+    record() is one multiplication, one bit_length and two additions.
+    """
+    __slots__ = ("scale", "unit", "counts", "count", "sum")
+
+    def __init__(self, scale: float = 1.0, unit: str = "", buckets: int = 16) -> None:
+        self.scale = scale
+        self.unit = unit
+        self.counts = [0] * buckets
+        self.count = 0
+        self.sum = 0.0
+
+    def record(self, value: float) -> None:
+        i = int(value * self.scale).bit_length()
+        counts = self.counts
+        if i >= len(counts):
+            i = len(counts) - 1
+        counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+    def describe(self) -> dict:
+        buckets = {}
+        last = len(self.counts) - 1
+        for i, count in enumerate(self.counts):
+            if count:
+                buckets[f"<{1 << i}{self.unit}" if i < last else f">={1 << (i - 1)}{self.unit}"] = count
+        return {"count": self.count, "avg": round(self.sum * self.scale / self.count, 3) if self.count else 0.0,
+                "buckets": buckets}
+
+
+class Metrics:
+    """
+    the counters of the data path of one worker, plain attributes so counting is a single attribute increment.
+    the reassembly counters are in DataHandler, the resolver and queue counters in ResolverHealth and SendQueue.
+    """
+
+    def __init__(self) -> None:
+        self.h_received = 0  # datagrams from the h side
+        self.h_sent = 0  # datagrams to the h side
+        self.packets_sent = 0  # packets sent in queries (every try is counted once)
+        self.packets_answered = 0  # packets put in the answer queue
+        self.answer_queue_full = 0
+        self.fragments_per_packet = Histogram(unit="")
+        self.queries_received = 0
+        self.stream_queries_received = 0  # of them over tcp/tls
+        self.invalid_requests = 0
+        self.invalid_fragments = 0
+        self.invalid_answers = 0
+        self.decode_errors = 0
+        self.socket_recreations = 0
+        self.wan_recv_errors = 0
+        self.worker_messages = 0
+        self.unknown_sessions = 0  # datagrams for a session without an address (expired or from before a restart)
+        self.sessions_full = 0  # datagrams from new clients while all session ids are in use
+        # time spent in each stage, only with stage_timing (avg times count is the total time of the stage)
+        self.stage_h_recv = Histogram(1e6, "us", 21)  # encoding and queueing a batch of h side datagrams
+        self.stage_pacing_wait = Histogram(1e6, "us", 21)  # waiting for the send rate of a resolver
+        self.stage_wan_send = Histogram(1e6, "us", 21)  # sending one query
+        self.stage_wan_recv = Histogram(1e6, "us", 21)  # parsing and reassembling a batch of queries, the responses
+        self.stage_wan_reply = Histogram(1e6, "us", 21)  # sending the responses of a batch
+        self.stage_h_send = Histogram(1e6, "us", 21)  # sending a batch of reassembled datagrams to the h side
+
+    def describe(self) -> dict:
+        result = {}
+        for name, value in vars(self).items():
+            result[name] = value.describe() if isinstance(value, Histogram) else value
+        return result
+
+
+def stats_path(path: str, worker_id: int, workers_count: int) -> str:
+    """
+    every worker writes its own file: stats.json -> stats.1.json
+    """
+    if workers_count == 1:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.{worker_id}{ext}"
+
+
+def dump_stats(path: str, stats: dict) -> None:
+    # written to a temporary file first, so a reader never sees half a file
+    tmp_path = path + ".tmp"
+    try:
+        with open(tmp_path, "w") as f:
+            json.dump(stats, f)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print("stats_file write error:", e)
+
+
+def _is_loopback(host: str) -> bool:
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return host == "localhost"
+
+
+class _StatsProtocol(asyncio.DatagramProtocol):
+    def __init__(self, snapshot, commands: dict, token: bytes) -> None:
+        self.snapshot = snapshot
+        self.commands = commands
+        self.token = token
+        self.transport = None
+        self.refused = 0
+
+    def connection_made(self, transport) -> None:
+        self.transport = transport
+
+    def authorize(self, data: bytes, addr) -> bytes | None:
+        """
+        the datagram without the token, None if it is not answered: with a token every datagram must start with it
+        (from any address), without one only loopback addresses are answered. a big reply to any small datagram
+        would make the port a udp amplification reflector.
+        """
+        data = data.strip()
+        if self.token:
+            if not hmac.compare_digest(data[:len(self.token)], self.token):
+                return None
+            return data[len(self.token):].strip()
+        if not _is_loopback(addr[0]):
+            return None
+        return data
+
+    def datagram_received(self, data: bytes, addr) -> None:
+        data = self.authorize(data, addr)
+        if data is None:
+            self.refused += 1
+            if self.refused in (1, 10, 100) or self.refused % 1000 == 0:
+                print("stats_address: datagrams refused:", self.refused, "last from:", addr)
+            return
+        try:
+            command = self.commands.get(data)
+            self.transport.sendto(json.dumps(command() if command is not None else self.snapshot()).encode(), addr)
+        except Exception as e:
+            print("stats send error:", e)
+
+
+async def serve_stats(bind_addr: tuple, snapshot, commands: dict | None = None, token: str = "") -> None:
+    """
+    answers any datagram with the json of snapshot(), for example: echo | nc -u -w1 127.0.0.1 9900,
+    a datagram that is the name of one of the commands ({name: function}) runs it and gets its result instead.
+    without a token only loopback senders are answered, with one the datagrams start with it: "<token> reload"
+    """
+    if not token and not _is_loopback(bind_addr[0]):
+        print("stats_address is not a loopback address and stats_token is empty, only loopback senders are answered")
+    await asyncio.get_running_loop().create_datagram_endpoint(
+        lambda: _StatsProtocol(snapshot, commands or {}, token.encode()), local_addr=bind_addr)
+
+
+async def dump_stats_every(path: str, interval: float, snapshot) -> None:
+    while True:
+        await asyncio.sleep(interval)
+        dump_stats(path, snapshot())
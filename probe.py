@@ -0,0 +1,272 @@
+# tests what each dns_ip supports on the way to the other side of the tunnel (which must be running, it answers the
+# probes with NOERROR): the longest qname and label, questions per query, whether the case of the qname is kept,
+# rtt and the rate it answers without losses. prints a resolver profile for each of them.
+# usage: python probe.py [--config config.json] [--write] [--resolver ip]
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import statistics
+import sys
+import time
+
+from utility.dns import encode_qname, build_dns_query, pack_questions, MAX_QUESTIONS
+
+# the leading "0" is never a valid data offset character, so the other side does not take a probe for data
+PROBE_CHARS = b"abcdefghijklmnopqrstuvwxyz234567"
+PROBE_TIMEOUT = 2.0
+PROBE_TRIES = 3
+RTT_PROBES = 10
+# the rate starts at PROBE_MIN_RATE and doubles up to PROBE_MAX_RATE while the resolver answers it, each rate is sent
+# for RATE_STEP_TIME seconds, the highest one with at least RATE_MIN_REPLIES of the replies is kept
+PROBE_MIN_RATE = 25
+PROBE_MAX_RATE = 12800
+RATE_STEP_TIME = 1.0
+RATE_MIN_REPLIES = 0.95
+# sending a rate took longer than this times RATE_STEP_TIME: this machine can not send faster
+RATE_SEND_SLACK = 1.2
+
+
+def probe_qname(length: int, max_label: int, domain: bytes, rnd: random.Random, mixed_case: bool = False) -> bytes:
+    """
+    a qname of length characters (without the trailing dot, like max_domain_len) in labels of up to max_label,
+    under domain
+    """
+    prefix_len = length - len(domain) - 1
+    if prefix_len < 1:
+        raise ValueError("length is shorter than the domain")
+    labels = []
+    while prefix_len > 0:
+        size = min(max_label, prefix_len)
+        if prefix_len - size == 1:
+            # no room for a dot and a label after this one
+            size -= 1
+        label = bytearray(rnd.choice(PROBE_CHARS) for _ in range(size))
+        if not labels:
+            label[0] = 48  # b"0"
+        if mixed_case:
+            label = bytearray(ch ^ 0x20 if 97 <= ch <= 122 and rnd.random() < 0.5 else ch for ch in label)
+        labels.append(bytes(label))
+        prefix_len -= size + 1
+    return b".".join(labels) + b"." + domain
+
+
+class _ProbeProtocol(asyncio.DatagramProtocol):
+    def __init__(self) -> None:
+        self.waiters: dict[int, asyncio.Future] = {}
+
+    def datagram_received(self, data: bytes, addr) -> None:
+        if len(data) < 12:
+            return
+        waiter = self.waiters.pop(int.from_bytes(data[:2], "big"), None)
+        if waiter is not None and not waiter.done():
+            waiter.set_result(data)
+
+
+class Prober:
+    """
+    probes one resolver, every probe is a query for a random qname under domain
+    """
+
+    def __init__(self, resolver_ip: str, domain: bytes, qtype: int, bind_ip: str, rnd: random.Random) -> None:
+        self.addr = (resolver_ip, 53)
+        self.domain = domain.rstrip(b".").lower()
+        self.qtype = qtype
+        self.bind_ip = bind_ip
+        self.rnd = rnd
+        self.transport = None
+        self.protocol = None
+        self.next_id = rnd.randint(0, 65535)
+
+    async def open(self) -> None:
+        self.transport, self.protocol = await asyncio.get_running_loop().create_datagram_endpoint(
+            _ProbeProtocol, local_addr=(self.bind_ip or "0.0.0.0", 0), family=socket.AF_INET)
+
+    def close(self) -> None:
+        self.transport.close()
+
+    def _query(self, qname: bytes) -> bytes:
+        qid = self.next_id
+        self.next_id = (qid + 1) & 0xFFFF
+        return build_dns_query(encode_qname(qname), qid, self.qtype)
+
+    def _send(self, message: bytes) -> asyncio.Future:
+        waiter = asyncio.get_running_loop().create_future()
+        self.protocol.waiters[int.from_bytes(message[:2], "big")] = waiter
+        self.transport.sendto(message, self.addr)
+        return waiter
+
+    async def ask(self, queries: list[bytes], timeout: float = PROBE_TIMEOUT) -> bytes | None:
+        """
+        the reply to the queries (merged into one message if there are several), None if there was none
+        """
+        message = pack_questions(queries, len(queries), 65535)[0] if len(queries) > 1 else queries[0]
+        waiter = self._send(message)
+        try:
+            return await asyncio.wait_for(waiter, timeout)
+        except asyncio.TimeoutError:
+            self.protocol.waiters.pop(int.from_bytes(message[:2], "big"), None)
+            return None
+
+    async def works(self, qnames: list[bytes]) -> bool:
+        """
+        if a NOERROR reply with all questions comes back, lost probes are sent again
+        """
+        for _ in range(PROBE_TRIES):
+            queries = [self._query(qname) for qname in qnames]
+            reply = await self.ask(queries)
+            if reply is None:
+                continue
+            return reply[3] & 0x0F == 0 and int.from_bytes(reply[4:6], "big") == len(queries)
+        return False
+
+    async def _highest(self, low: int, high: int, test) -> int:
+        # the highest value in low..high for which test works, low - 1 if none (test is monotonic)
+        if not await test(low):
+            return low - 1
+        while low < high:
+            mid = (low + high + 1) // 2
+            if await test(mid):
+                low = mid
+            else:
+                high = mid - 1
+        return low
+
+    async def max_sub_len(self) -> int:
+        length = len(self.domain) + 1
+        return await self._highest(1, 63, lambda size: self.works(
+            [probe_qname(length + size, 63, self.domain, self.rnd)]))
+
+    async def max_domain_len(self, max_label: int) -> int:
+        return await self._highest(len(self.domain) + 2, 253, lambda length: self.works(
+            [probe_qname(length, max_label, self.domain, self.rnd)]))
+
+    async def questions(self) -> int:
+        questions = 1
+        while questions < MAX_QUESTIONS:
+            qname_len = len(self.domain) + 9
+            if not await self.works([probe_qname(qname_len, 63, self.domain, self.rnd) for _ in range(questions + 1)]):
+                break
+            questions += 1
+        return questions
+
+    async def preserves_case(self) -> bool | None:
+        for _ in range(PROBE_TRIES):
+            query = self._query(probe_qname(len(self.domain) + 17, 63, self.domain, self.rnd, True))
+            reply = await self.ask([query])
+            if reply is not None:
+                return reply[12:len(query) - 4] == query[12:len(query) - 4]
+        return None
+
+    async def rtt(self) -> float | None:
+        rtts = []
+        for _ in range(RTT_PROBES):
+            start = time.perf_counter()
+            if await self.ask([self._query(probe_qname(len(self.domain) + 9, 63, self.domain, self.rnd))]):
+                rtts.append(time.perf_counter() - start)
+        return statistics.median(rtts) if rtts else None
+
+    async def rate(self) -> tuple[float, bool]:
+        """
+        (the highest rate in queries per second that is answered without losses, if the resolver limits it). the rate
+        doubles until replies are lost, the resolver does not limit it if it answers PROBE_MAX_RATE or a rate that
+        this machine can not send any faster.
+        """
+        loop = asyncio.get_running_loop()
+        best = 0.0
+        rate = PROBE_MIN_RATE
+        while rate <= PROBE_MAX_RATE:
+            waiters = []
+            count = int(rate * RATE_STEP_TIME)
+            start = loop.time()
+            for i in range(count):
+                delay = start + i / rate - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                waiters.append(self._send(self._query(probe_qname(len(self.domain) + 9, 63, self.domain, self.rnd))))
+            send_time = loop.time() - start
+            done, pending = await asyncio.wait(waiters, timeout=PROBE_TIMEOUT)
+            for waiter in pending:
+                waiter.cancel()
+            self.protocol.waiters.clear()
+            replies = sum(1 for waiter in done if waiter.result()[3] & 0x0F == 0)
+            if replies < count * RATE_MIN_REPLIES:
+                return best, True
+            best = float(rate)
+            if send_time > RATE_STEP_TIME * RATE_SEND_SLACK:
+                break
+            rate *= 2
+            # the rate limit of the resolver refills
+            await asyncio.sleep(RATE_STEP_TIME)
+        return best, False
+
+    async def profile(self) -> dict:
+        """
+        the resolver profile (the keys of resolver_profiles), empty if no probe gets a NOERROR reply
+        """
+        if not await self.works([probe_qname(len(self.domain) + 9, 63, self.domain, self.rnd)]):
+            return {}
+        rtt = await self.rtt()
+        max_sub_len = await self.max_sub_len()
+        result = {"max_domain_len": await self.max_domain_len(max_sub_len), "max_sub_len": max_sub_len,
+                  "questions": await self.questions(), "preserves_case": await self.preserves_case(),
+                  "rtt_ms": round(rtt * 1000, 1) if rtt is not None else None}
+        rate, rate_limited = await self.rate()
+        if rate_limited:
+            result["rate"] = rate
+        else:
+            # no limit was found, this is not a pacing rate (the tunnel does not read rate_at_least)
+            result["rate_at_least"] = rate
+        return result
+
+
+async def probe_resolvers(config: dict, resolver_ips: list[str]) -> dict:
+    """
+    {ip: profile} of the resolvers, probed one after the other (so they do not share the bandwidth)
+    """
+    domain = config["send_domains"][0].encode()
+    rnd = random.Random()
+    profiles = {}
+    for ip in resolver_ips:
+        prober = Prober(ip, domain, config["send_query_type_int"], config.get("send_interface_ip", ""), rnd)
+        await prober.open()
+        try:
+            profiles[ip] = await prober.profile()
+        finally:
+            prober.close()
+        print(ip, json.dumps(profiles[ip]), file=sys.stderr)
+    return profiles
+
+
+def main():
+    parser = argparse.ArgumentParser(description="tests what each dns_ip supports and prints resolver profiles")
+    parser.add_argument("--config", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "config.json"))
+    parser.add_argument("--resolver", action="append", default=[], help="only this dns_ip (can be repeated)")
+    parser.add_argument("--write", action="store_true", help="write the profiles to resolver_profiles in the config")
+    opts = parser.parse_args()
+
+    with open(opts.config) as f:
+        config = json.load(f)
+    if not config["send_domains"]:
+        sys.exit("send_domains is empty")
+    profiles = asyncio.run(probe_resolvers(config, opts.resolver or config["dns_ips"]))
+    print(json.dumps(profiles, indent=1))
+    if opts.write:
+        resolver_profiles = config.setdefault("resolver_profiles", {})
+        for ip, profile in profiles.items():
+            if profile:
+                resolver_profile = resolver_profiles.setdefault(ip, {})
+                resolver_profile.update(profile)
+                # a rate is only written when the resolver limits it, else the configured rate is kept
+                if "rate" in profile:
+                    resolver_profile.pop("rate_at_least", None)
+        with open(opts.config, "w") as f:
+            json.dump(config, f, indent=2)
+            f.write("\n")
+
+
+if __name__ == "__main__":
+    main()
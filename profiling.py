@@ -0,0 +1,145 @@
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+# the sampling profiler looks at the stack of the event loop thread this often
+SAMPLE_INTERVAL = 0.005
+# more frames per allocation make tracemalloc much slower, one is enough to compare snapshots by line
+TRACEMALLOC_FRAMES = 1
+TOP_LINES = 10
+
+
+class Profiler:
+    """
+    on demand cpu profiles (cProfile, or a thread that samples the stack of the event loop, which is cheaper and sees
+    the time in c functions as their caller) and tracemalloc snapshots. every result is written to a file in
+    directory named <what>.<worker id>.<unix time in ms>.<pid>.<number>.<ext>, the methods return a short summary.
+    """
+
+    def __init__(self, directory: str, worker_id: int) -> None:
+        self.directory = directory
+        self.worker_id = worker_id
+        self.mode = ""
+        self.started = 0.0
+        self.dumps = 0
+        self.profile: cProfile.Profile | None = None
+        self.sampler: threading.Thread | None = None
+        self.sampling = threading.Event()
+        self.samples: Counter = Counter()
+        self.target_thread = 0
+        self.last_snapshot: tracemalloc.Snapshot | None = None
+
+    def _path(self, what: str, ext: str) -> str:
+        # the profiles and snapshots show the code and data of the tunnel, only the user of the tunnel reads them
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        while True:
+            # the number of the dump keeps two dumps of the same millisecond apart, O_EXCL never overwrites a file
+            self.dumps += 1
+            path = os.path.join(self.directory, f"{what}.{self.worker_id}.{int(time.time() * 1000)}.{os.getpid()}."
+                                                f"{self.dumps}.{ext}")
+            try:
+                os.close(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600))
+            except FileExistsError:
+                continue
+            return path
+
+    def start(self, mode: str = "cprofile") -> dict:
+        if self.mode:
+            return {"error": f"{self.mode} profile is running"}
+        if mode == "cprofile":
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        elif mode == "sampling":
+            self.samples = Counter()
+            self.target_thread = threading.get_ident()
+            self.sampling.set()
+            self.sampler = threading.Thread(target=self._sample, daemon=True)
+            self.sampler.start()
+        else:
+            return {"error": "the profile modes are cprofile and sampling"}
+        self.mode = mode
+        self.started = time.perf_counter()
+        print("profile started:", mode)
+        return {"started": mode}
+
+    def _sample(self) -> None:
+        current_frames = sys._current_frames
+        samples = self.samples
+        while self.sampling.is_set():
+            time.sleep(SAMPLE_INTERVAL)
+            frame = current_frames().get(self.target_thread)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+                frame = frame.f_back
+            samples[";".join(reversed(stack))] += 1
+
+    def stop(self) -> dict:
+        """
+        writes the profile: cProfile as a .prof file (python -m pstats, snakeviz), samples as collapsed stacks (one
+        "frame;frame;frame count" line per stack, for flamegraph.pl or speedscope)
+        """
+        if not self.mode:
+            return {"error": "no profile is running"}
+        seconds = round(time.perf_counter() - self.started, 3)
+        if self.mode == "cprofile":
+            self.profile.disable()
+            path = self._path("cpu", "prof")
+            self.profile.dump_stats(path)
+            out = io.StringIO()
+            pstats.Stats(self.profile, stream=out).sort_stats("tottime").print_stats(TOP_LINES)
+            top = [line.strip() for line in out.getvalue().splitlines() if line.strip()][-TOP_LINES:]
+            self.profile = None
+        else:
+            self.sampling.clear()
+            self.sampler.join()
+            self.sampler = None
+            path = self._path("cpu", "folded")
+            with open(path, "w") as f:
+                for stack, count in self.samples.most_common():
+                    f.write(f"{stack} {count}\n")
+            # the functions that were on top of the stack most often
+            leaves = Counter()
+            for stack, count in self.samples.items():
+                leaves[stack.rsplit(";", 1)[-1]] += count
+            top = [f"{count} {leaf}" for leaf, count in leaves.most_common(TOP_LINES)]
+        print("profile written:", path)
+        result = {"stopped": self.mode, "seconds": seconds, "file": path, "top": top}
+        self.mode = ""
+        return result
+
+    def toggle(self) -> dict:
+        return self.stop() if self.mode else self.start()
+
+    def memory_snapshot(self, extra: dict | None = None) -> dict:
+        """
+        the first call starts tracemalloc, the next ones write a snapshot and return the lines that allocated the most
+        since the previous one (and extra, for example the reassembly state)
+        """
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+            self.last_snapshot = tracemalloc.take_snapshot()
+            print("tracemalloc started")
+            return {"tracemalloc": "started"}
+        snapshot = tracemalloc.take_snapshot()
+        path = self._path("memory", "tracemalloc")
+        snapshot.dump(path)
+        growth = [str(stat) for stat in snapshot.compare_to(self.last_snapshot, "lineno")[:TOP_LINES]]
+        self.last_snapshot = snapshot
+        current, peak = tracemalloc.get_traced_memory()
+        print("tracemalloc snapshot written:", path)
+        return {"file": path, "traced_bytes": current, "peak_bytes": peak, "growth": growth, **(extra or {})}
+
+    def memory_stop(self) -> dict:
+        if not tracemalloc.is_tracing():
+            return {"error": "tracemalloc is not running"}
+        tracemalloc.stop()
+        self.last_snapshot = None
+        return {"tracemalloc": "stopped"}
@@ -0,0 +1,212 @@
+import asyncio
+from array import array
+from collections import deque
+
+MIN_SAMPLES = 20
+EWMA_ALPHA = 0.05
+QUARANTINE_SUCCESS = 0.5
+RECOVER_SUCCESS = 0.8
+MAX_QUARANTINE_TIME = 600.0
+# the quarantine time of a resolver is halved after each this many seconds of being active again, so a resolver that
+# fails now and then starts from resolver_quarantine_time instead of the maximum
+QUARANTINE_DECAY_TIME = 600.0
+SWEEP_INTERVAL = 0.5
+
+ACTIVE = 0
+QUARANTINED = 1
+PROBING = 2
+
+RCODE_NAMES = {0: "NOERROR", 1: "FORMERR", 2: "SERVFAIL", 3: "NXDOMAIN", 4: "NOTIMP", 5: "REFUSED"}
+
+
+class ResolverStats:
+    __slots__ = ("sent", "replies", "lost", "rcodes", "rtt", "success", "samples", "state", "quarantine_time",
+                 "quarantine_until", "decay_at", "weight")
+
+    def __init__(self) -> None:
+        self.sent = 0
+        self.replies = 0
+        self.lost = 0
+        self.rcodes = [0] * 16
+        self.rtt = 0.0
+        self.success = 1.0
+        self.samples = 0
+        self.state = ACTIVE
+        self.quarantine_time = 0.0
+        self.quarantine_until = 0.0
+        self.decay_at = 0.0
+        self.weight = 1
+
+    def sample(self, ok: float) -> None:
+        self.success += (ok - self.success) * EWMA_ALPHA
+        self.samples += 1
+
+
+class ResolverHealth:
+    """
+    matches resolver replies to the query ids we sent, keeps rtt/loss/rcode statistics per resolver,
+    quarantines the bad ones and hands out resolvers by smooth weighted round-robin.
+    """
+
+    def __init__(self, resolvers: list[str], reply_timeout: float, quarantine_time: float) -> None:
+        self.resolvers = resolvers
+        self.resolver_indexes = {ip: i for i, ip in enumerate(resolvers)}
+        self.reply_timeout = reply_timeout
+        self.base_quarantine_time = quarantine_time
+        self.stats = [ResolverStats() for _ in resolvers]
+        self.sent_resolver = array("i", [-1]) * 65536
+        self.sent_time = array("d", [0.0]) * 65536
+        self.in_flight = deque()
+        self.current = [0] * len(resolvers)
+        self.eligible: list[int] = list(range(len(resolvers)))
+
+    def set_resolvers(self, resolvers: list[str], old_indexes: list[int], reply_timeout: float,
+                      quarantine_time: float) -> None:
+        """
+        the resolvers after a reload, old_indexes[i] is the index of resolvers[i] before (-1 for a new one). the kept
+        resolvers keep their statistics and queries in flight, the replies to the removed ones are ignored.
+        """
+        new_indexes = {old_index: i for i, old_index in enumerate(old_indexes) if old_index >= 0}
+        sent_resolver = self.sent_resolver
+        # every query that is not answered or counted as lost yet is in in_flight
+        for _, qid in self.in_flight:
+            if sent_resolver[qid] >= 0:
+                sent_resolver[qid] = new_indexes.get(sent_resolver[qid], -1)
+        self.stats = [self.stats[old_index] if old_index >= 0 else ResolverStats() for old_index in old_indexes]
+        self.current = [self.current[old_index] if old_index >= 0 else 0 for old_index in old_indexes]
+        self.resolvers = resolvers
+        self.resolver_indexes = {ip: i for i, ip in enumerate(resolvers)}
+        self.reply_timeout = reply_timeout
+        self.base_quarantine_time = quarantine_time
+        self.update_weights()
+
+    def on_sent(self, resolver_index: int, query: bytes, now: float) -> None:
+        qid = (query[0] << 8) | query[1]
+        self.sent_resolver[qid] = resolver_index
+        self.sent_time[qid] = now
+        self.in_flight.append((now, qid))
+        self.stats[resolver_index].sent += 1
+
+    def on_reply(self, data: bytes, ip: str, now: float) -> None:
+        if len(data) < 12 or not (data[2] & 0x80):
+            return
+        qid = (data[0] << 8) | data[1]
+        resolver_index = self.sent_resolver[qid]
+        if resolver_index < 0 or self.resolver_indexes.get(ip) != resolver_index:
+            return
+        self.sent_resolver[qid] = -1
+        stats = self.stats[resolver_index]
+        rcode = data[3] & 0x0F
+        stats.replies += 1
+        stats.rcodes[rcode] += 1
+        rtt = now - self.sent_time[qid]
+        if stats.replies == 1:
+            stats.rtt = rtt
+        else:
+            stats.rtt += (rtt - stats.rtt) * EWMA_ALPHA
+        stats.sample(1.0 if rcode == 0 else 0.0)
+
+    def sweep(self, now: float) -> list[int]:
+        """
+        counts unanswered queries as lost, updates states and weights, returns the resolvers that need a probe.
+        """
+        in_flight = self.in_flight
+        deadline = now - self.reply_timeout
+        sent_resolver = self.sent_resolver
+        sent_time = self.sent_time
+        while in_flight and in_flight[0][0] < deadline:
+            sent_at, qid = in_flight.popleft()
+            resolver_index = sent_resolver[qid]
+            if resolver_index >= 0 and sent_time[qid] == sent_at:
+                sent_resolver[qid] = -1
+                stats = self.stats[resolver_index]
+                stats.lost += 1
+                stats.sample(0.0)
+
+        to_probe = []
+        for i, stats in enumerate(self.stats):
+            if stats.state == ACTIVE and stats.quarantine_time and now >= stats.decay_at:
+                stats.quarantine_time /= 2
+                if stats.quarantine_time < self.base_quarantine_time:
+                    stats.quarantine_time = 0.0
+                stats.decay_at = now + QUARANTINE_DECAY_TIME
+            if stats.state == QUARANTINED and now >= stats.quarantine_until:
+                stats.state = PROBING
+                stats.success = QUARANTINE_SUCCESS
+                stats.samples = 0
+            if stats.samples < MIN_SAMPLES // 4:
+                if stats.state == PROBING:
+                    to_probe.append(i)
+                continue
+            if stats.state == PROBING and stats.success >= RECOVER_SUCCESS:
+                stats.state = ACTIVE
+                stats.samples = 0
+                stats.decay_at = now + QUARANTINE_DECAY_TIME
+                print("resolver recovered:", self.resolvers[i], self.describe(i))
+            elif stats.state != QUARANTINED and stats.samples >= MIN_SAMPLES and stats.success < QUARANTINE_SUCCESS:
+                stats.quarantine_time = min(max(stats.quarantine_time * 2, self.base_quarantine_time),
+                                            MAX_QUARANTINE_TIME)
+                stats.quarantine_until = now + stats.quarantine_time
+                stats.state = QUARANTINED
+                print("resolver quarantined:", self.resolvers[i], self.describe(i))
+            elif stats.state == PROBING:
+                to_probe.append(i)
+        self.update_weights()
+        return to_probe
+
+    def update_weights(self) -> None:
+        active = [i for i, stats in enumerate(self.stats) if stats.state == ACTIVE]
+        if not active:
+            # better a bad resolver than none at all
+            active = list(range(len(self.stats)))
+        best_rtt = min((self.stats[i].rtt for i in active if self.stats[i].replies), default=0.0)
+        for i in active:
+            stats = self.stats[i]
+            rtt_factor = 1.0
+            if stats.replies and stats.rtt > 0:
+                rtt_factor = max(0.1, min(1.0, best_rtt / stats.rtt))
+            stats.weight = max(1, round(100 * stats.success * rtt_factor))
+        self.eligible = active
+
+    def next_resolver(self) -> int:
+        """
+        smooth weighted round-robin over the eligible resolvers
+        """
+        current = self.current
+        stats = self.stats
+        best = -1
+        best_current = 0
+        total = 0
+        for i in self.eligible:
+            weight = stats[i].weight
+            total += weight
+            c = current[i] + weight
+            current[i] = c
+            if best < 0 or c > best_current:
+                best = i
+                best_current = c
+        current[best] -= total
+        return best
+
+    def describe(self, resolver_index: int) -> dict:
+        stats = self.stats[resolver_index]
+        return {
+            "sent": stats.sent,
+            "replies": stats.replies,
+            "lost": stats.lost,
+            "rtt": round(stats.rtt, 4),
+            "success": round(stats.success, 3),
+            "weight": stats.weight,
+            "state": ("active", "quarantined", "probing")[stats.state],
+            "rcodes": {RCODE_NAMES.get(rcode, str(rcode)): count for rcode, count in enumerate(stats.rcodes) if count},
+        }
+
+    async def monitor(self, send_probe) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(SWEEP_INTERVAL)
+            for resolver_index in self.sweep(loop.time()):
+                try:
+                    send_probe(resolver_index)
+                except Exception as e:
+                    print("probe send error:", e, self.resolvers[resolver_index])
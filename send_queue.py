@@ -0,0 +1,183 @@
+import asyncio
+import math
+from collections import deque
+
+from metrics import Histogram
+
+# bytes a flow may send in its turn of the round robin (deficit round robin)
+FLOW_QUANTUM = 1500
+
+
+class SendQueue:
+    """
+    the packets that wait to be sent to one resolver, with codel (rfc 8289) on dequeue: once every packet waited
+    longer than target for at least interval, packets are dropped at the head, more often the longer it lasts,
+    so the flows in the tunnel see the congestion instead of a standing queue.
+    a packet that does not fit in max_packets/max_bytes drops the oldest ones (head-drop) of the flow with the most
+    bytes. the flows (sessions) take turns with deficit round robin, so one busy session does not delay the others.
+    one consumer (get) per queue. a target of 0 disables codel.
+    """
+
+    def __init__(self, max_packets: int, max_bytes: int, target: float, interval: float) -> None:
+        self.max_packets = max_packets
+        self.max_bytes = max_bytes
+        self.target = target if target > 0 else math.inf
+        self.interval = interval
+        # {flow: deque of (enqueue time, bytes, item)}, in the order of their turns
+        self.flows: dict[int, deque[tuple[float, int, object]]] = {}
+        self.flow_bytes: dict[int, int] = {}
+        self.deficits: dict[int, int] = {}
+        self.active: deque[int] = deque()
+        self.packets = 0
+        self.bytes = 0
+        self.waiter: asyncio.Future | None = None
+        # codel state
+        self.first_above_time = 0.0
+        self.dropping = False
+        self.drop_next = 0.0
+        self.count = 0
+        self.last_count = 0
+        # counters since start
+        self.enqueued = 0
+        self.dequeued = 0
+        self.dropped_overflow = 0
+        self.dropped_codel = 0
+        self.dropped_delayed = 0  # counted by the consumer, older than packets_wait_time_limit when sent
+        self.delay_sum = 0.0
+        self.delay_max = 0.0
+        self.delay_histogram = Histogram(1000, "ms")
+
+    def __len__(self) -> int:
+        return self.packets
+
+    def _drop_head(self, flow: int) -> None:
+        queue = self.flows[flow]
+        size = queue.popleft()[1]
+        self.bytes -= size
+        self.flow_bytes[flow] -= size
+        self.packets -= 1
+        if not queue:
+            self._remove_flow(flow)
+
+    def _remove_flow(self, flow: int) -> None:
+        del self.flows[flow]
+        del self.flow_bytes[flow]
+        del self.deficits[flow]
+        self.active.remove(flow)
+
+    def put(self, now: float, item, size: int, flow: int = 0) -> None:
+        while self.packets and (self.packets >= self.max_packets or self.bytes + size > self.max_bytes):
+            flow_bytes = self.flow_bytes
+            self._drop_head(max(flow_bytes, key=flow_bytes.__getitem__) if len(flow_bytes) > 1 else self.active[0])
+            self.dropped_overflow += 1
+        queue = self.flows.get(flow)
+        if queue is None:
+            queue = self.flows[flow] = deque()
+            self.flow_bytes[flow] = 0
+            self.deficits[flow] = FLOW_QUANTUM
+            self.active.append(flow)
+        queue.append((now, size, item))
+        self.flow_bytes[flow] += size
+        self.packets += 1
+        self.bytes += size
+        self.enqueued += 1
+        waiter = self.waiter
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    def _pop(self, now: float) -> tuple[float, object, bool]:
+        # (enqueue time, item, ok to drop) of the head of the flow whose turn it is
+        active = self.active
+        deficits = self.deficits
+        flow = active[0]
+        queue = self.flows[flow]
+        if len(active) > 1:
+            while deficits[flow] <= 0:
+                deficits[flow] += FLOW_QUANTUM
+                active.rotate(-1)
+                flow = active[0]
+            queue = self.flows[flow]
+            deficits[flow] -= queue[0][1]
+        enqueue_time, size, item = queue.popleft()
+        self.flow_bytes[flow] -= size
+        self.bytes -= size
+        self.packets -= 1
+        if not queue:
+            self._remove_flow(flow)
+        sojourn = now - enqueue_time
+        if sojourn < self.target or not self.packets:
+            self.first_above_time = 0.0
+            return enqueue_time, item, False
+        if self.first_above_time == 0.0:
+            self.first_above_time = now + self.interval
+            return enqueue_time, item, False
+        return enqueue_time, item, now >= self.first_above_time
+
+    def _control_law(self, t: float) -> float:
+        return t + self.interval / math.sqrt(self.count)
+
+    def dequeue(self, now: float):
+        """
+        the next item that codel does not drop, None if the queue is empty
+        """
+        if not self.packets:
+            self.dropping = False
+            return None
+        enqueue_time, item, ok_to_drop = self._pop(now)
+        if self.dropping:
+            if not ok_to_drop:
+                self.dropping = False
+            while self.dropping and now >= self.drop_next:
+                self.dropped_codel += 1
+                self.count += 1
+                if not self.packets:
+                    self.dropping = False
+                    return None
+                enqueue_time, item, ok_to_drop = self._pop(now)
+                if not ok_to_drop:
+                    self.dropping = False
+                else:
+                    self.drop_next = self._control_law(self.drop_next)
+        elif ok_to_drop:
+            self.dropped_codel += 1
+            if not self.packets:
+                return None
+            enqueue_time, item, _ = self._pop(now)
+            self.dropping = True
+            # a new dropping state soon after the last one goes on with its drop rate
+            delta = self.count - self.last_count
+            self.count = delta if delta > 1 and now - self.drop_next < 16 * self.interval else 1
+            self.drop_next = self._control_law(now)
+            self.last_count = self.count
+        delay = now - enqueue_time
+        self.dequeued += 1
+        self.delay_sum += delay
+        if delay > self.delay_max:
+            self.delay_max = delay
+        self.delay_histogram.record(delay)
+        return item
+
+    async def get(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            while not self.packets:
+                self.waiter = loop.create_future()
+                await self.waiter
+                self.waiter = None
+            item = self.dequeue(loop.time())
+            if item is not None:
+                return item
+
+    def describe(self, histogram: bool = False) -> dict:
+        """
+        the counters since start
+        """
+        result = {"queued": self.packets, "queued_bytes": self.bytes, "flows": len(self.flows),
+                  "enqueued": self.enqueued,
+                  "sent": self.dequeued, "dropped_overflow": self.dropped_overflow,
+                  "dropped_codel": self.dropped_codel, "dropped_delayed": self.dropped_delayed,
+                  "delay_avg_ms": round(self.delay_sum / self.dequeued * 1000, 1) if self.dequeued else 0.0,
+                  "delay_max_ms": round(self.delay_max * 1000, 1)}
+        if histogram:
+            result["delay"] = self.delay_histogram.describe()
+        return result
@@ -0,0 +1,131 @@
+import asyncio
+import sys
+from collections import deque
+
+# asyncio timers fire at about this granularity, a bucket must be able to hold the tokens of one tick
+TIMER_RESOLUTION = 0.016 if sys.platform == "win32" else 0.001
+
+
+class _TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "last", "waiters")
+
+    def __init__(self, rate: float, burst: float, now: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = now
+        self.waiters = deque()
+
+    def max_tokens(self) -> float:
+        # what a backlogged bucket may carry over: burst and the tokens of one late timer tick, a longer stall (event
+        # loop, gc pause, reload) is not paid back as a burst to the resolver
+        return self.burst + self.rate * TIMER_RESOLUTION
+
+    def refill(self, now: float) -> None:
+        tokens = self.tokens + (now - self.last) * self.rate
+        if tokens > self.burst:
+            # idle time only fills up to burst, tokens still owed from a late timer tick are kept up to max_tokens()
+            tokens = min(self.tokens, self.max_tokens()) if self.tokens > self.burst else self.burst
+        self.tokens = tokens
+        self.last = now
+
+
+class SendScheduler:
+    """
+    paces sends with one token bucket per resolver, all buckets share a single timer,
+    so a tick releases every waiter that has a token instead of one sleep per fragment.
+    a rate of 0 means unlimited.
+    """
+
+    def __init__(self, rates: list[float], burst: float) -> None:
+        self.loop = asyncio.get_running_loop()
+        now = self.loop.time()
+        self.buckets: list[_TokenBucket | None] = []
+        for rate in rates:
+            if rate > 0:
+                self.buckets.append(_TokenBucket(rate, max(burst, 1.0, rate * TIMER_RESOLUTION), now))
+            else:
+                self.buckets.append(None)
+        self.pending: set[_TokenBucket] = set()
+        self.timer: asyncio.TimerHandle | None = None
+        self.timer_when = 0.0
+
+    def set_rates(self, rates: list[float], burst: float, old_indexes: list[int]) -> None:
+        """
+        the rates after a reload, old_indexes[i] is the index of rates[i] before (-1 for a new one). the kept buckets
+        keep their tokens and waiters, the waiters of the removed ones are released.
+        """
+        now = self.loop.time()
+        buckets = []
+        for rate, old_index in zip(rates, old_indexes):
+            bucket = self.buckets[old_index] if old_index >= 0 else None
+            if rate <= 0:
+                buckets.append(None)
+            elif bucket is None:
+                buckets.append(_TokenBucket(rate, max(burst, 1.0, rate * TIMER_RESOLUTION), now))
+            else:
+                # the tokens of the time before are counted at the old rate
+                bucket.refill(now)
+                bucket.rate = rate
+                bucket.burst = max(burst, 1.0, rate * TIMER_RESOLUTION)
+                buckets.append(bucket)
+                if bucket in self.pending:
+                    self._schedule(bucket.last + max(0.0, 1.0 - bucket.tokens) / rate)
+        for bucket in self.buckets:
+            if bucket is not None and bucket not in buckets:
+                self.pending.discard(bucket)
+                while bucket.waiters:
+                    waiter = bucket.waiters.popleft()
+                    if not waiter.done():
+                        waiter.set_result(None)
+        self.buckets = buckets
+
+    def acquire(self, index: int) -> asyncio.Future | None:
+        """
+        takes one token of the resolver, returns None if it is available now, else a future to await.
+        """
+        bucket = self.buckets[index]
+        if bucket is None:
+            return None
+        if not bucket.waiters:
+            bucket.refill(self.loop.time())
+            if bucket.tokens >= 1.0:
+                bucket.tokens -= 1.0
+                return None
+        waiter = self.loop.create_future()
+        bucket.waiters.append(waiter)
+        if bucket not in self.pending:
+            self.pending.add(bucket)
+            self._schedule(bucket.last + (1.0 - bucket.tokens) / bucket.rate)
+        return waiter
+
+    def _schedule(self, when: float) -> None:
+        if self.timer is not None:
+            if self.timer_when <= when + TIMER_RESOLUTION:
+                return
+            self.timer.cancel()
+        self.timer_when = when
+        self.timer = self.loop.call_at(when, self._on_timer)
+
+    def _on_timer(self) -> None:
+        self.timer = None
+        now = self.loop.time()
+        next_due = None
+        for bucket in tuple(self.pending):
+            # a backlogged bucket is not capped at burst, tokens lost to a late timer are still owed up to max_tokens()
+            bucket.tokens = min(bucket.tokens + (now - bucket.last) * bucket.rate, bucket.max_tokens())
+            bucket.last = now
+            waiters = bucket.waiters
+            while waiters and bucket.tokens >= 1.0:
+                waiter = waiters.popleft()
+                if not waiter.done():
+                    waiter.set_result(None)
+                    bucket.tokens -= 1.0
+            if waiters:
+                due = now + (1.0 - bucket.tokens) / bucket.rate
+                if next_due is None or due < next_due:
+                    next_due = due
+            else:
+                self.pending.discard(bucket)
+        if next_due is not None:
+            self._schedule(max(next_due, now + TIMER_RESOLUTION))
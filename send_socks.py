@@ -0,0 +1,190 @@
+import asyncio
+import math
+import random
+import socket
+
+# the pool is sized to the send rate, and old sockets are rotated, this often
+SEND_SOCK_TICK = 1.0
+# weight of the last tick in a falling send rate
+SEND_RATE_ALPHA = 0.2
+
+
+class PoolSocket:
+    __slots__ = ("sock", "port", "sends", "errors", "expires")
+
+    def __init__(self, sock: socket.socket, expires: float) -> None:
+        self.sock = sock
+        self.port = sock.getsockname()[1]
+        self.sends = 0
+        self.errors = 0
+        self.expires = expires
+
+
+class SendSocketPool:
+    """
+    the udp sockets that send the DNS-Queries, each with its own source port. they are opened when needed: one more
+    whenever the sends of this tick go over sock_rate per open socket (sock_rate 0: on every send), up to max_socks,
+    and the ones that the send rate does not need any more are closed. with rotate_time every socket is replaced by a
+    new one after about that many seconds, and a socket that fails to send is replaced right away. the replaced and
+    closed sockets still receive replies for linger seconds, the replies go to on_readable(sock).
+    """
+
+    def __init__(self, bind_ip: str, max_socks: int, sock_rate: float, rotate_time: float, linger: float,
+                 on_readable) -> None:
+        self.bind_ip = bind_ip
+        self.max_socks = max(1, max_socks)
+        self.sock_rate = sock_rate
+        self.rotate_time = rotate_time
+        self.linger = linger
+        self.on_readable = on_readable
+        self.socks: list[PoolSocket] = []
+        self.next_index = 0
+        self.tick_sends = 0
+        self.tick_limit = 0  # one more socket is opened after this many sends in a tick
+        self.send_rate = 0.0
+        self.opened = 0
+        self.rotated = 0
+        self.replaced = 0
+        self.open_errors = 0
+        self.last_open_error: OSError | None = None
+        self.closed_sends = 0
+        self.closed_errors = 0
+
+    def __len__(self) -> int:
+        return len(self.socks)
+
+    def _open(self) -> PoolSocket | None:
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            s.setblocking(False)
+            s.bind((self.bind_ip, 0))
+        except OSError as e:
+            s.close()
+            # printed once per tick by maintain()
+            self.open_errors += 1
+            self.last_open_error = e
+            return None
+        loop = asyncio.get_running_loop()
+        loop.add_reader(s.fileno(), self.on_readable, s)
+        self.opened += 1
+        expires = loop.time() + self.rotate_time * random.uniform(0.5, 1.5) if self.rotate_time > 0 else math.inf
+        return PoolSocket(s, expires)
+
+    def _close(self, pool_sock: PoolSocket) -> None:
+        s = pool_sock.sock
+        if s.fileno() >= 0:
+            asyncio.get_running_loop().remove_reader(s.fileno())
+        s.close()
+
+    def _retire(self, pool_sock: PoolSocket) -> None:
+        self.closed_sends += pool_sock.sends
+        self.closed_errors += pool_sock.errors
+        # the replies of its last queries may still come
+        asyncio.get_running_loop().call_later(self.linger, self._close, pool_sock)
+
+    def _update_tick_limit(self) -> None:
+        self.tick_limit = int(len(self.socks) * self.sock_rate * SEND_SOCK_TICK)
+
+    def next(self) -> PoolSocket:
+        """
+        the socket for the next query (round robin), raises OSError if there is none and none can be opened
+        """
+        socks = self.socks
+        self.tick_sends += 1
+        if self.tick_sends > self.tick_limit and len(socks) < self.max_socks or not socks:
+            pool_sock = self._open()
+            if pool_sock is not None:
+                socks.append(pool_sock)
+                self._update_tick_limit()
+            elif not socks:
+                raise OSError(f"no send socket: {self.last_open_error}")
+        index = self.next_index
+        if index >= len(socks):
+            index = 0
+        self.next_index = index + 1
+        pool_sock = socks[index]
+        pool_sock.sends += 1
+        return pool_sock
+
+    def failed(self, pool_sock: PoolSocket) -> None:
+        """
+        replaces a socket that could not send, the next queries go to the other sockets meanwhile
+        """
+        pool_sock.errors += 1
+        try:
+            index = self.socks.index(pool_sock)
+        except ValueError:
+            # already replaced or closed
+            return
+        self._retire(pool_sock)
+        new_sock = self._open()
+        if new_sock is None:
+            # it is opened again when the send rate needs it
+            del self.socks[index]
+            self._update_tick_limit()
+        else:
+            self.socks[index] = new_sock
+        self.replaced += 1
+
+    def maintain(self, now: float) -> None:
+        """
+        called every SEND_SOCK_TICK: closes the sockets that the send rate does not need and rotates the old ones
+        """
+        tick_rate = self.tick_sends / SEND_SOCK_TICK
+        # it follows a rising rate at once and a falling one slowly, so a burst does not close the sockets it opened
+        if tick_rate > self.send_rate:
+            self.send_rate = tick_rate
+        else:
+            self.send_rate += SEND_RATE_ALPHA * (tick_rate - self.send_rate)
+        self.tick_sends = 0
+        if self.open_errors and self.last_open_error is not None:
+            print("send socket open errors:", self.open_errors, self.last_open_error)
+            self.last_open_error = None
+        keep = self.max_socks
+        if self.sock_rate > 0:
+            # some room above the rate, so a small change of it does not close and open sockets every tick
+            needed = max(1, math.ceil(self.send_rate / self.sock_rate))
+            keep = min(keep, needed + needed // 4 + 1)
+        if len(self.socks) > keep:
+            for pool_sock in self.socks[keep:]:
+                self._retire(pool_sock)
+            del self.socks[keep:]
+        if self.rotate_time > 0:
+            for i, pool_sock in enumerate(self.socks):
+                if now >= pool_sock.expires:
+                    new_sock = self._open()
+                    if new_sock is None:
+                        break
+                    self._retire(pool_sock)
+                    self.socks[i] = new_sock
+                    self.rotated += 1
+        self._update_tick_limit()
+
+    def set_limits(self, max_socks: int, sock_rate: float, rotate_time: float, linger: float) -> None:
+        self.max_socks = max(1, max_socks)
+        self.sock_rate = sock_rate
+        self.linger = linger
+        if rotate_time != self.rotate_time:
+            self.rotate_time = rotate_time
+            now = asyncio.get_running_loop().time()
+            for pool_sock in self.socks:
+                pool_sock.expires = now + rotate_time * random.uniform(0.5, 1.5) if rotate_time > 0 else math.inf
+        if len(self.socks) > self.max_socks:
+            for pool_sock in self.socks[self.max_socks:]:
+                self._retire(pool_sock)
+            del self.socks[self.max_socks:]
+        self._update_tick_limit()
+
+    def close(self) -> None:
+        for pool_sock in self.socks:
+            self._close(pool_sock)
+        self.socks.clear()
+
+    def describe(self) -> dict:
+        return {"open": len(self.socks), "max": self.max_socks, "send_rate": round(self.send_rate, 1),
+                "opened": self.opened, "rotated": self.rotated, "replaced": self.replaced,
+                "open_errors": self.open_errors,
+                "sends": self.closed_sends + sum(pool_sock.sends for pool_sock in self.socks),
+                "errors": self.closed_errors + sum(pool_sock.errors for pool_sock in self.socks),
+                # [source port, sends, send errors] of the open sockets
+                "sockets": [[pool_sock.port, pool_sock.sends, pool_sock.errors] for pool_sock in self.socks]}
@@ -0,0 +1,172 @@
+import asyncio
+import socket
+
+# with sessions every datagram in the tunnel starts with its session id: 1 byte below 128, else 2 bytes big-endian with
+# the high bit set (like the lengths of coalesced datagrams)
+MAX_SESSION_ID = 0x7FFF
+
+
+def add_session(session_id: int, data: bytes) -> bytes:
+    if session_id < 0x80:
+        return bytes((session_id,)) + data
+    return (0x8000 | session_id).to_bytes(2, "big") + data
+
+
+def split_session(data: bytes) -> tuple[int, bytes]:
+    if not data:
+        raise ValueError("no session id")
+    session_id = data[0]
+    if session_id & 0x80:
+        if len(data) < 2:
+            raise ValueError("invalid session id")
+        return (session_id & 0x7F) << 8 | data[1], data[2:]
+    return session_id, data[1:]
+
+
+class SessionTable:
+    """
+    the h side addresses on the side without h_out_address: every new source address gets a session id, sessions
+    that sent nothing for timeout seconds are forgotten. each worker hands out the ids equal to its id modulo the
+    workers count (first, step) and tells the others with learn(), and again for its live sessions every timeout / 2
+    (announcements()), the learned sessions that were not told again for timeout seconds are forgotten too.
+    """
+
+    def __init__(self, timeout: float, first: int = 0, step: int = 1) -> None:
+        self.timeout = timeout
+        self.first = first
+        self.step = step
+        self.next_id = first
+        self.sessions: dict[tuple, int] = {}  # {addr: session id}, own sessions
+        self.last_seen: dict[int, float] = {}  # {session id: time}, own sessions
+        self.addrs: dict[int, tuple] = {}  # {session id: addr}, own and learned sessions
+        self.announced: dict[int, float] = {}  # {session id: time}, own sessions, when the others were told
+        self.learned: dict[int, float] = {}  # {session id: time}, learned sessions
+
+    def __len__(self) -> int:
+        return len(self.sessions)
+
+    def session_of(self, addr: tuple, now: float) -> tuple[int, bool]:
+        """
+        (session id, new) of a source address, the session id is -1 if all of them are in use
+        """
+        session_id = self.sessions.get(addr)
+        if session_id is not None:
+            self.last_seen[session_id] = now
+            return session_id, False
+        for _ in range(MAX_SESSION_ID // self.step + 1):
+            session_id = self.next_id
+            self.next_id += self.step
+            if self.next_id > MAX_SESSION_ID:
+                self.next_id = self.first
+            if session_id not in self.last_seen:
+                break
+        else:
+            return -1, False
+        self.sessions[addr] = session_id
+        self.last_seen[session_id] = now
+        self.announced[session_id] = now
+        self.addrs[session_id] = addr
+        return session_id, True
+
+    def learn(self, session_id: int, addr: tuple, now: float) -> None:
+        if session_id in self.last_seen:
+            return
+        self.addrs[session_id] = addr
+        self.learned[session_id] = now
+
+    def announcements(self, now: float) -> list[tuple[int, tuple]]:
+        """
+        (session id, addr) of the own sessions that the other workers must be told again
+        """
+        due = []
+        for session_id, announced in self.announced.items():
+            if now - announced >= self.timeout / 2:
+                self.announced[session_id] = now
+                due.append((session_id, self.addrs[session_id]))
+        return due
+
+    def addr_of(self, session_id: int) -> tuple | None:
+        return self.addrs.get(session_id)
+
+    def expire(self, now: float) -> None:
+        for addr, session_id in list(self.sessions.items()):
+            if now - self.last_seen[session_id] > self.timeout:
+                del self.sessions[addr]
+                del self.last_seen[session_id]
+                del self.announced[session_id]
+                del self.addrs[session_id]
+        for session_id, learned in list(self.learned.items()):
+            if now - learned > self.timeout:
+                del self.learned[session_id]
+                del self.addrs[session_id]
+
+
+class SessionBackends:
+    """
+    the side with h_out_address gives every session its own udp socket to its backend (backends[session id modulo
+    their count]), so each client of the other side is a separate client for the backend. the replies of the backend
+    go to on_reply(session_id, datagrams). sockets that were idle for timeout seconds are closed.
+    """
+
+    def __init__(self, backends: list[tuple], timeout: float, on_reply) -> None:
+        self.backends = backends
+        self.timeout = timeout
+        self.on_reply = on_reply
+        self.sockets: dict[int, socket.socket] = {}
+        self.last_seen: dict[int, float] = {}
+
+    def __len__(self) -> int:
+        return len(self.sockets)
+
+    def _open(self, session_id: int) -> socket.socket:
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.setblocking(False)
+        s.connect(self.backends[session_id % len(self.backends)])
+        asyncio.get_running_loop().add_reader(s.fileno(), self._readable, session_id, s)
+        self.sockets[session_id] = s
+        return s
+
+    def _close(self, session_id: int) -> None:
+        s = self.sockets.pop(session_id)
+        self.last_seen.pop(session_id, None)
+        if s.fileno() >= 0:
+            asyncio.get_running_loop().remove_reader(s.fileno())
+        s.close()
+
+    def _readable(self, session_id: int, s: socket.socket) -> None:
+        datagrams = []
+        while True:
+            try:
+                datagrams.append(s.recv(65575))
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as e:
+                # for example the backend is not listening (connection refused), a new socket is opened for the next
+                # datagram of the session
+                print("session socket recv error:", session_id, e)
+                if self.sockets.get(session_id) is s:
+                    self._close(session_id)
+                break
+        if datagrams:
+            self.last_seen[session_id] = asyncio.get_running_loop().time()
+            self.on_reply(session_id, datagrams)
+
+    def send(self, session_id: int, data: bytes, now: float) -> None:
+        s = self.sockets.get(session_id)
+        try:
+            if s is None:
+                s = self._open(session_id)
+            s.send(data)
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError as e:
+            print("session socket send error:", session_id, e)
+            if session_id in self.sockets:
+                self._close(session_id)
+            return
+        self.last_seen[session_id] = now
+
+    def expire(self, now: float) -> None:
+        for session_id, last_seen in list(self.last_seen.items()):
+            if now - last_seen > self.timeout:
+                self._close(session_id)
@@ -0,0 +1,27 @@
+import os
+import stat
+import sys
+
+import pytest
+
+from capture import H_DATAGRAM, WAN_QUERY, Capture, read_capture
+
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / "capture.bin")
+    capture = Capture(path, 0, 10.0)
+    capture.write(H_DATAGRAM, [b"abc", b""], 10.5)
+    capture.write(WAN_QUERY, [b"query"], 11.0)
+    capture.close()
+    assert list(read_capture(path)) == [(0.0, H_DATAGRAM, b"abc"), (0.0, H_DATAGRAM, b""), (0.5, WAN_QUERY, b"query")]
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="posix file modes")
+def test_only_the_owner_reads_it(tmp_path):
+    path = str(tmp_path / "capture.bin")
+    # an existing file that others could read
+    with open(path, "wb") as f:
+        f.write(b"old")
+    os.chmod(path, 0o644)
+    Capture(path, 0, 0.0).close()
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
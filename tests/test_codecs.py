@@ -0,0 +1,45 @@
+import math
+import random
+
+import pytest
+
+from utility.base36 import BASE36_BLOCK, BASE36_WIDTHS, b36decode, b36encode_lower
+from utility.codec import PAYLOAD_CODECS, get_payload_codec
+
+# around the base36 block size and longer than the largest packet
+LENGTHS = list(range(0, 80)) + [127, 128, 129, 255, 256, 1199, 1200, 1279, 1280, 1281, 4000]
+
+
+@pytest.mark.parametrize("name", sorted(PAYLOAD_CODECS))
+def test_codec_round_trip(name):
+    codec = get_payload_codec(name)
+    rng = random.Random(name)
+    for length in LENGTHS:
+        for data in (bytes(length), b"\xff" * length, rng.randbytes(length)):
+            encoded = codec.encode(data)
+            # only characters that every resolver keeps in a qname, in lowercase
+            assert encoded == encoded.lower() and not encoded.translate(None, b"abcdefghijklmnopqrstuvwxyz0123456789")
+            assert len(encoded) <= math.ceil(length * 8 / codec.bits_per_char)
+            assert codec.decode(encoded) == data
+            # resolvers may randomize the case of the qname
+            assert codec.decode(encoded.upper()) == data
+
+
+def test_base36_block_boundaries():
+    for length in (BASE36_BLOCK - 1, BASE36_BLOCK, BASE36_BLOCK + 1, 3 * BASE36_BLOCK):
+        data = b"\xff" * length
+        assert len(b36encode_lower(data)) == sum(BASE36_WIDTHS[len(data[i:i + BASE36_BLOCK])]
+                                                 for i in range(0, length, BASE36_BLOCK))
+        assert b36decode(b36encode_lower(data)) == data
+
+
+@pytest.mark.parametrize("data", [b"abc-", b"ab=c", b"a", b"zzzz", b"z" * (BASE36_WIDTHS[BASE36_BLOCK] + 1)])
+def test_base36_rejects_invalid_input(data):
+    with pytest.raises(ValueError):
+        b36decode(data)
+
+
+def test_unknown_codec():
+    assert get_payload_codec("BASE36") is PAYLOAD_CODECS["base36"]
+    with pytest.raises(ValueError):
+        get_payload_codec("base64")
@@ -0,0 +1,65 @@
+import base64
+import random
+
+import pytest
+
+from data_cap import get_base32_final_domains, get_base32_final_queries, get_chunk_len
+from utility.codec import PAYLOAD_CODECS, PayloadCodec
+from utility.dns import QTYPE_A, QTYPE_TXT, QueryTemplate, build_dns_query, encode_qname
+
+# base32 of the standard library without translate(), as the queries were built before the query templates
+STDLIB_BASE32 = PayloadCodec("stdlib_base32", lambda data: base64.b32encode(data).rstrip(b"=").lower(), None, 5.0)
+SEND_DOMAINS = [b"t.example.com", b"tunnel.a-much-longer-send-domain.example.org", b"x.io"]
+
+
+def send_lists(max_domain_len: int, max_sub_len: int, qtype: int, data_offset_width: int) -> tuple[list, list]:
+    domains = []
+    templates = []
+    for domain in SEND_DOMAINS:
+        qname_encoded = encode_qname(domain)
+        chunk_len = get_chunk_len(max_domain_len + 2, len(qname_encoded), max_sub_len, data_offset_width)
+        domains.append((qname_encoded, chunk_len))
+        templates.append((QueryTemplate(qname_encoded, qtype, max_sub_len), chunk_len))
+    return domains, templates
+
+
+def old_queries(data: bytes, data_offset: int, domain_idx: int, domains: list, max_domain_len: int,
+                max_sub_len: int, data_offset_width: int, query_id: int, qtype: int, codec: PayloadCodec) -> list:
+    final_domains = get_base32_final_domains(data, data_offset, domain_idx, domains, max_sub_len, data_offset_width,
+                                             max_domain_len + 2, codec)
+    return [build_dns_query(domain, (query_id + i) & 0xFFFF, qtype) for i, domain in enumerate(final_domains)]
+
+
+@pytest.mark.parametrize("max_domain_len,max_sub_len", [(99, 63), (151, 63), (253, 63), (253, 30), (120, 9)])
+@pytest.mark.parametrize("qtype", [QTYPE_A, QTYPE_TXT])
+def test_templates_match_old_queries(max_domain_len, max_sub_len, qtype):
+    rng = random.Random(max_domain_len * 100 + max_sub_len + qtype)
+    data_offset_width = 4
+    domains, templates = send_lists(max_domain_len, max_sub_len, qtype, data_offset_width)
+    for _ in range(200):
+        data = rng.randbytes(rng.choice([0, 1, 2, 5, 24, 40, 100, 500, 1200, 1400]))
+        data_offset = rng.randrange(32 ** data_offset_width)
+        domain_idx = rng.randrange(len(SEND_DOMAINS))
+        query_id = rng.randrange(0x10000)
+        expected = old_queries(data, data_offset, domain_idx, domains, max_domain_len, max_sub_len,
+                               data_offset_width, query_id, qtype, STDLIB_BASE32)
+        queries = get_base32_final_queries(data, data_offset, domain_idx, templates, data_offset_width, query_id)
+        assert [bytes(query) for query in queries] == expected
+
+
+def test_templates_match_old_queries_base36():
+    rng = random.Random(36)
+    codec = PAYLOAD_CODECS["base36"]
+    domains, templates = send_lists(151, 63, QTYPE_A, 4)
+    for _ in range(200):
+        data = rng.randbytes(rng.randrange(1500))
+        expected = old_queries(data, 1234, 1, domains, 151, 63, 4, 0xFFFE, QTYPE_A, codec)
+        queries = get_base32_final_queries(data, 1234, 1, templates, 4, 0xFFFE, codec)
+        assert [bytes(query) for query in queries] == expected
+
+
+def test_too_many_fragments():
+    domains, templates = send_lists(60, 63, QTYPE_A, 4)
+    data = bytes(5000)
+    assert get_base32_final_domains(data, 0, 0, domains, 63, 4, 62) == []
+    assert get_base32_final_queries(data, 0, 0, templates, 4, 0) == []
@@ -0,0 +1,166 @@
+import asyncio
+import itertools
+import random
+
+from compression import Compressor
+from data_cap import PACKET_COMPRESSED, get_base32_final_queries, get_chunk_data, get_chunk_len, \
+    get_fec_final_queries, get_fec_shard_size
+from data_handler import DataHandler
+from utility.codec import PAYLOAD_CODECS
+from utility.dns import QueryTemplate, RecvDomainIndex, encode_qname
+
+
+def run_with_handler(test, **kwargs):
+    """
+    runs test(handler) on an event loop, DataHandler starts its cleanup task on the running loop
+    """
+
+    async def main():
+        handler = DataHandler(1024, 10.0, **kwargs)
+        try:
+            test(handler)
+        finally:
+            handler.cleaner_task.cancel()
+
+    asyncio.run(main())
+
+
+def feed(handler, key: int, fragments: list) -> list:
+    """
+    fragments: (fragment part, last fragment, data), returns the non-empty results
+    """
+    results = []
+    for fragment_part, last_fragment, data in fragments:
+        result = handler.new_data_event(key, fragment_part, last_fragment, data)
+        if result:
+            results.append(bytes(result))
+    return results
+
+
+def fragments_of(parts: list) -> list:
+    return [(i, i == len(parts) - 1, data) for i, data in enumerate(parts)]
+
+
+def test_in_order():
+    def test(handler):
+        assert feed(handler, 1, fragments_of([b"aa", b"bb", b"cc"])) == [b"aabbcc"]
+        assert feed(handler, 2, fragments_of([b"single"])) == [b"single"]
+        assert handler.completed == 2
+
+    run_with_handler(test)
+
+
+def test_out_of_order():
+    parts = [b"a", b"bb", b"ccc", b"dddd"]
+
+    def test(handler):
+        for key, order in enumerate(itertools.permutations(fragments_of(parts))):
+            assert feed(handler, key, order) == [b"abbcccdddd"], order
+        assert handler.completed == 24
+        assert handler.conflicts == 0
+
+    run_with_handler(test)
+
+
+def test_duplicates():
+    def test(handler):
+        fragments = fragments_of([b"aa", b"bb", b"cc"])
+        assert feed(handler, 1, [fragments[1], fragments[1], fragments[0], fragments[0]]) == []
+        assert handler.duplicates == 2
+        assert feed(handler, 1, [fragments[2]]) == [b"aabbcc"]
+        # copies after the packet is complete are not delivered again
+        assert feed(handler, 1, fragments) == []
+        assert handler.duplicates == 5
+        assert handler.completed == 1
+
+    run_with_handler(test)
+
+
+def test_conflicting_last_fragments():
+    def test(handler):
+        # two different last fragments
+        assert feed(handler, 1, [(0, False, b"aa"), (2, True, b"cc"), (1, True, b"bb")]) == []
+        # a fragment after the last one
+        assert feed(handler, 2, [(1, True, b"bb"), (2, False, b"cc"), (0, False, b"aa")]) == []
+        # a last fragment before a fragment that was already received
+        assert feed(handler, 3, [(2, False, b"cc"), (1, True, b"bb"), (0, False, b"aa")]) == []
+        assert handler.conflicts == 3
+        assert handler.completed == 0
+        # the key stays conflicting until it is released
+        assert feed(handler, 1, [(1, False, b"bb")]) == []
+
+    run_with_handler(test)
+
+
+def test_conflicting_fec_and_plain_fragments():
+    def test(handler):
+        assert handler.new_shard_event(1, 0, 2, 1, b"xx") is None
+        assert handler.new_data_event(1, 1, True, b"yy") == b""
+        assert handler.new_data_event(2, 0, False, b"yy") == b""
+        assert handler.new_shard_event(2, 1, 2, 1, b"xx") is None
+        # different n, k or shard size than the first shard
+        assert handler.new_shard_event(3, 0, 2, 1, b"xx") is None
+        assert handler.new_shard_event(3, 1, 3, 1, b"xx") is None
+        assert handler.new_shard_event(4, 0, 2, 1, b"xx") is None
+        assert handler.new_shard_event(4, 1, 2, 1, b"xxx") is None
+        assert handler.conflicts == 4
+        # any n shards complete a fec packet, once
+        assert handler.new_shard_event(5, 2, 2, 1, b"pp") is None
+        assert handler.new_shard_event(5, 2, 2, 1, b"pp") is None
+        assert handler.new_shard_event(5, 0, 2, 1, b"aa") == {2: b"pp", 0: b"aa"}
+        assert handler.new_shard_event(5, 1, 2, 1, b"bb") is None
+        assert handler.duplicates == 2
+        assert handler.completed == 1
+
+    run_with_handler(test)
+
+
+def test_released_key_is_free_again():
+    def test(handler):
+        assert feed(handler, 1, [(0, False, b"aa")]) == []
+        for _ in range(handler.wheel_ticks + 1):
+            handler.tick()
+        assert handler.timeouts == 1
+        assert feed(handler, 1, fragments_of([b"new"])) == [b"new"]
+
+    run_with_handler(test)
+
+
+def test_fragment_event_decodes_packets():
+    codec = PAYLOAD_CODECS["base32"]
+    compressor = Compressor()
+    qname_encoded = encode_qname(b"t.example.com")
+    chunk_len = get_chunk_len(101, len(qname_encoded), 63, 3)
+    templates = [(QueryTemplate(qname_encoded, 1, 63), chunk_len)]
+    shard_size = get_fec_shard_size(chunk_len, codec)
+    index = RecvDomainIndex([b"t.example.com"])
+    rng = random.Random(5)
+
+    def test(handler):
+        for data_offset in range(0, 200, 7):
+            packet = rng.randbytes(rng.randrange(1, 600))
+            packet_flags = 0
+            data = packet
+            if data_offset % 2:
+                data = compressor.compress(b"x" * 500 + packet)
+                packet = b"x" * 500 + packet
+                packet_flags = PACKET_COMPRESSED
+            # the epoch above the 10 bits of the 1024 keys
+            wire_offset = data_offset | 3 << 10
+            if data_offset % 3:
+                queries = get_fec_final_queries(data, wire_offset, 0, templates, 3, 0, shard_size, 0.5, codec,
+                                                packet_flags)
+                # a parity fragment instead of the first data fragment
+                queries = queries[1:]
+            else:
+                queries = get_base32_final_queries(data, wire_offset, 0, templates, 3, 0, codec, packet_flags)
+            results = []
+            for query in reversed(queries):
+                fragment = get_chunk_data(index.handle_dns_request(bytes(query))[2], 3)
+                result = handler.new_fragment_event(*fragment, codec, compressor)
+                if result is not None:
+                    results.append(result)
+            assert results == [packet]
+            assert handler.epochs[data_offset] == 3
+
+    run_with_handler(test)
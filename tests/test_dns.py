@@ -0,0 +1,169 @@
+import random
+
+import pytest
+
+import json
+import os
+from struct import pack
+
+from utility.dns import OPT_RR_SIZE, QTYPE_A, QTYPE_OPT, QTYPE_TXT, QueryTemplate, RecvDomainIndex, answer_capacity, \
+    build_dns_query, create_data_response, encode_qname, get_edns_udp_size, insert_dots, pack_questions, \
+    query_edns_udp_size
+
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "config.json")
+
+RECV_DOMAINS = [b"t.example.com", b"Other.Example.Org", b"example.com"]
+
+
+def query(payload: bytes, domain: bytes, qtype: int = QTYPE_A, q_id: int = 0x1234) -> bytes:
+    return build_dns_query(insert_dots(payload) + encode_qname(domain), q_id, qtype)
+
+
+def multi_question_query(questions: list) -> bytes:
+    data = bytearray(query(*questions[0]))
+    data[5] = len(questions)
+    for payload, domain in questions[1:]:
+        data += query(payload, domain)[12:]
+    return bytes(data)
+
+
+def template_query(edns_udp_size: int, payload: bytes = b"abcd", q_id: int = 0x1234) -> bytes:
+    return bytes(QueryTemplate(encode_qname(b"t.example.com"), QTYPE_TXT, 63, edns_udp_size).build(q_id, b"", payload))
+
+
+def resolver_upstream_query(data: bytes, next_question: int, udp_size: int) -> bytes:
+    # what a recursive resolver sends to the other side: the questions with its own OPT record
+    return b"".join((data[:10], b"\x00\x01", data[12:next_question], pack("!BHHIH", 0, QTYPE_OPT, udp_size, 0, 0)))
+
+
+def test_payload_and_recv_domain():
+    index = RecvDomainIndex(RECV_DOMAINS)
+    payload = bytes(random.Random(1).choice(b"abcdefghijklmnopqrstuvwxyz234567") for _ in range(150))
+    qid, qflags, payloads, qtype, next_question = index.handle_dns_request_questions(
+        query(payload, b"T.EXAMPLE.com", QTYPE_TXT))
+    assert (qid, qflags, qtype) == (0x1234, 0x0100, QTYPE_TXT)
+    assert [bytes(p) for p in payloads] == [payload]
+    # a single label payload
+    assert bytes(index.handle_dns_request_questions(query(b"abc", b"other.example.org"))[2][0]) == b"abc"
+    # the longest recv domain that is first in the config wins
+    assert bytes(index.handle_dns_request_questions(query(b"abc", b"t.example.com"))[2][0]) == b"abc"
+    assert bytes(index.handle_dns_request_questions(query(b"abc", b"u.example.com"))[2][0]) == b"abcu"
+    assert index.handle_dns_request_questions(query(b"", b"example.com"))[2] == [b""]
+
+
+def test_multiple_questions():
+    index = RecvDomainIndex(RECV_DOMAINS)
+    data = multi_question_query([(b"aaaa", b"t.example.com"), (b"bbbb", b"other.example.org")])
+    _, _, payloads, _, next_question = index.handle_dns_request_questions(data)
+    assert [bytes(p) for p in payloads] == [b"aaaa", b"bbbb"]
+    assert next_question == len(data)
+    with pytest.raises(ValueError):
+        index.handle_dns_request_questions(data, max_questions=1)
+    with pytest.raises(ValueError):
+        index.handle_dns_request_questions(
+            multi_question_query([(b"aaaa", b"t.example.com"), (b"bbbb", b"not-a-recv-domain.net")]))
+
+
+@pytest.mark.parametrize("data", [
+    b"",
+    bytes(17),
+    # a response
+    b"\x12\x34\x81\x00" + query(b"abc", b"t.example.com")[4:],
+    # no question
+    b"\x12\x34\x01\x00\x00\x00" + query(b"abc", b"t.example.com")[6:],
+    # not a recv domain
+    query(b"abc", b"t.example.net"),
+    # label longer than 63
+    query(b"abc", b"t.example.com")[:12] + b"\x40" + bytes(64) + b"\x00\x00\x01\x00\x01",
+    # class CH
+    query(b"abc", b"t.example.com")[:-1] + b"\x03",
+    # cut in the qtype and class, in the qname
+    query(b"abc", b"t.example.com")[:-3],
+    query(b"abc", b"t.example.com")[:-5],
+    query(b"abc", b"t.example.com")[:20],
+])
+def test_malformed_queries(data):
+    with pytest.raises(ValueError):
+        RecvDomainIndex(RECV_DOMAINS).handle_dns_request_questions(data)
+
+
+def test_fuzz_raises_only_value_error():
+    index = RecvDomainIndex(RECV_DOMAINS)
+    rng = random.Random(7)
+    valid = [query(rng.randbytes(rng.randrange(1, 200)).hex().encode()[:rng.randrange(1, 200)], domain)
+             for domain in (b"t.example.com", b"other.example.org", b"example.com")]
+    valid.append(multi_question_query([(b"aaaa", b"t.example.com"), (b"bbbb", b"example.com")]))
+    cases = []
+    for data in valid:
+        cases += [data[:i] for i in range(len(data))]
+        for _ in range(2000):
+            mutated = bytearray(data)
+            for _ in range(rng.randrange(1, 4)):
+                mutated[rng.randrange(len(mutated))] = rng.randrange(256)
+            cases.append(bytes(mutated))
+    cases += [rng.randbytes(rng.randrange(64)) for _ in range(2000)]
+    for data in cases:
+        try:
+            index.handle_dns_request_questions(data)
+        except ValueError:
+            pass
+
+
+def test_template_edns():
+    index = RecvDomainIndex(RECV_DOMAINS)
+    assert template_query(0) == query(b"abcd", b"t.example.com", QTYPE_TXT)
+    data = template_query(1232)
+    assert data[:11] + data[12:-OPT_RR_SIZE] == template_query(0)[:11] + template_query(0)[12:]
+    _, _, payloads, _, next_question = index.handle_dns_request_questions(data)
+    assert [bytes(p) for p in payloads] == [b"abcd"]
+    assert next_question == len(data) - OPT_RR_SIZE
+    assert get_edns_udp_size(data, next_question) == 1232
+
+    # merged queries keep one OPT record at the end
+    merged = pack_questions([template_query(1232, b"aaaa"), template_query(1232, b"bbbb", 0x1235)], 2)
+    assert len(merged) == 1
+    _, _, payloads, _, next_question = index.handle_dns_request_questions(merged[0])
+    assert [bytes(p) for p in payloads] == [b"aaaa", b"bbbb"]
+    assert len(merged[0]) == next_question + OPT_RR_SIZE
+    assert get_edns_udp_size(merged[0], next_question) == 1232
+
+
+@pytest.mark.parametrize("client_edns", [0, 1232])
+def test_answer_fits_the_client_edns(client_edns):
+    # the answering side sizes the answer from the OPT record of the resolver, the resolver passes it back only if it
+    # fits the size the client advertised (512 bytes without EDNS0)
+    answer_max_size = 1232
+    data = template_query(client_edns)
+    _, _, _, _, next_question = RecvDomainIndex(RECV_DOMAINS).handle_dns_request_questions(data)
+    upstream = resolver_upstream_query(data, next_question, 4096)
+    edns_udp_size = get_edns_udp_size(upstream, next_question)
+    assert edns_udp_size == 4096
+    question = upstream[12:next_question]
+    room = min(answer_max_size, max(512, edns_udp_size)) - 12 - len(question) - OPT_RR_SIZE
+    payload = bytes(answer_capacity(QTYPE_TXT, room))
+    response = create_data_response(0x1234, 0x0100, question, 1, QTYPE_TXT, payload,
+                                    min(edns_udp_size, answer_max_size))
+    assert len(response) == answer_max_size
+    client_size = max(512, get_edns_udp_size(data, next_question))
+    assert (len(response) <= client_size) == (client_edns != 0)
+
+
+def test_default_config_queries_have_no_edns():
+    # the shipped config (A queries, no answer_data) sends the same bytes as before EDNS0 support, ARCOUNT 0
+    with open(CONFIG_PATH) as f:
+        config = json.load(f)
+    qtype = config["send_query_type_int"]
+    edns_udp_size = query_edns_udp_size(qtype, config["answer_max_size"], config.get("edns", False))
+    assert edns_udp_size == 0
+    data = QueryTemplate(encode_qname(b"t.example.com"), qtype, config["max_sub_len"], edns_udp_size).build(
+        0x1234, b"", b"abcd")
+    assert data == query(b"abcd", b"t.example.com", qtype)
+    assert data[10:12] == b"\x00\x00"
+
+
+def test_query_edns_udp_size():
+    assert query_edns_udp_size(QTYPE_TXT, 1232, True) == 1232
+    assert query_edns_udp_size(QTYPE_A, 1232, True) == 1232
+    assert query_edns_udp_size(QTYPE_TXT, 1232, False) == 0
+    # CNAME answers can not carry data
+    assert query_edns_udp_size(5, 1232, True) == 0
@@ -0,0 +1,32 @@
+import os
+import stat
+import sys
+
+import pytest
+
+from profiling import Profiler
+
+
+def test_dumps_do_not_overwrite(tmp_path, monkeypatch):
+    # all dumps in the same millisecond
+    monkeypatch.setattr("profiling.time.time", lambda: 1700000000.0)
+    profiler = Profiler(str(tmp_path / "profiles"), 3)
+    paths = [profiler._path("cpu", "prof") for _ in range(5)]
+    assert len(set(paths)) == 5
+    for path in paths:
+        assert os.path.basename(path).startswith("cpu.3.")
+        assert f".{os.getpid()}." in os.path.basename(path)
+    # an existing file is skipped, not truncated
+    with open(paths[0], "w") as f:
+        f.write("old dump")
+    profiler.dumps = 0
+    assert profiler._path("cpu", "prof") not in paths
+    with open(paths[0]) as f:
+        assert f.read() == "old dump"
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="posix file modes")
+def test_only_the_owner_reads_them(tmp_path):
+    path = Profiler(str(tmp_path / "profiles"), 0)._path("memory", "tracemalloc")
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+    assert stat.S_IMODE(os.stat(os.path.dirname(path)).st_mode) == 0o700
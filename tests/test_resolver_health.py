@@ -0,0 +1,43 @@
+from resolver_health import ResolverHealth
+from utility.dns import QTYPE_A, QueryTemplate, encode_qname, renumber_queries
+
+RESOLVERS = ["10.0.0.1", "10.0.0.2"]
+
+
+def queries(q_id: int, count: int = 3) -> list:
+    template = QueryTemplate(encode_qname(b"t.example.com"), QTYPE_A)
+    return [template.build((q_id + i) & 0xFFFF, b"", b"abc%d" % i) for i in range(count)]
+
+
+def reply(query: bytes, rcode: int = 0) -> bytes:
+    return bytes(query[:2]) + bytes((0x84, rcode)) + bytes(query[4:])
+
+
+def test_renumber_queries():
+    first = queries(0xFFFE)
+    second = renumber_queries(first, 0xFFFE + 3)
+    assert [(q[0] << 8) | q[1] for q in second] == [1, 2, 3]
+    assert [q[2:] for q in second] == [q[2:] for q in first]
+    assert [(q[0] << 8) | q[1] for q in first] == [0xFFFE, 0xFFFF, 0]
+
+
+def test_every_try_is_attributed():
+    health = ResolverHealth(RESOLVERS, 2.0, 30.0)
+    first = queries(100)
+    second = renumber_queries(first, 103)
+    for query in first:
+        health.on_sent(0, query, 0.0)
+    for query in second:
+        health.on_sent(1, query, 0.0)
+    # the first try is answered, of the second try only one query
+    for query in first:
+        health.on_reply(reply(query), RESOLVERS[0], 0.1)
+    health.on_reply(reply(second[0], 2), RESOLVERS[1], 0.3)
+    # a reply from the other resolver does not count
+    health.on_reply(reply(second[1]), RESOLVERS[0], 0.3)
+    health.sweep(5.0)
+    assert (health.stats[0].replies, health.stats[0].lost) == (3, 0)
+    assert (health.stats[1].replies, health.stats[1].lost) == (1, 2)
+    assert health.stats[1].rcodes[2] == 1
+    assert round(health.stats[0].rtt, 3) == 0.1
+    assert round(health.stats[1].rtt, 3) == 0.3
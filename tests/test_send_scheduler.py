@@ -0,0 +1,26 @@
+import asyncio
+
+from send_scheduler import TIMER_RESOLUTION, SendScheduler
+
+
+def test_stall_is_not_sent_as_a_burst():
+    async def main():
+        scheduler = SendScheduler([1000.0], 5)
+        bucket = scheduler.buckets[0]
+        while scheduler.acquire(0) is None:
+            pass
+        waiters = [scheduler.acquire(0) for _ in range(500)]
+        scheduler.timer.cancel()
+        # the event loop stalled for 0.3 s, that is 300 tokens
+        bucket.last -= 0.3
+        scheduler._on_timer()
+        released = sum(waiter.done() for waiter in waiters)
+        assert released <= bucket.burst + bucket.rate * TIMER_RESOLUTION + 1
+        assert bucket.tokens < 1.0
+        # a late refill keeps at most max_tokens() too
+        bucket.tokens = 100.0
+        bucket.refill(bucket.last + 0.3)
+        assert bucket.tokens == bucket.max_tokens()
+        scheduler.timer.cancel()
+
+    asyncio.run(main())
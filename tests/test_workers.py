@@ -0,0 +1,41 @@
+from workers import MIN_SHARE, SHARE_STALE_TIME, WorkerShare, pack_demand, unpack_demand
+
+
+def test_one_busy_worker_gets_the_whole_budget():
+    share = WorkerShare(2, 0, 0.0)
+    share.add(100)
+    assert share.tick(1.0) == 100.0
+    share.learn(1, 0.0, 1.0)
+    assert share.update(1.0) == 1.0
+    # the idle worker keeps a small part, to notice its first client
+    idle = WorkerShare(2, 1, 0.0)
+    idle.tick(1.0)
+    idle.learn(0, 100.0, 1.0)
+    assert idle.update(1.0) == MIN_SHARE / 2
+
+
+def test_budget_follows_the_demand():
+    share = WorkerShare(4, 1, 0.0)
+    share.add(30)
+    share.tick(1.0)
+    share.learn(0, 10.0, 1.0)
+    share.learn(2, 60.0, 1.0)
+    assert share.update(1.0) == 0.3
+
+
+def test_idle_and_stale_workers():
+    share = WorkerShare(2, 0, 0.0)
+    share.tick(1.0)
+    assert share.update(1.0) == 0.5
+    # a worker that stopped reporting does not keep its part
+    share.learn(1, 50.0, 1.0)
+    share.add(50)
+    share.tick(2.0)
+    assert share.update(2.0) == 0.5
+    share.add(50)
+    share.tick(2.0 + SHARE_STALE_TIME)
+    assert share.update(2.0 + SHARE_STALE_TIME + 0.5) == 1.0
+
+
+def test_demand_message():
+    assert unpack_demand(pack_demand(3, 12.5)) == (3, 12.5)
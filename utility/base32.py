@@ -9,6 +9,8 @@ BASE32_LIST_LOWER = [b"a", b"b", b"c", b"d", b"e", b"f", b"g", b"h", b"i", b"j",
 BASE32_CHARS_BYTES_UPPER = b"ABCDEFGHIJKLMNOPQRSTUVWXYZ234567"
 BASE32_CHARS_BYTES_LOWER = b"abcdefghijklmnopqrstuvwxyz234567"
 
+_B32_LOWER_TABLE = bytes.maketrans(BASE32_CHARS_BYTES_UPPER, BASE32_CHARS_BYTES_LOWER)
+
 BASE32_LOOKUP = [-1] * 256
 for i, ch in enumerate(BASE32_CHARS_BYTES_UPPER):
     BASE32_LOOKUP[ch] = i
@@ -37,8 +39,11 @@ def base32_to_number(s: bytes) -> int:
 
 def b32decode_nopad(s: bytes) -> bytes:
     pad = (-len(s)) & 7
-    return base64.b32decode(s + b"=" * pad, casefold=True)
+    if pad:
+        s = b"".join((s, b"=" * pad))
+    return base64.b32decode(s, casefold=True)
 
 
 def b32encode_nopad_lower(s: bytes) -> bytes:
-    return base64.b32encode(s).rstrip(b"=").lower()
+    # lowercase and strip the padding in one pass
+    return base64.b32encode(s).translate(_B32_LOWER_TABLE, b"=")
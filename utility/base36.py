@@ -0,0 +1,63 @@
+import math
+
+BASE36_CHARS_BYTES_LOWER = b"0123456789abcdefghijklmnopqrstuvwxyz"
+BASE36_CHARS_BYTES_UPPER = BASE36_CHARS_BYTES_LOWER.upper()
+
+# data is packed in big integers of up to BASE36_BLOCK bytes, so the cost stays linear in the data length,
+# a full block is 199 characters: 5.146 bits per character (base32: 5)
+BASE36_BLOCK = 128
+# BASE36_WIDTHS[n]: characters of a block of n bytes
+BASE36_WIDTHS = [math.ceil(8 * n / math.log2(36)) for n in range(BASE36_BLOCK + 1)]
+_BLOCK_LENS = {width: n for n, width in enumerate(BASE36_WIDTHS)}
+
+# every 3 digits number, 36 ** 3 == 46656
+_DIGITS3 = [bytes((BASE36_CHARS_BYTES_LOWER[i // 1296], BASE36_CHARS_BYTES_LOWER[i // 36 % 36],
+                   BASE36_CHARS_BYTES_LOWER[i % 36])) for i in range(46656)]
+_LEAF_WIDTH = 24
+_powers = {}
+
+
+def _to_digits(n: int, width: int, out: list) -> None:
+    # splits the number in two halves until they are small enough for the 3 digits table
+    if width <= _LEAF_WIDTH:
+        parts = []
+        for _ in range((width + 2) // 3):
+            n, r = divmod(n, 46656)
+            parts.append(_DIGITS3[r])
+        parts.reverse()
+        digits = b"".join(parts)
+        out.append(digits[len(digits) - width:])
+        return
+    half = width // 2
+    power = _powers.get(half)
+    if power is None:
+        power = _powers[half] = 36 ** half
+    high, low = divmod(n, power)
+    _to_digits(high, width - half, out)
+    _to_digits(low, half, out)
+
+
+def b36encode_lower(s: bytes) -> bytes:
+    out = []
+    for i in range(0, len(s), BASE36_BLOCK):
+        block = s[i:i + BASE36_BLOCK]
+        _to_digits(int.from_bytes(block, "big"), BASE36_WIDTHS[len(block)], out)
+    return b"".join(out)
+
+
+def b36decode(s: bytes) -> bytes:
+    s = bytes(s)
+    if s.translate(None, BASE36_CHARS_BYTES_LOWER + BASE36_CHARS_BYTES_UPPER):
+        raise ValueError("Non-base36 digit found")
+    full_width = BASE36_WIDTHS[BASE36_BLOCK]
+    out = []
+    for i in range(0, len(s), full_width):
+        digits = s[i:i + full_width]
+        n = _BLOCK_LENS.get(len(digits))
+        if n is None:
+            raise ValueError("Incorrect base36 length")
+        try:
+            out.append(int(digits, 36).to_bytes(n, "big"))
+        except OverflowError:
+            raise ValueError("Incorrect base36 block") from None
+    return b"".join(out)
@@ -0,0 +1,31 @@
+from utility.base32 import b32encode_nopad_lower, b32decode_nopad
+from utility.base36 import b36encode_lower, b36decode, BASE36_BLOCK, BASE36_WIDTHS
+
+
+class PayloadCodec:
+    """
+    turns the payload into qname characters and back, both sides must use the same codec.
+    the encoded payload is split into fragments at any character and joined again before decode,
+    so encode and decode always see the whole packet.
+    all codecs are case-insensitive, resolvers may randomize the case of the qname (0x20 encoding).
+    """
+    __slots__ = ("name", "encode", "decode", "bits_per_char")
+
+    def __init__(self, name: str, encode, decode, bits_per_char: float) -> None:
+        self.name = name
+        self.encode = encode
+        self.decode = decode
+        self.bits_per_char = bits_per_char
+
+
+PAYLOAD_CODECS = {
+    "base32": PayloadCodec("base32", b32encode_nopad_lower, b32decode_nopad, 5.0),
+    "base36": PayloadCodec("base36", b36encode_lower, b36decode, 8 * BASE36_BLOCK / BASE36_WIDTHS[BASE36_BLOCK]),
+}
+
+
+def get_payload_codec(name: str) -> PayloadCodec:
+    codec = PAYLOAD_CODECS.get(name.lower())
+    if codec is None:
+        raise ValueError(f"unknown payload codec: {name}, supported: {', '.join(PAYLOAD_CODECS)}")
+    return codec
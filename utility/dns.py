@@ -1,5 +1,29 @@
 from struct import pack, unpack_from
 
+# the most questions accepted in one query
+MAX_QUESTIONS = 8
+
+QTYPE_A = 1
+QTYPE_NULL = 10
+QTYPE_TXT = 16
+QTYPE_AAAA = 28
+QTYPE_OPT = 41
+# the answer types that can carry data: A and AAAA records get a sequence byte because resolvers may reorder them
+DATA_QTYPES = (QTYPE_A, QTYPE_NULL, QTYPE_TXT, QTYPE_AAAA)
+_ADDRESS_RECORD_LENS = {QTYPE_A: 4, QTYPE_AAAA: 16}
+# an answer record without rdata: name pointer to the first question, type, class, ttl, rdlength
+_ANSWER_RR = 12
+# the OPT record of the responses: root name, type 41, udp size, extended rcode/version/flags, rdlength 0
+OPT_RR_SIZE = 11
+
+
+def query_edns_udp_size(qtype: int, answer_max_size: int, edns: bool) -> int:
+    """
+    the EDNS0 udp size that the queries advertise: answer_max_size if edns is on and the answers of qtype can carry
+    data, else 0 (no OPT record, the queries are the same as without EDNS0 support)
+    """
+    return answer_max_size if edns and qtype in DATA_QTYPES else 0
+
 
 def label_domain(domain: bytes) -> list[bytes]:
     return [label for label in domain.strip(b".").split(b".") if label]
@@ -38,6 +62,71 @@ def build_dns_query(qname_encoded: bytes, q_id: int, qtype: int) -> bytes:
     return header + question
 
 
+class QueryTemplate:
+    """
+    the fixed parts of every query sent to one send domain: header flags and counts, qname suffix, qtype and qclass,
+    plus the label boundaries of every (header, chunk) length pair that was built once.
+    with edns_udp_size the queries end with an OPT record that advertises it, so the resolver passes back answers
+    bigger than 512 bytes.
+    build() only copies the query id and the data into one new bytearray.
+    """
+    __slots__ = ("head", "tail", "max_sub", "layouts")
+
+    def __init__(self, qname_encoded: bytes, qtype: int, max_sub: int = 63, edns_udp_size: int = 0) -> None:
+        if not qname_encoded or qname_encoded[-1] != 0:
+            raise ValueError("qname_encoded must end with a null byte (\\x00)")
+        self.head = pack("!HHHHHH", 0, 0x0100, 1, 0, 0, 1 if edns_udp_size else 0)
+        self.tail = qname_encoded + pack("!HH", qtype & 0xFFFF, 0x0001)
+        if edns_udp_size:
+            self.tail += pack("!BHHIH", 0, QTYPE_OPT, edns_udp_size, 0, 0)
+        self.max_sub = max_sub
+        self.layouts = {}
+
+    def _layout(self, len_header: int, len_chunk: int) -> tuple:
+        n = len_header + len_chunk
+        max_sub = self.max_sub
+        prefilled = bytearray(self.head)
+        header_copies = []
+        chunk_copies = []
+        src = 0
+        while src < n:
+            label_len = min(max_sub, n - src)
+            prefilled.append(label_len)
+            dst = len(prefilled)
+            prefilled.extend(bytes(label_len))
+            end = src + label_len
+            if src < len_header:
+                h_end = min(end, len_header)
+                header_copies.append((src, h_end, dst, dst + h_end - src))
+                dst += h_end - src
+                src = h_end
+            if src < end:
+                chunk_copies.append((src - len_header, end - len_header, dst, dst + end - src))
+                src = end
+        prefilled.extend(self.tail)
+        layout = (bytes(prefilled), tuple(header_copies), tuple(chunk_copies))
+        self.layouts[(len_header << 8) | len_chunk] = layout
+        return layout
+
+    def build(self, q_id: int, header: bytes, chunk: bytes) -> bytearray:
+        """
+        the same bytes as build_dns_query(insert_dots(header + chunk, max_sub) + qname_encoded, q_id, qtype),
+        followed by the OPT record with edns_udp_size
+        """
+        layout = self.layouts.get((len(header) << 8) | len(chunk))
+        if layout is None:
+            layout = self._layout(len(header), len(chunk))
+        prefilled, header_copies, chunk_copies = layout
+        buf = bytearray(prefilled)
+        buf[0] = (q_id >> 8) & 0xFF
+        buf[1] = q_id & 0xFF
+        for src_s, src_e, dst_s, dst_e in header_copies:
+            buf[dst_s:dst_e] = header[src_s:src_e]
+        for src_s, src_e, dst_s, dst_e in chunk_copies:
+            buf[dst_s:dst_e] = chunk[src_s:src_e]
+        return buf
+
+
 def insert_dots(data: bytes, max_sub: int = 63) -> bytes:
     n = len(data)
     # chunks = (n + max_sub - 1) // max_sub
@@ -56,12 +145,12 @@ def handle_question(data: bytes, offset: int) -> tuple[list, int, int]:
     while offset < len_data:
         label_len = data[offset]
         if label_len == 0:
-            qtype, qclass = unpack_from("!HH", data, offset + 1)
-            if qclass != 1:
-                raise ValueError
             next_question = offset + 5
             if next_question > len_data:
                 raise ValueError
+            qtype, qclass = unpack_from("!HH", data, offset + 1)
+            if qclass != 1:
+                raise ValueError
             return labels, qtype, next_question
         if label_len > 63:
             raise ValueError
@@ -85,7 +174,161 @@ def handle_dns_request(data: bytes) -> tuple[int, int, list, int, int]:
     return qid, qflags, labels, qtype, next_question  # question = data[12:next_question]
 
 
-def create_noerror_empty_response(qid: int, qflags: int, question: bytes) -> bytes:
+class RecvDomainIndex:
+    """
+    finds the recv domain of a query with one hash lookup per suffix label of the qname,
+    so the cost does not grow with the number of recv domains.
+    a suffix that is in several recv domains belongs to the first one, as in the config order.
+    """
+    __slots__ = ("suffixes", "suffix_lens", "max_labels")
+
+    def __init__(self, recv_domains: list[bytes]) -> None:
+        self.suffixes = {}  # encoded lowercase suffix (with the root label): recv domain index
+        self.max_labels = 0
+        for i, recv_domain in enumerate(recv_domains):
+            labels = label_domain(recv_domain.lower())
+            if not labels:
+                continue
+            self.suffixes.setdefault(encode_qname(b".".join(labels)), i)
+            self.max_labels = max(self.max_labels, len(labels))
+        self.suffix_lens = frozenset(len(suffix) for suffix in self.suffixes)
+
+    def handle_dns_request(self, data: bytes) -> tuple[int, int, bytes | memoryview, int, int]:
+        """
+        the same checks as handle_dns_request, but returns the labels before the recv domain joined together
+        (without the length bytes and not lowercased), a single label is returned as a memoryview of data.
+        """
+        if len(data) < 17:
+            raise ValueError
+
+        qid, qflags, qdcount = unpack_from("!HHH", data, 0)
+        if qdcount != 1:
+            raise ValueError("not 1 question")
+        if qflags & 0x8000:
+            raise ValueError("not query")
+        payload, qtype, next_question = self.handle_question(data, 12)
+        return qid, qflags, payload, qtype, next_question
+
+    def handle_dns_request_questions(self, data: bytes, max_questions: int = MAX_QUESTIONS) -> \
+            tuple[int, int, list, int, int]:
+        """
+        like handle_dns_request for queries with 1 to max_questions questions, returns the payload of every
+        question, the qtype of the first one and the end of the questions. every question must be for a recv domain.
+        """
+        if len(data) < 17:
+            raise ValueError
+
+        qid, qflags, qdcount = unpack_from("!HHH", data, 0)
+        if qdcount == 0 or qdcount > max_questions:
+            raise ValueError("unsupported number of questions")
+        if qflags & 0x8000:
+            raise ValueError("not query")
+        payload, qtype, next_question = self.handle_question(data, 12)
+        payloads = [payload]
+        for _ in range(qdcount - 1):
+            payload, _, next_question = self.handle_question(data, next_question)
+            payloads.append(payload)
+        return qid, qflags, payloads, qtype, next_question
+
+    def handle_question(self, data: bytes, offset: int) -> tuple[bytes | memoryview, int, int]:
+        len_data = len(data)
+        label_starts = []
+        while True:
+            if offset >= len_data:
+                raise ValueError
+            label_len = data[offset]
+            if label_len == 0:
+                break
+            if label_len > 63:
+                raise ValueError
+            label_starts.append(offset)
+            offset += label_len + 1
+        next_question = offset + 5
+        if next_question > len_data:
+            raise ValueError
+        qtype, qclass = unpack_from("!HH", data, offset + 1)
+        if qclass != 1:
+            raise ValueError
+
+        suffixes = self.suffixes
+        suffix_lens = self.suffix_lens
+        qname_end = offset + 1
+        payload_labels = -1
+        best = -1
+        len_labels = len(label_starts)
+        for i in range(max(0, len_labels - self.max_labels), len_labels):
+            label_s = label_starts[i]
+            if qname_end - label_s not in suffix_lens:
+                continue
+            recv_domain_index = suffixes.get(data[label_s:qname_end].lower())
+            if recv_domain_index is not None and (best < 0 or recv_domain_index < best):
+                best = recv_domain_index
+                payload_labels = i
+        if payload_labels < 0:
+            raise ValueError("no accepted recv domain")
+
+        if payload_labels == 0:
+            payload = b""
+        elif payload_labels == 1:
+            payload = memoryview(data)[label_starts[0] + 1:label_starts[1]]
+        else:
+            payload = b"".join([data[label_starts[i] + 1:label_starts[i + 1]] for i in range(payload_labels)])
+        return payload, qtype, next_question
+
+
+def renumber_queries(queries: list, q_id: int) -> list:
+    """
+    copies of the queries with the query ids q_id, q_id + 1, ... (mod 65536)
+    """
+    renumbered = []
+    for query in queries:
+        copy = bytearray(query)
+        copy[0] = (q_id >> 8) & 0xFF
+        copy[1] = q_id & 0xFF
+        renumbered.append(copy)
+        q_id = (q_id + 1) & 0xFFFF
+    return renumbered
+
+
+def pack_questions(queries: list, max_questions: int, max_message_len: int = 512) -> list:
+    """
+    merges runs of up to max_questions single-question queries (built by build_dns_query/QueryTemplate) into one
+    query with all their questions and the query id of the first one.
+    a message is kept within max_message_len, so the reply that echoes the questions does not need EDNS or TCP.
+    queries with an OPT record (QueryTemplate with edns_udp_size) keep one at the end of the message.
+    """
+    messages = []
+    group = []
+    group_len = 0
+    for query in queries:
+        if group and len(group) < max_questions and \
+                group_len + len(query) - 12 - (OPT_RR_SIZE if query[11] else 0) <= max_message_len:
+            group.append(query)
+            group_len += len(query) - 12 - (OPT_RR_SIZE if query[11] else 0)
+            continue
+        if group:
+            messages.append(_merge_questions(group))
+        group = [query]
+        group_len = len(query)
+    if group:
+        messages.append(_merge_questions(group))
+    return messages
+
+
+def _merge_questions(group: list):
+    if len(group) == 1:
+        return group[0]
+    header = bytearray(group[0][:12])
+    header[4] = len(group) >> 8
+    header[5] = len(group) & 0xFF
+    if not header[11]:
+        return b"".join([header] + [memoryview(query)[12:] for query in group])
+    # the questions without the OPT record of each query, then the OPT record once
+    return b"".join([header] + [memoryview(query)[12:-OPT_RR_SIZE] for query in group] +
+                    [memoryview(group[0])[-OPT_RR_SIZE:]])
+
+
+def create_noerror_empty_response(qid: int, qflags: int, question: bytes, qdcount: int = 1) -> bytes:
     # QR = 1
     # Opcode = echo
     # AA = 1
@@ -99,6 +342,140 @@ def create_noerror_empty_response(qid: int, qflags: int, question: bytes) -> byt
 
     rflags = 0x8400 | (qflags & 0x7910) | (((qflags & 0x7800) != 0) << 2)
 
-    header = pack("!HHHHHH", qid, rflags, 1, 0, 0, 0)
+    header = pack("!HHHHHH", qid, rflags, qdcount, 0, 0, 0)
 
     return header + question
+
+
+def skip_name(data: bytes, offset: int) -> int:
+    """
+    returns the offset after the (possibly compressed) name that starts at offset
+    """
+    len_data = len(data)
+    while True:
+        if offset >= len_data:
+            raise ValueError
+        label_len = data[offset]
+        if label_len == 0:
+            return offset + 1
+        if label_len >= 0xC0:
+            return offset + 2
+        if label_len > 63:
+            raise ValueError
+        offset += label_len + 1
+
+
+def get_edns_udp_size(data: bytes, next_question: int) -> int:
+    """
+    the udp payload size of the OPT record in the additional section of a query, 0 without EDNS.
+    next_question is the end of the questions, queries with answer or authority records are not looked at.
+    """
+    ancount, nscount, arcount = unpack_from("!HHH", data, 6)
+    if ancount or nscount:
+        return 0
+    offset = next_question
+    for _ in range(arcount):
+        offset = skip_name(data, offset)
+        rtype, rclass, _, rdlength = unpack_from("!HHIH", data, offset)
+        if rtype == QTYPE_OPT:
+            return rclass
+        offset += 10 + rdlength
+    return 0
+
+
+def answer_capacity(qtype: int, room: int) -> int:
+    """
+    how many payload bytes fit in the answer of a response that has room bytes left (after header, questions and OPT)
+    """
+    room -= _ANSWER_RR
+    if room <= 0:
+        return 0
+    if qtype == QTYPE_NULL:
+        return min(room, 65535)
+    if qtype == QTYPE_TXT:
+        # every 255 bytes need a length byte
+        return min(room - (room + 255) // 256, 65535 - 256)
+    record_len = _ADDRESS_RECORD_LENS.get(qtype)
+    if record_len is None:
+        return 0
+    # one record per (record_len - 1) bytes, each record after the first costs a whole answer record
+    records = min((room + _ANSWER_RR) // (_ANSWER_RR + record_len), 256)
+    return records * (record_len - 1)
+
+
+def create_data_response(qid: int, qflags: int, question: bytes, qdcount: int, qtype: int, payload: bytes,
+                         edns_udp_size: int = 0) -> bytes:
+    """
+    a NOERROR response with the payload in answer records of qtype (one of DATA_QTYPES) for the first question,
+    with ttl 0. payload must be at most answer_capacity() bytes, A/AAAA records are zero padded.
+    with edns_udp_size an OPT record is added, as the query had one.
+    """
+    rflags = 0x8400 | (qflags & 0x7910) | (((qflags & 0x7800) != 0) << 2)
+    parts = []
+    if qtype == QTYPE_NULL:
+        parts.append(pack("!HHHIH", 0xC00C, qtype, 1, 0, len(payload)))
+        parts.append(payload)
+        ancount = 1
+    elif qtype == QTYPE_TXT:
+        strings = []
+        for i in range(0, len(payload), 255):
+            string = payload[i:i + 255]
+            strings.append(bytes((len(string),)))
+            strings.append(string)
+        rdata = b"".join(strings)
+        parts.append(pack("!HHHIH", 0xC00C, qtype, 1, 0, len(rdata)))
+        parts.append(rdata)
+        ancount = 1
+    else:
+        record_len = _ADDRESS_RECORD_LENS[qtype]
+        data_len = record_len - 1
+        ancount = 0
+        for i in range(0, len(payload), data_len):
+            record = payload[i:i + data_len]
+            parts.append(pack("!HHHIHB", 0xC00C, qtype, 1, 0, record_len, ancount))
+            parts.append(record)
+            if len(record) < data_len:
+                parts.append(bytes(data_len - len(record)))
+            ancount += 1
+    arcount = 0
+    if edns_udp_size:
+        parts.append(pack("!BHHIH", 0, QTYPE_OPT, edns_udp_size, 0, 0))
+        arcount = 1
+    return pack("!HHHHHH", qid, rflags, qdcount, ancount, 0, arcount) + question + b"".join(parts)
+
+
+def get_answer_payload(data: bytes) -> bytes:
+    """
+    the payload of the answers of a response built by create_data_response, b"" if it has none
+    """
+    qdcount, ancount = unpack_from("!HH", data, 4)
+    if not ancount:
+        return b""
+    offset = 12
+    for _ in range(qdcount):
+        offset = skip_name(data, offset) + 4
+    parts = []
+    records = []
+    for _ in range(ancount):
+        offset = skip_name(data, offset)
+        rtype, _, _, rdlength = unpack_from("!HHIH", data, offset)
+        offset += 10
+        rdata_end = offset + rdlength
+        if rdata_end > len(data):
+            raise ValueError
+        if rtype == QTYPE_NULL:
+            parts.append(data[offset:rdata_end])
+        elif rtype == QTYPE_TXT:
+            while offset < rdata_end:
+                string_end = offset + 1 + data[offset]
+                if string_end > rdata_end:
+                    raise ValueError
+                parts.append(data[offset + 1:string_end])
+                offset = string_end
+        elif rtype in _ADDRESS_RECORD_LENS and rdlength == _ADDRESS_RECORD_LENS[rtype]:
+            records.append(data[offset:rdata_end])
+        offset = rdata_end
+    if records:
+        records.sort(key=lambda record: record[0])
+        parts.extend(record[1:] for record in records)
+    return b"".join(parts)
@@ -0,0 +1,182 @@
+import os
+import signal
+import socket
+import struct
+import sys
+
+FRAGMENT_MESSAGE = 0
+H_ADDR_MESSAGE = 1
+SESSION_ADDR_MESSAGE = 2
+SESSION_DATA_MESSAGE = 3
+DEMAND_MESSAGE = 4
+
+INBOX_BUFFER_SIZE = 4 << 20
+
+# the workers tell each other their send demand this often, and the budget is split again
+SHARE_INTERVAL = 0.25
+# the demand of a worker that did not report for this long (it stopped) is not counted
+SHARE_STALE_TIME = 4 * SHARE_INTERVAL
+# a worker without demand keeps this part of its equal share, so its first packets are not stuck behind a zero rate.
+# the shares of all workers add up to at most 1 + MIN_SHARE
+MIN_SHARE = 0.05
+
+_FRAGMENT_HEADER = struct.Struct("!BIB?B")
+_SESSION_HEADER = struct.Struct("!BH")
+_DEMAND_MESSAGE = struct.Struct("!BHd")
+
+
+def create_inboxes(workers_count: int) -> list[tuple[socket.socket, socket.socket]]:
+    """
+    one unix datagram socketpair per worker: (read end, write end), the write ends are shared by all workers
+    """
+    inboxes = []
+    for _ in range(workers_count):
+        read_end, write_end = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        for s in (read_end, write_end):
+            s.setblocking(False)
+            try:
+                s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, INBOX_BUFFER_SIZE)
+                s.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, INBOX_BUFFER_SIZE)
+            except OSError:
+                pass
+        inboxes.append((read_end, write_end))
+    return inboxes
+
+
+def fork_workers(workers_count: int) -> int:
+    """
+    forks the workers and returns the worker id in each of them,
+    the parent only supervises: it stops all workers when one of them exits or when it is terminated, and passes
+    SIGHUP (reload), SIGUSR1 and SIGUSR2 (profiling) on to them.
+    """
+    if not hasattr(os, "fork") or not hasattr(socket, "SO_REUSEPORT"):
+        sys.exit("workers are only supported on linux/bsd (fork and SO_REUSEPORT)")
+    children = {}
+    for worker_id in range(workers_count):
+        pid = os.fork()
+        if pid == 0:
+            return worker_id
+        children[pid] = worker_id
+
+    def stop_children(signum, frame, exit_code=0):
+        for child_pid in children:
+            try:
+                os.kill(child_pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        sys.exit(exit_code)
+
+    def signal_children(signum, frame):
+        for child_pid in children:
+            try:
+                os.kill(child_pid, signum)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop_children)
+    signal.signal(signal.SIGINT, stop_children)
+    signal.signal(signal.SIGHUP, signal_children)
+    signal.signal(signal.SIGUSR1, signal_children)
+    signal.signal(signal.SIGUSR2, signal_children)
+    pid, status = os.wait()
+    exit_code = os.waitstatus_to_exitcode(status)
+    print("worker exited:", children.pop(pid), "exit code:", exit_code)
+    # a worker never stops by itself, so the tunnel fails (killed by a signal: 128 + signal like the shell), and
+    # systemd Restart=on-failure restarts it
+    stop_children(signal.SIGTERM, None, 128 - exit_code if exit_code < 0 else exit_code or 1)
+
+
+def pack_fragment(data_offset: int, fragment_part: int, last_fragment: bool, chunk_data: bytes,
+                  packet_flags: int) -> bytes:
+    return _FRAGMENT_HEADER.pack(FRAGMENT_MESSAGE, data_offset, fragment_part, last_fragment, packet_flags) + chunk_data
+
+
+def unpack_fragment(message: bytes) -> tuple[int, int, bool, bytes, int]:
+    _, data_offset, fragment_part, last_fragment, packet_flags = _FRAGMENT_HEADER.unpack_from(message, 0)
+    return data_offset, fragment_part, last_fragment, message[_FRAGMENT_HEADER.size:], packet_flags
+
+
+def pack_h_addr(addr: tuple) -> bytes:
+    return bytes((H_ADDR_MESSAGE,)) + f"{addr[0]}:{addr[1]}".encode()
+
+
+def unpack_h_addr(message: bytes) -> tuple:
+    ip, port = message[1:].decode().rsplit(":", 1)
+    return ip, int(port)
+
+
+def pack_session_addr(session_id: int, addr: tuple) -> bytes:
+    return _SESSION_HEADER.pack(SESSION_ADDR_MESSAGE, session_id) + f"{addr[0]}:{addr[1]}".encode()
+
+
+def unpack_session_addr(message: bytes) -> tuple[int, tuple]:
+    _, session_id = _SESSION_HEADER.unpack_from(message, 0)
+    ip, port = message[_SESSION_HEADER.size:].decode().rsplit(":", 1)
+    return session_id, (ip, int(port))
+
+
+def pack_session_data(session_id: int, data: bytes) -> bytes:
+    return _SESSION_HEADER.pack(SESSION_DATA_MESSAGE, session_id) + data
+
+
+def unpack_session_data(message: bytes) -> tuple[int, bytes]:
+    _, session_id = _SESSION_HEADER.unpack_from(message, 0)
+    return session_id, message[_SESSION_HEADER.size:]
+
+
+def pack_demand(worker_id: int, demand: float) -> bytes:
+    return _DEMAND_MESSAGE.pack(DEMAND_MESSAGE, worker_id, demand)
+
+
+def unpack_demand(message: bytes) -> tuple[int, float]:
+    _, worker_id, demand = _DEMAND_MESSAGE.unpack(message)
+    return worker_id, demand
+
+
+class WorkerShare:
+    """
+    splits the send budget (the rate of every resolver and the send sockets) between the workers by their demand:
+    the queries each one queued in the last SHARE_INTERVAL. the kernel hands each h side client to one worker, so a
+    single client gets the whole budget instead of 1/N of it, and with several clients every worker gets its part.
+    """
+
+    def __init__(self, workers_count: int, worker_id: int, now: float) -> None:
+        self.workers_count = workers_count
+        self.worker_id = worker_id
+        self.queued = 0
+        self.last_tick = now
+        self.demands = [0.0] * workers_count
+        self.reported = [now] * workers_count
+        self.share = 1 / workers_count
+
+    def add(self, queries: int) -> None:
+        self.queued += queries
+
+    def learn(self, other_id: int, demand: float, now: float) -> None:
+        if 0 <= other_id < self.workers_count:
+            self.demands[other_id] = demand
+            self.reported[other_id] = now
+
+    def tick(self, now: float) -> float:
+        """
+        ends an interval: returns the demand of this worker (queries per second) to send to the others
+        """
+        elapsed = now - self.last_tick
+        demand = self.queued / elapsed if elapsed > 0 else 0.0
+        self.queued = 0
+        self.last_tick = now
+        self.demands[self.worker_id] = demand
+        self.reported[self.worker_id] = now
+        return demand
+
+    def update(self, now: float) -> float:
+        """
+        the part of the budget (0 to 1) of this worker after the last reports
+        """
+        stale = now - SHARE_STALE_TIME
+        total = sum(demand for demand, reported in zip(self.demands, self.reported) if reported >= stale)
+        if total <= 0:
+            self.share = 1 / self.workers_count
+        else:
+            self.share = max(self.demands[self.worker_id] / total, MIN_SHARE / self.workers_count)
+        return self.share